@@ -0,0 +1,103 @@
+import os
+import uuid
+import asyncio
+import functools
+import tempfile
+import concurrent.futures
+from typing import NamedTuple
+
+from aiohttp import web
+from comfy.cli_args import args
+
+CHUNK_SIZE = 1024 * 1024
+# uploads bigger than this go to a temporary file on disk instead of memory
+SPOOL_SIZE = 4 * 1024 * 1024
+
+_pool = None
+
+def get_pool():
+    global _pool
+    if _pool is None:
+        _pool = concurrent.futures.ThreadPoolExecutor(max_workers=max(args.file_io_threads, 1), thread_name_prefix="file_io")
+    return _pool
+
+async def run(function, *args, **kwargs):
+    """
+    Runs the blocking function on the file I/O thread pool so disk and image
+    work doesn't stall the event loop.
+    """
+    return await asyncio.get_running_loop().run_in_executor(get_pool(), functools.partial(function, *args, **kwargs))
+
+class UploadedFile(NamedTuple):
+    filename: str
+    content_type: str
+    file: object
+
+async def read_multipart(request, max_size):
+    """
+    Like request.post() but file parts are streamed in chunks to temporary
+    files on the thread pool instead of being read into memory. Raises
+    HTTPRequestEntityTooLarge past max_size bytes, 0 is no limit. The files
+    have to be closed with close_multipart().
+    """
+    if not request.content_type.startswith("multipart/"):
+        return dict(await request.post())
+
+    post = {}
+    size = 0
+    try:
+        reader = await request.multipart()
+        async for part in reader:
+            if getattr(part, "name", None) is None:
+                # nested multiparts aren't used by the frontend
+                continue
+            if part.filename is None:
+                value = await part.text()
+                size += len(value)
+                if max_size > 0 and size > max_size:
+                    raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+                post[part.name] = value
+                continue
+
+            f = tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+            post[part.name] = UploadedFile(part.filename, part.headers.get("Content-Type", "application/octet-stream"), f)
+            while True:
+                chunk = await part.read_chunk(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if max_size > 0 and size > max_size:
+                    raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+                await run(f.write, chunk)
+            await run(f.seek, 0)
+    except BaseException:
+        close_multipart(post)
+        raise
+    return post
+
+def close_multipart(post):
+    for value in post.values():
+        if isinstance(value, UploadedFile):
+            value.file.close()
+
+async def write_stream(stream, path, max_size=0):
+    """
+    Writes the body of a request to path in chunks, through a temporary file
+    next to it so a failed upload doesn't leave a partial file behind. Raises
+    HTTPRequestEntityTooLarge past max_size bytes, 0 is no limit.
+    """
+    temp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+    f = await run(open, temp, "wb")
+    size = 0
+    try:
+        async for chunk in stream.iter_chunked(CHUNK_SIZE):
+            size += len(chunk)
+            if max_size > 0 and size > max_size:
+                raise web.HTTPRequestEntityTooLarge(max_size=max_size, actual_size=size)
+            await run(f.write, chunk)
+        await run(f.close)
+        await run(os.replace, temp, path)
+    except BaseException:
+        await run(f.close)
+        await run(lambda: os.path.exists(temp) and os.remove(temp))
+        raise
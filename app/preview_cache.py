@@ -0,0 +1,91 @@
+import os
+import uuid
+import json
+import shutil
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+class PreviewCache:
+    """
+    The images /view converts files to (previews, thumbnails, single
+    channels), written to a directory capped at max_bytes on disk. The least
+    recently used files are deleted first. A variant is keyed by the path,
+    modification time and size of the file it comes from, so changed files
+    are converted again and their old variants age out.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.files = OrderedDict()
+        self.size = 0
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def name(self, file, variant):
+        stat = os.stat(file)
+        key = json.dumps([os.path.abspath(file), stat.st_mtime_ns, stat.st_size] + list(variant))
+        return "{}.{}".format(hashlib.sha1(key.encode("utf-8")).hexdigest(), variant[0])
+
+    def read(self, name):
+        with self.lock:
+            if name not in self.files:
+                return None
+            self.files.move_to_end(name)
+        try:
+            with open(os.path.join(self.directory, name), "rb") as f:
+                return f.read()
+        except OSError:
+            self.remove(name)
+            return None
+
+    def write(self, name, data):
+        if len(data) > self.max_bytes:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name)
+        temp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        try:
+            with open(temp, "wb") as f:
+                f.write(data)
+            os.replace(temp, path)
+        except OSError as e:
+            logging.warning("Failed to cache preview {}: {}".format(path, e))
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+
+        with self.lock:
+            if name in self.files:
+                self.size -= self.files[name]
+            self.files[name] = len(data)
+            self.size += len(data)
+            evicted = []
+            while self.size > self.max_bytes and len(self.files) > 0:
+                old, size = self.files.popitem(last=False)
+                self.size -= size
+                evicted.append(old)
+        for old in evicted:
+            try:
+                os.remove(os.path.join(self.directory, old))
+            except OSError:
+                pass
+
+    def remove(self, name):
+        with self.lock:
+            size = self.files.pop(name, None)
+            if size is not None:
+                self.size -= size
+
+    def get(self, file, variant, convert):
+        """
+        The bytes of a variant of file, tuple starting with the file
+        extension, made with convert() when it isn't cached.
+        """
+        name = self.name(file, variant)
+        data = self.read(name)
+        if data is None:
+            data = convert()
+            self.write(name, data)
+        return data
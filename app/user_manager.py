@@ -8,6 +8,7 @@ from aiohttp import web
 from comfy.cli_args import args
 from folder_paths import user_directory
 from .app_settings import AppSettings
+from . import file_io
 
 default_user = "default"
 users_file = os.path.join(user_directory, "users.json")
@@ -110,24 +111,29 @@ class UserManager():
             user_id = self.add_user(username)
             return web.json_response(user_id)
 
-        @routes.get("/userdata")
-        async def listuserdata(request):
-            directory = request.rel_url.query.get('dir', '')
-            if not directory:
-                return web.Response(status=400)
-                
+        def list_user_files(request, directory, recurse):
             path = self.get_request_user_filepath(request, directory)
             if not path:
                 return web.Response(status=403)
-            
+
             if not os.path.exists(path):
                 return web.Response(status=404)
-            
-            recurse = request.rel_url.query.get('recurse', '').lower() == "true"
+
             results = glob.glob(os.path.join(
                 glob.escape(path), '**/*'), recursive=recurse)
-            results = [os.path.relpath(x, path) for x in results if os.path.isfile(x)]
-            
+            return [os.path.relpath(x, path) for x in results if os.path.isfile(x)]
+
+        @routes.get("/userdata")
+        async def listuserdata(request):
+            directory = request.rel_url.query.get('dir', '')
+            if not directory:
+                return web.Response(status=400)
+                
+            recurse = request.rel_url.query.get('recurse', '').lower() == "true"
+            results = await file_io.run(list_user_files, request, directory, recurse)
+            if not isinstance(results, list):
+                return results
+
             split_path = request.rel_url.query.get('split', '').lower() == "true"
             if split_path:
                 results = [[x] + x.split(os.sep) for x in results]
@@ -150,7 +156,7 @@ class UserManager():
 
         @routes.get("/userdata/{file}")
         async def getuserdata(request):
-            path = get_user_data_path(request, check_exists=True)
+            path = await file_io.run(get_user_data_path, request, check_exists=True)
             if not isinstance(path, str):
                 return path
             
@@ -158,48 +164,45 @@ class UserManager():
 
         @routes.post("/userdata/{file}")
         async def post_userdata(request):
-            path = get_user_data_path(request)
+            path = await file_io.run(get_user_data_path, request)
             if not isinstance(path, str):
                 return path
             
             overwrite = request.query["overwrite"] != "false"
-            if not overwrite and os.path.exists(path):
+            if not overwrite and await file_io.run(os.path.exists, path):
                 return web.Response(status=409)
 
-            body = await request.read()
-
-            with open(path, "wb") as f:
-                f.write(body)
+            await file_io.write_stream(request.content, path, request.client_max_size)
                 
-            resp = os.path.relpath(path, self.get_request_user_filepath(request, None))
+            resp = os.path.relpath(path, await file_io.run(self.get_request_user_filepath, request, None))
             return web.json_response(resp)
 
         @routes.delete("/userdata/{file}")
         async def delete_userdata(request):
-            path = get_user_data_path(request, check_exists=True)
+            path = await file_io.run(get_user_data_path, request, check_exists=True)
             if not isinstance(path, str):
                 return path
 
-            os.remove(path)
+            await file_io.run(os.remove, path)
                 
             return web.Response(status=204)
 
         @routes.post("/userdata/{file}/move/{dest}")
         async def move_userdata(request):
-            source = get_user_data_path(request, check_exists=True)
+            source = await file_io.run(get_user_data_path, request, check_exists=True)
             if not isinstance(source, str):
                 return source
             
-            dest = get_user_data_path(request, check_exists=False, param="dest")
+            dest = await file_io.run(get_user_data_path, request, check_exists=False, param="dest")
             if not isinstance(source, str):
                 return dest
             
             overwrite = request.query["overwrite"] != "false"
-            if not overwrite and os.path.exists(dest):
+            if not overwrite and await file_io.run(os.path.exists, dest):
                 return web.Response(status=409)
 
             print(f"moving '{source}' -> '{dest}'")
-            shutil.move(source, dest)
+            await file_io.run(shutil.move, source, dest)
                 
-            resp = os.path.relpath(dest, self.get_request_user_filepath(request, None))
+            resp = os.path.relpath(dest, await file_io.run(self.get_request_user_filepath, request, None))
             return web.json_response(resp)
@@ -1,5 +1,6 @@
 import argparse
 import enum
+import math
 import comfy.options
 
 class EnumAction(argparse.Action):
@@ -30,6 +31,22 @@ class EnumAction(argparse.Action):
         value = self._enum(values)
         setattr(namespace, self.dest, value)
 
+def name_value(value_type, minimum, strict=False):
+    """
+    Argparse type for NAME=VALUE arguments, parses to a (name, value) tuple
+    with a value of at least minimum (greater than it if strict).
+    """
+    def parse(argument):
+        name, _, value = argument.rpartition("=")
+        try:
+            value = value_type(value)
+        except ValueError:
+            value = None
+        if name == "" or value is None or not math.isfinite(value) or value < minimum or (strict and value == minimum):
+            raise argparse.ArgumentTypeError("expected NAME=VALUE with a {} {} {}, got {!r}".format("whole number" if value_type is int else "number", ">" if strict else ">=", minimum, argument))
+        return (name, value)
+    return parse
+
 
 parser = argparse.ArgumentParser()
 
@@ -39,6 +56,8 @@ parser.add_argument("--tls-keyfile", type=str, help="Path to TLS (SSL) key file.
 parser.add_argument("--tls-certfile", type=str, help="Path to TLS (SSL) certificate file. Enables TLS, makes app accessible at https://... requires --tls-keyfile to function")
 parser.add_argument("--enable-cors-header", type=str, default=None, metavar="ORIGIN", nargs="?", const="*", help="Enable CORS (Cross-Origin Resource Sharing) with optional origin or allow all with default '*'.")
 parser.add_argument("--max-upload-size", type=float, default=100, help="Set the maximum upload size in MB.")
+parser.add_argument("--file-io-threads", type=int, default=4, metavar="N", help="The number of threads the server uses to read and write uploads, views and user data without blocking its event loop.")
+parser.add_argument("--preview-cache-size", type=float, default=512, metavar="MB", help="Maximum disk space in MB used to cache the previews, thumbnails and channels /view converts images to, least recently used ones are deleted first. 0 disables the cache.")
 
 parser.add_argument("--extra-model-paths-config", type=str, default=None, metavar="PATH", nargs='+', action='append', help="Load one or more extra_model_paths.yaml files.")
 parser.add_argument("--output-directory", type=str, default=None, help="Set the ComfyUI output directory.")
@@ -110,6 +129,52 @@ vram_group.add_argument("--novram", action="store_true", help="When lowvram isn'
 vram_group.add_argument("--cpu", action="store_true", help="To use the CPU for everything (slow).")
 
 
+parser.add_argument("--queue-db", type=str, default=None, metavar="PATH", help="Keep the prompt queue and history in this SQLite database instead of in memory. Queued prompts survive a restart and history is read from disk when requested.")
+
+class QueuePolicy(enum.Enum):
+    FIFO = "fifo"
+    ModelAffinity = "model-affinity"
+    Fair = "fair"
+    ShortestJob = "shortest-job"
+    Deadline = "deadline"
+
+parser.add_argument("--queue-policy", type=QueuePolicy, default=QueuePolicy.FIFO, help="fifo: run queued prompts in order. model-affinity: among the next --affinity-window prompts, run the one that shares the most models with the previous prompt first, to avoid reloading weights when submissions alternate between checkpoints. fair: weighted fair queuing between users (--multi-user) or client ids, see --fair-weights and --fair-max-running. shortest-job: run the prompt with the lowest estimated run time first, see --sjf-max-wait. deadline: run the prompt that has to start the soonest to meet its deadline (\"deadline\" in seconds in the POST /prompt request, else --default-deadline) first.", action=EnumAction)
+parser.add_argument("--affinity-window", type=int, default=16, metavar="N", help="How many queued prompts the model-affinity policy looks at.")
+parser.add_argument("--affinity-max-skips", type=int, default=4, metavar="N", help="How many times the model-affinity policy can run other prompts ahead of a queued prompt before it has to run.")
+parser.add_argument("--fair-weights", type=name_value(float, 0, strict=True), nargs="+", default=[], metavar="NAME=WEIGHT", help="Share of the worker each user or client id gets with the fair queue policy, relative to the others. * sets the default (1).")
+parser.add_argument("--fair-max-running", type=name_value(int, 0), nargs="+", default=[], metavar="NAME=N", help="Maximum number of prompts of a user or client id running at the same time with the fair queue policy. * sets the default (0, no limit).")
+parser.add_argument("--sjf-max-wait", type=float, default=600.0, metavar="SECONDS", help="With the shortest-job queue policy, a prompt that has been queued this long runs next whatever its estimated run time.")
+parser.add_argument("--default-deadline", type=float, default=3600.0, metavar="SECONDS", help="Deadline of the prompts queued without one, with the deadline queue policy.")
+
+parser.add_argument("--enable-prompt-deduplication", action="store_true", help="Don't run a prompt when an identical one (same nodes, inputs and outputs) is already queued or running, it follows that one instead: its client gets the same progress messages and its history entry the same outputs. Prompts with nodes that define IS_CHANGED or aren't idempotent always run.")
+
+parser.add_argument("--max-queue", type=int, default=0, metavar="N", help="Reject new prompts with 429 Too Many Requests while N prompts are pending. 0 is no limit.")
+parser.add_argument("--max-queue-per-user", type=int, default=0, metavar="N", help="Reject new prompts of a user (--multi-user) or client id that already has N prompts pending. 0 is no limit.")
+parser.add_argument("--max-queue-time", type=float, default=0, metavar="SECONDS", help="Reject new prompts when the pending ones are estimated to take more than this many seconds to run, estimates come from the run times of earlier prompts of the same workflow. 0 is no limit.")
+
+parser.add_argument("--cache-lru", type=int, default=0, metavar="N", help="Also keep the outputs of up to N node executions in a content-addressed LRU cache shared across prompts, so identical subgraphs submitted by other clients or under other node ids are not recomputed. 0 disables it.")
+
+parser.add_argument("--cache-ram-budget", type=float, default=None, metavar="MB", help="RAM budget in MB for IMAGE, LATENT and MASK outputs held by --cache-lru. Past it, the least recently used ones are spilled to safetensors files in the temp directory and memory-mapped back when they are hit.")
+parser.add_argument("--cache-spill-size", type=float, default=10240, metavar="MB", help="Maximum disk space in MB used by --cache-ram-budget spilling, least recently used files are deleted first.")
+parser.add_argument("--cpu-node-threads", type=int, default=0, metavar="N", help="Run nodes marked as CPU bound (image loading, resizing, saving...) on a pool of N threads alongside the rest of the prompt when they don't depend on it. 0 runs everything on the prompt worker thread.")
+
+parser.add_argument("--preemption", action="store_true", help="Pause the running prompt at its next sampler step when a prompt is sent to the front of the queue ahead of it, run that one and then resume the paused prompt where it stopped. Both stay in memory while the other runs. Only with a single worker.")
+
+parser.add_argument("--workers", type=int, default=1, metavar="N", help="Run prompts in N worker processes at the same time, each with its own executor, caches and models. Useful for CPU inference on machines with many cores. 0 runs no prompts in this process, for a --broker that only hands them out.")
+parser.add_argument("--worker-threads", type=int, default=0, metavar="N", help="Number of torch threads of each --workers process. 0 splits the CPU cores evenly between them.")
+
+parser.add_argument("--broker", action="store_true", help="Let other ComfyUI instances started with --broker-url run the prompts queued on this server. The workers read the inputs and save the outputs in their own --input-directory and --output-directory, which have to be on storage shared with this server for the history and /view to find them. Workers warn at startup when they aren't.")
+parser.add_argument("--broker-url", type=str, default=None, metavar="URL", help="Run the prompts queued on the --broker server at this URL instead of the ones queued on this one. The --input-directory and --output-directory have to be the ones of the broker, on shared storage.")
+parser.add_argument("--broker-token", type=str, default=None, metavar="TOKEN", help="Shared secret the --broker server requires from its workers.")
+parser.add_argument("--broker-lease-time", type=float, default=30.0, metavar="SECONDS", help="How long a --broker waits for the heartbeat of a worker before giving its prompts to another worker.")
+
+class OutputReleasePolicy(enum.Enum):
+    Never = "never"
+    Intermediate = "intermediate"
+    Large = "large"
+
+parser.add_argument("--release-outputs", type=OutputReleasePolicy, default=OutputReleasePolicy.Never, help="Free node outputs during a prompt once no remaining node in it needs them, instead of keeping them all until the next prompt. intermediate: free every consumed output. large: only free IMAGE, LATENT and MASK outputs and keep loader and conditioning outputs that are likely to be reused by the next prompt. Outputs held by --cache-lru stay in that cache.", action=EnumAction)
+
 parser.add_argument("--disable-smart-memory", action="store_true", help="Force ComfyUI to agressively offload to regular ram instead of keeping models in vram when it can.")
 parser.add_argument("--deterministic", action="store_true", help="Make pytorch use slower deterministic algorithms when it can. Note that this might not make images deterministic in all cases.")
 
@@ -5,6 +5,7 @@ from comfy.cli_args import args
 import torch
 import sys
 import platform
+import time
 
 class VRAMState(Enum):
     DISABLED = 0    #No vram present: no need to move models to vram
@@ -379,7 +380,20 @@ def free_memory(memory_required, device, keep_loaded=[]):
             if mem_free_torch > mem_free_total * 0.25:
                 soft_empty_cache()
 
+MODEL_LOAD_HOOK = None
+def set_model_load_hook(function):
+    global MODEL_LOAD_HOOK
+    MODEL_LOAD_HOOK = function
+
 def load_models_gpu(models, memory_required=0, force_patch_weights=False):
+    start = time.perf_counter()
+    try:
+        load_models_gpu_impl(models, memory_required=memory_required, force_patch_weights=force_patch_weights)
+    finally:
+        if MODEL_LOAD_HOOK is not None:
+            MODEL_LOAD_HOOK(start, time.perf_counter() - start)
+
+def load_models_gpu_impl(models, memory_required=0, force_patch_weights=False):
     global vram_state
 
     inference_memory = minimum_inference_memory()
@@ -358,6 +358,28 @@ def resize_to_batch_size(tensor, batch_size):
 
     return output
 
+def batched_call(function, args, tensors):
+    """
+    Returns [function(args[i], tensors[i]) for i in range(len(tensors))] but
+    calls function only once for all the tensors that have the same arg (the
+    same object) and the same shape apart from the batch dimension, with
+    those tensors concatenated. function must return one item per input item.
+    """
+    groups = {}
+    for i, (arg, tensor) in enumerate(zip(args, tensors)):
+        groups.setdefault((id(arg), tuple(tensor.shape[1:]), tensor.dtype, tensor.device), []).append(i)
+
+    out = [None] * len(tensors)
+    for indices in groups.values():
+        sizes = [tensors[i].shape[0] for i in indices]
+        if len(indices) == 1:
+            result = function(args[indices[0]], tensors[indices[0]])
+        else:
+            result = function(args[indices[0]], torch.cat([tensors[i] for i in indices]))
+        for i, x in zip(indices, torch.split(result, sizes)):
+            out[i] = x
+    return out
+
 def convert_sd_to(state_dict, dtype):
     keys = list(state_dict.keys())
     for k in keys:
@@ -0,0 +1,180 @@
+import math
+import time
+
+from comfy_execution import profiler
+from comfy_execution import scheduling
+
+class QueueFull(Exception):
+    def __init__(self, error_type, message, retry_after):
+        super().__init__(message)
+        self.error_type = error_type
+        self.message = message
+        self.retry_after = retry_after
+
+    def error(self):
+        """
+        The "error" of the 429 response POST /prompt answers with.
+        """
+        return {"type": self.error_type, "message": self.message, "details": "", "extra_info": {"retry_after": self.retry_after}}
+
+    def headers(self):
+        return {"Retry-After": str(self.retry_after)}
+
+class AdmissionControl:
+    """
+    Decides whether POST /prompt takes a new prompt: there can be at most
+    max_queue prompts pending, max_per_owner of them from the same user or
+    client id (scheduling.item_owner) and max_pending_time seconds of
+    estimated work waiting for the workers. 0 is no limit.
+
+    Prompts are estimated with estimate(item), in seconds or None, when they
+    are queued. The queue is followed through PromptQueue.get_changes() so a
+    check only costs the changes since the previous one, under the queue
+    mutex. parallelism() is the number of prompts that run at the same time.
+    """
+    def __init__(self, prompt_queue, max_queue=0, max_per_owner=0, max_pending_time=0.0, parallelism=lambda: 1, estimate=None):
+        self.prompt_queue = prompt_queue
+        self.max_queue = max_queue
+        self.max_per_owner = max_per_owner
+        self.max_pending_time = max_pending_time
+        self.parallelism = parallelism
+        if estimate is None:
+            estimate = lambda item: profiler.history.estimate_prompt(item[2])
+        self.estimate_function = estimate
+        self.version = None
+        # prompt_id -> (owner, estimate)
+        self.pending = {}
+        # prompt_id -> (owner, estimate, start time)
+        self.running = {}
+        self.owners = {}
+        self.pending_time = 0.0
+
+    def estimate(self, item):
+        estimate = self.estimate_function(item)
+        return 0.0 if estimate is None else estimate
+
+    def add_pending(self, item):
+        self.remove_pending(item[1])
+        self.running.pop(item[1], None)
+        owner = scheduling.item_owner(item)
+        estimate = self.estimate(item)
+        self.pending[item[1]] = (owner, estimate)
+        self.owners[owner] = self.owners.get(owner, 0) + 1
+        self.pending_time += estimate
+
+    def remove_pending(self, prompt_id):
+        entry = self.pending.pop(prompt_id, None)
+        if entry is None:
+            return None
+        owner, estimate = entry
+        self.owners[owner] -= 1
+        if self.owners[owner] <= 0:
+            del self.owners[owner]
+        self.pending_time -= estimate
+        return entry
+
+    def rebuild(self):
+        with self.prompt_queue.mutex:
+            running, queued = self.prompt_queue.get_current_queue()
+            self.version = self.prompt_queue.version
+        self.pending = {}
+        self.running = {}
+        self.owners = {}
+        self.pending_time = 0.0
+        now = time.monotonic()
+        for item in queued:
+            self.add_pending(item)
+        for item in running:
+            self.running[item[1]] = (scheduling.item_owner(item), self.estimate(item), now)
+
+    def sync(self):
+        if self.version is None:
+            self.rebuild()
+            return
+        version, changes = self.prompt_queue.get_changes(self.version)
+        if changes is None:
+            self.rebuild()
+            return
+        now = time.monotonic()
+        for change in changes:
+            op = change["op"]
+            prompt_id = change["prompt_id"]
+            if op == "add":
+                if change.get("item", None) is not None:
+                    self.add_pending(change["item"])
+            elif op == "running":
+                entry = self.remove_pending(prompt_id)
+                if entry is not None:
+                    self.running[prompt_id] = entry + (now,)
+            elif op == "remove":
+                self.remove_pending(prompt_id)
+            elif op == "done":
+                self.running.pop(prompt_id, None)
+            elif op == "clear":
+                for prompt_id in list(self.pending):
+                    self.remove_pending(prompt_id)
+        self.version = version
+        if len(self.pending) == 0:
+            # don't let float error pile up
+            self.pending_time = 0.0
+
+    def remaining_time(self):
+        now = time.monotonic()
+        return sum(max(estimate - (now - start), 0.0) for owner, estimate, start in self.running.values())
+
+    def retry_after(self, seconds):
+        return max(1, math.ceil(seconds))
+
+    def admit(self, item):
+        """
+        Raises QueueFull if the item can't be queued, otherwise returns the
+        estimated seconds it takes and the estimated seconds until it is
+        done, None when nothing ran yet to estimate from.
+        """
+        with self.prompt_queue.mutex:
+            self.sync()
+            parallelism = max(self.parallelism(), 1)
+            estimate = self.estimate_function(item)
+            average = self.pending_time / len(self.pending) if len(self.pending) > 0 else (estimate or 0.0)
+
+            if self.max_queue > 0 and len(self.pending) >= self.max_queue:
+                excess = len(self.pending) - self.max_queue + 1
+                raise QueueFull("queue_full", "There are already {} prompts queued".format(len(self.pending)),
+                                self.retry_after(excess * average / parallelism))
+
+            owner = scheduling.item_owner(item)
+            owner_pending = self.owners.get(owner, 0)
+            if self.max_per_owner > 0 and owner_pending >= self.max_per_owner:
+                excess = owner_pending - self.max_per_owner + 1
+                raise QueueFull("owner_queue_full", "You already have {} prompts queued".format(owner_pending),
+                                self.retry_after(excess * average * max(len(self.owners), 1) / parallelism))
+
+            pending_time = self.pending_time + self.remaining_time()
+            if self.max_pending_time > 0 and estimate is not None and pending_time + estimate > self.max_pending_time:
+                raise QueueFull("queue_busy", "The queued prompts will take about {:.0f} seconds to run".format(pending_time),
+                                self.retry_after((pending_time + estimate - self.max_pending_time) / parallelism))
+
+            if estimate is None:
+                return None, None
+            return estimate, pending_time / parallelism + estimate
+
+    def estimates(self, prompt_ids):
+        """
+        The estimated run time of the queued or running prompts with these ids.
+        """
+        with self.prompt_queue.mutex:
+            self.sync()
+            out = {}
+            for prompt_id in prompt_ids:
+                entry = self.pending.get(prompt_id, None) or self.running.get(prompt_id, None)
+                if entry is not None:
+                    out[prompt_id] = entry[1]
+            return out
+
+    def estimated_time(self):
+        """
+        Estimated seconds until all the queued and running prompts are done.
+        """
+        with self.prompt_queue.mutex:
+            self.sync()
+            return (self.pending_time + self.remaining_time()) / max(self.parallelism(), 1)
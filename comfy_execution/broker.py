@@ -0,0 +1,434 @@
+import os
+import json
+import time
+import uuid
+import base64
+import logging
+import threading
+import urllib.request
+import urllib.error
+
+import execution
+import folder_paths
+import comfy.model_management
+from comfy_execution import profiler
+
+PREVIEW_IMAGE = 1
+# in a folder so the image loaders listing the input files skip it
+STORAGE_CHECK_FILE = os.path.join(".broker", "storage_check")
+
+class UnknownWorker(Exception):
+    pass
+
+class LeaseLost(Exception):
+    pass
+
+def shared_directories():
+    return [folder_paths.get_input_directory(), folder_paths.get_output_directory()]
+
+def write_storage_check(token):
+    for directory in shared_directories():
+        path = os.path.join(directory, STORAGE_CHECK_FILE)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(token)
+
+def missing_storage(token):
+    """
+    The input and output directories of this instance that don't have the
+    storage check file with token the broker wrote in its own, so aren't
+    the same directories.
+    """
+    missing = []
+    for directory in shared_directories():
+        try:
+            with open(os.path.join(directory, STORAGE_CHECK_FILE)) as f:
+                if f.read() == token:
+                    continue
+        except OSError:
+            pass
+        missing.append(directory)
+    return missing
+
+class LocalBroker:
+    """
+    Hands the prompts of a PromptQueue to registered workers, which can be
+    other ComfyUI instances talking to it over the /broker routes.
+
+    A leased prompt belongs to the worker until it completes it or the lease
+    runs out, every heartbeat of the worker extends the leases it still holds
+    by lease_time.
+    Expired prompts go back to the queue and are failed once they were
+    leased max_attempts times. Progress reported by a worker is sent to the
+    websocket clients of this server.
+
+    Workers read the input files and save the outputs in their own
+    directories, which have to be the ones of this server for the history
+    and /view to find them. start() writes a file with storage_token in
+    them that workers check for when they register.
+    """
+    def __init__(self, prompt_queue, server, lease_time=30.0, max_attempts=3):
+        self.prompt_queue = prompt_queue
+        self.server = server
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+        self.workers = {}
+        self.leases = {}
+        self.attempts = {}
+        self.storage_token = uuid.uuid4().hex
+        prompt_queue.flag_listeners.append(self.set_flag)
+
+    def start(self):
+        try:
+            write_storage_check(self.storage_token)
+        except OSError as e:
+            logging.warning("Failed to write the broker storage check file: {}".format(e))
+        threading.Thread(target=self.expire_loop, daemon=True).start()
+
+    def register(self, name, info={}):
+        worker_id = uuid.uuid4().hex
+        with self.lock:
+            self.workers[worker_id] = {"name": name, "info": info, "last_seen": time.monotonic(), "flags": {}, "interrupt": set()}
+        logging.info("Worker {} ({}) registered".format(name, worker_id))
+        return worker_id
+
+    def get_worker(self, worker_id):
+        worker = self.workers.get(worker_id, None)
+        if worker is None:
+            raise UnknownWorker(worker_id)
+        worker["last_seen"] = time.monotonic()
+        return worker
+
+    def get_lease(self, worker_id, task_id):
+        lease = self.leases.get(task_id, None)
+        if lease is None or lease["worker_id"] != worker_id:
+            raise LeaseLost(task_id)
+        return lease
+
+    def heartbeat(self, worker_id, task_ids=()):
+        with self.lock:
+            worker = self.get_worker(worker_id)
+            expires = time.monotonic() + self.lease_time
+            for task_id in task_ids:
+                lease = self.leases.get(task_id, None)
+                if lease is not None and lease["worker_id"] == worker_id:
+                    lease["expires"] = expires
+            flags = worker["flags"]
+            worker["flags"] = {}
+            interrupt = list(worker["interrupt"])
+            worker["interrupt"].clear()
+        return {"flags": flags, "interrupt": interrupt}
+
+    def set_flag(self, name, data):
+        with self.lock:
+            for worker in self.workers.values():
+                worker["flags"][name] = data
+
+    def lease(self, worker_id, timeout=10.0):
+        with self.lock:
+            self.get_worker(worker_id)
+        queue_item = self.prompt_queue.get(timeout=timeout)
+        if queue_item is None:
+            return None
+        item, item_id = queue_item
+        task_id = uuid.uuid4().hex
+        with self.lock:
+            self.leases[task_id] = {"worker_id": worker_id, "item_id": item_id, "item": item, "expires": time.monotonic() + self.lease_time, "last_executing": time.monotonic()}
+            self.attempts[item[1]] = self.attempts.get(item[1], 0) + 1
+        return {"task_id": task_id, "item": item}
+
+    def report(self, worker_id, task_id, messages):
+        with self.lock:
+            self.get_worker(worker_id)
+            lease = self.get_lease(worker_id, task_id)
+        for event, data, sid in messages:
+            if event == PREVIEW_IMAGE:
+                data = base64.b64decode(data)
+            elif event == "executing" and isinstance(data, dict):
+                with self.lock:
+                    lease["last_executing"] = time.monotonic()
+                self.server.send_executing(data, sid)
+                continue
+            self.server.send_sync(event, data, sid)
+
+    def complete(self, worker_id, task_id, outputs, status=None, profile=None):
+        with self.lock:
+            self.get_worker(worker_id)
+            lease = self.get_lease(worker_id, task_id)
+            del self.leases[task_id]
+            self.attempts.pop(lease["item"][1], None)
+        if status is not None:
+            status = execution.PromptQueue.ExecutionStatus(**status)
+        if profile is not None:
+            profiler.history.add(profile)
+        self.prompt_queue.task_done(lease["item_id"], outputs, status=status, profile=profile)
+        client_id = lease["item"][3].get("client_id", None)
+        if client_id is not None:
+            self.server.send_sync("executing", { "node": None, "prompt_id": lease["item"][1] }, client_id)
+
+    def interrupt(self, prompt_id=None):
+        """
+        Asks the worker that leased prompt_id to interrupt it, by default the
+        prompt the clients last got an "executing" message about. Returns
+        False if no worker has it.
+        """
+        with self.lock:
+            leases = list(self.leases.items())
+            if prompt_id is None:
+                leases = sorted(leases, key=lambda x: x[1]["last_executing"])[-1:]
+            else:
+                leases = [x for x in leases if x[1]["item"][1] == prompt_id]
+            interrupted = False
+            for task_id, lease in leases:
+                worker = self.workers.get(lease["worker_id"], None)
+                if worker is not None:
+                    worker["interrupt"].add(task_id)
+                    interrupted = True
+            return interrupted
+
+    def expire(self):
+        now = time.monotonic()
+        with self.lock:
+            expired = []
+            for task_id, lease in list(self.leases.items()):
+                if lease["expires"] < now:
+                    del self.leases[task_id]
+                    prompt_id = lease["item"][1]
+                    retry = self.attempts.get(prompt_id, 0) < self.max_attempts
+                    if not retry:
+                        self.attempts.pop(prompt_id, None)
+                    expired.append((lease, retry))
+            for worker_id, worker in list(self.workers.items()):
+                if worker["last_seen"] + self.lease_time * 2 < now:
+                    logging.warning("Worker {} ({}) stopped sending heartbeats".format(worker["name"], worker_id))
+                    del self.workers[worker_id]
+
+        for lease, retry in expired:
+            prompt_id = lease["item"][1]
+            if retry:
+                logging.warning("Lease on prompt {} expired, queueing it again".format(prompt_id))
+                self.prompt_queue.requeue(lease["item_id"])
+            else:
+                logging.error("Lease on prompt {} expired {} times, giving up".format(prompt_id, self.max_attempts))
+                status = execution.PromptQueue.ExecutionStatus(status_str='error', completed=False, messages=[("execution_error", {"prompt_id": prompt_id, "exception_message": "the workers running it stopped responding"})])
+                self.prompt_queue.task_done(lease["item_id"], {}, status=status)
+
+    def expire_loop(self):
+        while True:
+            time.sleep(max(self.lease_time / 4, 0.1))
+            try:
+                self.expire()
+            except Exception:
+                logging.exception("broker lease check failed")
+
+    def describe(self):
+        now = time.monotonic()
+        with self.lock:
+            workers = {}
+            for worker_id, worker in self.workers.items():
+                workers[worker_id] = {"name": worker["name"], "info": worker["info"], "last_seen": now - worker["last_seen"], "tasks": []}
+            for task_id, lease in self.leases.items():
+                if lease["worker_id"] in workers:
+                    workers[lease["worker_id"]]["tasks"].append({"task_id": task_id, "prompt_id": lease["item"][1], "expires_in": lease["expires"] - now})
+            return {"lease_time": self.lease_time, "workers": workers}
+
+class HTTPBroker:
+    """
+    Talks to the LocalBroker of another ComfyUI server through its /broker
+    routes, same methods as LocalBroker.
+    """
+    def __init__(self, url, token=None):
+        self.url = url.rstrip("/")
+        self.token = token
+        self.lease_time = 30.0
+        self.storage_token = None
+
+    def call(self, route, data, timeout=30.0):
+        request = urllib.request.Request(self.url + "/broker/" + route, data=json.dumps(data).encode("utf-8"), method="POST")
+        request.add_header("Content-Type", "application/json")
+        if self.token is not None:
+            request.add_header("Authorization", "Bearer {}".format(self.token))
+        try:
+            with urllib.request.urlopen(request, timeout=timeout) as response:
+                return json.loads(response.read())
+        except urllib.error.HTTPError as e:
+            if e.code == 404:
+                raise UnknownWorker(data.get("worker_id", None))
+            if e.code == 409:
+                raise LeaseLost(data.get("task_id", None))
+            raise
+
+    def register(self, name, info={}):
+        out = self.call("register", {"name": name, "info": info})
+        self.lease_time = out["lease_time"]
+        self.storage_token = out.get("storage_token", None)
+        return out["worker_id"]
+
+    def heartbeat(self, worker_id, task_ids=()):
+        return self.call("heartbeat", {"worker_id": worker_id, "task_ids": list(task_ids)})
+
+    def lease(self, worker_id, timeout=10.0):
+        task = self.call("lease", {"worker_id": worker_id, "timeout": timeout}, timeout=timeout + 30.0)["task"]
+        if task is not None:
+            task["item"] = tuple(task["item"])
+        return task
+
+    def report(self, worker_id, task_id, messages):
+        self.call("report", {"worker_id": worker_id, "task_id": task_id, "messages": messages})
+
+    def complete(self, worker_id, task_id, outputs, status=None, profile=None):
+        self.call("complete", {"worker_id": worker_id, "task_id": task_id, "outputs": outputs, "status": status, "profile": profile})
+
+class BrokerQueue:
+    """
+    What prompt_worker() sees of the queue when this instance is a worker of
+    a broker: leases prompts from it, keeps the leases alive with heartbeats
+    and completes them with the results. Warns when registering if the
+    input and output directories aren't shared with the broker.
+    """
+    def __init__(self, broker, name, info={}):
+        self.broker = broker
+        self.name = name
+        self.info = info
+        self.worker_id = None
+        self.lock = threading.Lock()
+        self.flags = {}
+        self.current = None
+        self.messages = []
+        threading.Thread(target=self.heartbeat_loop, daemon=True).start()
+
+    def ensure_registered(self):
+        while self.worker_id is None:
+            try:
+                self.worker_id = self.broker.register(self.name, self.info)
+            except Exception as e:
+                logging.warning("Failed to register with the broker: {}".format(e))
+                time.sleep(5.0)
+                continue
+            self.check_storage()
+        return self.worker_id
+
+    def check_storage(self):
+        token = self.broker.storage_token
+        if token is None:
+            return
+        missing = missing_storage(token)
+        if len(missing) > 0:
+            logging.warning("\nWARNING: {} aren't the directories of the broker, the inputs the prompts use won't be found and their outputs won't be in the history of the broker. Put the --input-directory and --output-directory of the workers on storage shared with the broker.\n".format(", ".join(missing)))
+
+    def heartbeat_loop(self):
+        while True:
+            time.sleep(max(self.broker.lease_time / 3, 0.1))
+            if self.worker_id is None:
+                continue
+            with self.lock:
+                task_ids = [] if self.current is None else [self.current]
+            try:
+                out = self.broker.heartbeat(self.worker_id, task_ids)
+            except UnknownWorker:
+                self.worker_id = None
+                continue
+            except Exception as e:
+                logging.warning("Broker heartbeat failed: {}".format(e))
+                continue
+            with self.lock:
+                self.flags.update(out["flags"])
+                if self.current is not None and self.current in out["interrupt"]:
+                    comfy.model_management.interrupt_current_processing()
+            self.flush()
+
+    def get(self, timeout=None):
+        worker_id = self.ensure_registered()
+        try:
+            task = self.broker.lease(worker_id, timeout=min(timeout or 10.0, 10.0))
+        except UnknownWorker:
+            self.worker_id = None
+            return None
+        except Exception as e:
+            logging.warning("Failed to lease a prompt from the broker: {}".format(e))
+            time.sleep(1.0)
+            return None
+        if task is None:
+            return None
+        with self.lock:
+            self.current = task["task_id"]
+        return (task["item"], task["task_id"])
+
+    def send(self, event, data, sid):
+        with self.lock:
+            if self.current is not None:
+                self.messages.append([event, data, sid])
+
+    def flush(self):
+        with self.lock:
+            task_id = self.current
+            messages = self.messages
+            self.messages = []
+        if task_id is None or len(messages) == 0:
+            return
+        try:
+            self.broker.report(self.worker_id, task_id, messages)
+        except Exception as e:
+            logging.warning("Failed to send progress to the broker: {}".format(e))
+
+    def task_done(self, item_id, outputs, status, profile=None):
+        self.flush()
+        with self.lock:
+            self.current = None
+            self.messages = []
+        try:
+            self.broker.complete(self.worker_id, item_id, outputs, None if status is None else status._asdict(), profile)
+        except LeaseLost:
+            logging.warning("Lease on task {} was lost, the broker already gave the prompt to another worker".format(item_id))
+
+    def get_flags(self, reset=True):
+        with self.lock:
+            flags = self.flags
+            if reset:
+                self.flags = {}
+            return flags
+
+class BrokerServer:
+    """
+    Stands in for the PromptServer when this instance is a worker of a
+    broker, messages are batched and reported to the broker every interval
+    seconds. Only the latest preview image of a batch is kept.
+    encode_preview turns an unencoded preview into the bytes of a
+    PREVIEW_IMAGE message.
+    """
+    def __init__(self, broker_queue, encode_preview, interval=0.25):
+        self.broker_queue = broker_queue
+        self.encode_preview = encode_preview
+        self.interval = interval
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+        self.prompt_executor = None
+        self.preview = None
+        self.lock = threading.Lock()
+        threading.Thread(target=self.flush_loop, daemon=True).start()
+
+    def send_sync(self, event, data, sid=None):
+        if isinstance(event, int):
+            with self.lock:
+                self.preview = (data, sid)
+            return
+        self.broker_queue.send(event, data, sid)
+
+    def queue_updated(self):
+        pass
+
+    def flush_loop(self):
+        while True:
+            time.sleep(self.interval)
+            with self.lock:
+                preview = self.preview
+                self.preview = None
+            if preview is not None:
+                try:
+                    data = base64.b64encode(self.encode_preview(preview[0])).decode("ascii")
+                    self.broker_queue.send(PREVIEW_IMAGE, data, preview[1])
+                except Exception as e:
+                    logging.warning("Failed to encode preview: {}".format(e))
+            self.broker_queue.flush()
@@ -0,0 +1,429 @@
+import os
+import json
+import mmap
+import shutil
+import struct
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import torch
+import nodes
+import folder_paths
+import comfy.utils
+
+class CacheEntry(NamedTuple):
+    outputs: list
+    ui: dict
+
+input_types_cache = {}
+
+def get_input_types(class_def):
+    """
+    class_def.INPUT_TYPES(), cached until folder_paths.get_cache_generation()
+    changes. Loaders list the model folders in there so calling it for every
+    node of every prompt is expensive. The result is shared, don't modify it.
+    """
+    generation = folder_paths.get_cache_generation()
+    entry = input_types_cache.get(class_def, None)
+    if entry is None or entry[0] != generation:
+        entry = (generation, class_def.INPUT_TYPES())
+        input_types_cache[class_def] = entry
+    return entry[1]
+
+def is_idempotent(class_def):
+    # Nodes that depend on their own id (or say so explicitly) can't share
+    # outputs with an identical node somewhere else in the graph.
+    if getattr(class_def, "NOT_IDEMPOTENT", False):
+        return False
+    hidden = get_input_types(class_def).get("hidden", {})
+    return "UNIQUE_ID" not in hidden.values()
+
+def get_links(node):
+    for value in node['inputs'].values():
+        if isinstance(value, list):
+            yield value[0]
+
+class CacheKeySet:
+    """
+    Content-addressed keys for the nodes of a prompt.
+
+    The key of a node is a sha256 over its class_type, widget values, IS_CHANGED
+    result and the keys of the nodes linked to its inputs, so identical
+    subgraphs get identical keys no matter which node ids or which client
+    they came from. A node that can't be keyed (IS_CHANGED raised or returned
+    something that isn't plain JSON, like NaN) gets None and so does
+    everything downstream of it.
+
+    With is_changed=False the IS_CHANGED result is left out, which is what
+    validation needs since it runs before IS_CHANGED is called.
+    """
+    def __init__(self, prompt, is_changed=True):
+        self.prompt = prompt
+        self.is_changed = is_changed
+        self.keys = {}
+
+    def get(self, node_id) -> Optional[str]:
+        if node_id not in self.keys:
+            self.compute(node_id)
+        return self.keys[node_id]
+
+    def compute(self, node_id):
+        visiting = set()
+        stack = [(node_id, False)]
+        while len(stack) > 0:
+            unique_id, expanded = stack.pop()
+            if unique_id in self.keys:
+                continue
+            if unique_id not in self.prompt:
+                self.keys[unique_id] = None
+                continue
+            if expanded:
+                self.keys[unique_id] = self.node_key(unique_id)
+                continue
+            if unique_id in visiting:
+                # cycle, can never be satisfied
+                self.keys[unique_id] = None
+                continue
+            visiting.add(unique_id)
+            stack.append((unique_id, True))
+            for input_unique_id in get_links(self.prompt[unique_id]):
+                if input_unique_id not in self.keys:
+                    stack.append((input_unique_id, False))
+
+    def node_key(self, unique_id):
+        node = self.prompt[unique_id]
+        class_type = node['class_type']
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(class_type, None)
+        if class_def is None:
+            return None
+
+        inputs = []
+        for name in sorted(node['inputs']):
+            value = node['inputs'][name]
+            if isinstance(value, list):
+                input_key = self.keys.get(value[0], None)
+                if input_key is None:
+                    return None
+                value = ["link", input_key, value[1]]
+            inputs.append([name, value])
+
+        signature = {"class_type": class_type, "inputs": inputs}
+        if self.is_changed and hasattr(class_def, 'IS_CHANGED'):
+            if 'is_changed' not in node:
+                return None
+            signature["is_changed"] = node['is_changed']
+        if not is_idempotent(class_def):
+            signature["node_id"] = unique_id
+
+        try:
+            data = json.dumps(signature, sort_keys=True, allow_nan=False)
+        except (TypeError, ValueError):
+            return None
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+
+class ValidationCache:
+    """
+    Nodes that passed validate_inputs, keyed by their CacheKeySet key (without
+    IS_CHANGED) so a node is only validated once for all the prompts that
+    contain the same subgraph. The widget values validation converted to
+    INT/FLOAT/STRING are kept so they can be applied to the next prompt.
+    Everything is dropped when folder_paths.get_cache_generation() changes,
+    since lists of files are part of what is checked. Nodes that define
+    VALIDATE_INPUTS are never cached.
+    """
+    def __init__(self, max_size=4096):
+        self.max_size = max_size
+        self.generation = None
+        self.entries = OrderedDict()
+
+    def get(self, key) -> Optional[dict]:
+        if key is None or folder_paths.get_cache_generation() != self.generation or key not in self.entries:
+            return None
+        self.entries.move_to_end(key)
+        return self.entries[key]
+
+    def set(self, key, converted):
+        if key is None:
+            return
+        generation = folder_paths.get_cache_generation()
+        if generation != self.generation:
+            self.entries.clear()
+            self.generation = generation
+        self.entries[key] = converted
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+def spillable_size(outputs):
+    """
+    Bytes of tensor data in node outputs made only of tensors and LATENT
+    style dicts (IMAGE, LATENT, MASK...), or None if they hold anything else
+    and can't be written to disk.
+    """
+    size = 0
+    for slot in outputs:
+        for value in slot:
+            if isinstance(value, torch.Tensor):
+                size += value.nelement() * value.element_size()
+            elif isinstance(value, dict):
+                for v in value.values():
+                    if isinstance(v, torch.Tensor):
+                        size += v.nelement() * v.element_size()
+                    elif not isinstance(v, (int, float, bool, str, list, type(None))):
+                        return None
+            else:
+                return None
+    return size
+
+SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+
+def load_mapped(path):
+    """
+    The metadata and tensors of a safetensors file. The tensors are views of
+    a copy-on-write memory map of the file: their pages are only read when
+    they are used, the OS can drop them again and writing to them doesn't
+    change the file.
+    """
+    with open(path, "rb") as f:
+        length = struct.unpack("<Q", f.read(8))[0]
+        header = json.loads(f.read(length))
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+    start = 8 + length
+    metadata = header.pop("__metadata__", {})
+    tensors = {}
+    for name, info in header.items():
+        dtype = SAFETENSORS_DTYPES[info["dtype"]]
+        begin, end = info["data_offsets"]
+        if begin == end:
+            tensors[name] = torch.empty(info["shape"], dtype=dtype)
+            continue
+        count = (end - begin) // torch.empty((), dtype=dtype).element_size()
+        tensors[name] = torch.frombuffer(mapped, dtype=dtype, count=count, offset=start + begin).reshape(info["shape"])
+    return metadata, tensors
+
+class DiskSpillCache:
+    """
+    Node outputs written to safetensors files in a scratch directory, capped
+    at max_bytes on disk. The least recently used files are deleted first.
+    Loading a file memory-maps it (see load_mapped) instead of reading it, so
+    a large entry that comes back into use only takes the memory of the
+    parts that are read. The file is kept after loading, so spilling the
+    entry again doesn't write anything.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.files = OrderedDict()
+        self.size = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, "{}.safetensors".format(key))
+
+    def __contains__(self, key):
+        return key in self.files
+
+    def save(self, key, outputs):
+        if key in self.files:
+            self.files.move_to_end(key)
+            return True
+
+        tensors = {}
+        layout = []
+        for i, slot in enumerate(outputs):
+            slot_layout = []
+            for j, value in enumerate(slot):
+                name = "{}.{}".format(i, j)
+                if isinstance(value, torch.Tensor):
+                    tensors[name] = value.contiguous()
+                    slot_layout.append({"tensor": name})
+                else:
+                    item = {}
+                    for k, v in value.items():
+                        if isinstance(v, torch.Tensor):
+                            tensors["{}.{}".format(name, k)] = v.contiguous()
+                            item[k] = {"tensor": "{}.{}".format(name, k)}
+                        else:
+                            item[k] = {"value": v}
+                    slot_layout.append({"dict": item})
+            layout.append(slot_layout)
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.path(key)
+        try:
+            comfy.utils.save_torch_file(tensors, path, metadata={"layout": json.dumps(layout)})
+        except Exception as e:
+            logging.warning("Failed to spill cached outputs to {}: {}".format(path, e))
+            if os.path.exists(path):
+                os.remove(path)
+            return False
+
+        size = os.path.getsize(path)
+        self.files[key] = size
+        self.size += size
+        while self.size > self.max_bytes and len(self.files) > 0:
+            self.remove(next(iter(self.files)))
+        return key in self.files
+
+    def load(self, key):
+        if key not in self.files:
+            return None
+        self.files.move_to_end(key)
+        path = self.path(key)
+        try:
+            metadata, tensors = load_mapped(path)
+            layout = json.loads(metadata["layout"])
+        except Exception as e:
+            logging.warning("Failed to load spilled outputs from {}: {}".format(path, e))
+            self.remove(key)
+            return None
+
+        outputs = []
+        for slot_layout in layout:
+            slot = []
+            for item in slot_layout:
+                if "tensor" in item:
+                    slot.append(tensors[item["tensor"]])
+                else:
+                    value = {}
+                    for k, v in item["dict"].items():
+                        value[k] = tensors[v["tensor"]] if "tensor" in v else v["value"]
+                    slot.append(value)
+            outputs.append(slot)
+        return outputs
+
+    def remove(self, key):
+        size = self.files.pop(key, None)
+        if size is None:
+            return
+        self.size -= size
+        try:
+            os.remove(self.path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        self.files.clear()
+        self.size = 0
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+class LRUCache:
+    """
+    Node outputs shared across prompts, keyed by CacheKeySet keys. Holds at
+    most max_size entries and evicts the least recently used one first.
+
+    With a ram_budget (bytes) and a DiskSpillCache, entries made of tensors
+    (see spillable_size) are written to disk, least recently used first,
+    while the ones held in memory add up to more than the budget. A spilled
+    entry is memory-mapped back when it is hit.
+
+    Nodes on the cpu thread pool complete concurrently, so every method takes
+    the cache lock.
+    """
+    def __init__(self, max_size, ram_budget=None, spill=None):
+        self.lock = threading.RLock()
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.ram_budget = ram_budget
+        self.spill = spill
+        self.ram_sizes = {}
+        self.ram_bytes = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.entries)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.entries
+
+    def peek(self, key) -> Optional[CacheEntry]:
+        # the entry without loading it back or marking it used, outputs is None if it was spilled
+        with self.lock:
+            return self.entries.get(key, None)
+
+    def get(self, key) -> Optional[CacheEntry]:
+        with self.lock:
+            if key is None or key not in self.entries:
+                return None
+            self.entries.move_to_end(key)
+            entry = self.entries[key]
+            if entry.outputs is None:
+                outputs = self.spill.load(key)
+                if outputs is None:
+                    self.remove(key)
+                    return None
+                entry = entry._replace(outputs=outputs)
+                self.entries[key] = entry
+                self.track(key, outputs)
+                self.enforce_budget()
+            return entry
+
+    def set(self, key, entry: CacheEntry):
+        if key is None or self.max_size <= 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self.untrack(key)
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            self.track(key, entry.outputs)
+            while len(self.entries) > self.max_size:
+                self.remove(next(iter(self.entries)))
+            self.enforce_budget()
+
+    def remove(self, key):
+        with self.lock:
+            self.untrack(key)
+            self.entries.pop(key, None)
+            if self.spill is not None:
+                self.spill.remove(key)
+
+    def track(self, key, outputs):
+        if self.spill is None:
+            return
+        size = spillable_size(outputs)
+        if size is not None and size > 0:
+            self.ram_sizes[key] = size
+            self.ram_bytes += size
+
+    def untrack(self, key):
+        self.ram_bytes -= self.ram_sizes.pop(key, 0)
+
+    def is_spillable(self, key):
+        with self.lock:
+            return key in self.ram_sizes or (key in self.entries and self.entries[key].outputs is None)
+
+    def enforce_budget(self):
+        if self.spill is None or self.ram_budget is None:
+            return
+        for key in list(self.entries):
+            if self.ram_bytes <= self.ram_budget:
+                break
+            if key not in self.ram_sizes:
+                continue
+            entry = self.entries[key]
+            if self.spill.save(key, entry.outputs):
+                self.untrack(key)
+                self.entries[key] = entry._replace(outputs=None)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.ram_sizes.clear()
+            self.ram_bytes = 0
+            if self.spill is not None:
+                self.spill.clear()
@@ -0,0 +1,198 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from comfy_execution import graph
+from comfy_execution import profiler
+
+MIN_SAMPLES = 3
+
+def prompt_features(prompt):
+    """
+    What the run time of each node of a prompt is estimated from:
+    {node_id: [keys, x]} where keys are the regressions the node belongs to,
+    most specific first, and x the features: 1, sampling steps, megapixels
+    (width * height * batch * frames of the largest latent or image the
+    prompt creates) and their product. The regressions are split by the model
+    files the prompt loads and the sampler.
+    """
+    megapixels = 0.0
+    models = set()
+    for node in prompt.values():
+        inputs = node.get("inputs", {})
+        width = inputs.get("width", None)
+        height = inputs.get("height", None)
+        if isinstance(width, (int, float)) and isinstance(height, (int, float)):
+            size = width * height
+            for k in ("batch_size", "length"):
+                if isinstance(inputs.get(k, None), (int, float)):
+                    size *= inputs[k]
+            megapixels = max(megapixels, size / 1e6)
+        try:
+            models.update(str(value) for name, value in graph.get_model_inputs(node))
+        except Exception:
+            pass
+
+    models = ",".join(sorted(models))
+    out = {}
+    for node_id, node in prompt.items():
+        inputs = node.get("inputs", {})
+        class_type = node.get("class_type", None)
+        steps = inputs.get("steps", 1)
+        if not isinstance(steps, (int, float)):
+            steps = 1
+        sampler = inputs.get("sampler_name", "")
+        if not isinstance(sampler, str):
+            sampler = ""
+        keys = [class_type]
+        if len(models) > 0 or len(sampler) > 0:
+            keys.insert(0, "{}|{}|{}".format(class_type, models, sampler))
+        out[node_id] = [keys, [1.0, float(steps), megapixels, steps * megapixels]]
+    return out
+
+def solve(a, b):
+    # gaussian elimination with partial pivoting, the systems are 4x4
+    size = len(b)
+    m = [list(a[i]) + [b[i]] for i in range(size)]
+    for col in range(size):
+        pivot = max(range(col, size), key=lambda r: abs(m[r][col]))
+        if abs(m[pivot][col]) < 1e-12:
+            return None
+        m[col], m[pivot] = m[pivot], m[col]
+        for r in range(col + 1, size):
+            f = m[r][col] / m[col][col]
+            for c in range(col, size + 1):
+                m[r][c] -= f * m[col][c]
+    x = [0.0] * size
+    for r in range(size - 1, -1, -1):
+        x[r] = (m[r][size] - sum(m[r][c] * x[c] for c in range(r + 1, size))) / m[r][r]
+    return x
+
+class Regression:
+    """
+    Online ridge regression of a run time on features, older samples fade
+    out by decay per new sample so it follows changes in the hardware or the
+    settings.
+    """
+    def __init__(self, size, ridge=1e-3, state=None):
+        if state is not None:
+            self.a = state["a"]
+            self.b = state["b"]
+            self.samples = state["samples"]
+        else:
+            self.a = [[ridge if i == j else 0.0 for j in range(size)] for i in range(size)]
+            self.b = [0.0] * size
+            self.samples = 0
+        self.weights = None
+
+    def add(self, x, y, decay):
+        size = len(self.b)
+        for i in range(size):
+            self.b[i] = decay * self.b[i] + y * x[i]
+            for j in range(size):
+                self.a[i][j] = decay * self.a[i][j] + x[i] * x[j]
+        self.samples += 1
+        self.weights = None
+
+    def predict(self, x):
+        if self.weights is None:
+            self.weights = solve(self.a, self.b) or []
+        if len(self.weights) == len(x):
+            out = sum(w * v for w, v in zip(self.weights, x))
+            if out > 0:
+                return out
+        # the average, x[0] is always 1
+        return self.b[0] / self.a[0][0]
+
+    def state(self):
+        return {"a": self.a, "b": self.b, "samples": self.samples}
+
+class RuntimeEstimator:
+    """
+    Learns the run time of every node class from the profiles of the prompts
+    that ran (see prompt_features()) and predicts the run time of prompts
+    before they run. Model loading time is left out. The regressions are
+    saved to path as JSON at most every save_interval seconds.
+    """
+    def __init__(self, path=None, decay=0.99, save_interval=60.0):
+        self.path = path
+        self.decay = decay
+        self.save_interval = save_interval
+        self.lock = threading.Lock()
+        self.regressions = {}
+        self.last_save = time.monotonic()
+        self.dirty = False
+        if path is not None and os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                for key, state in data["regressions"].items():
+                    self.regressions[key] = Regression(len(state["b"]), state=state)
+            except Exception as e:
+                logging.warning("Failed to load the runtime estimates from {}: {}".format(path, e))
+
+    def add(self, profile):
+        features = profile.get("features", None)
+        if features is None:
+            return
+        with self.lock:
+            for record in profile["nodes"]:
+                if record["cache"] != "miss" or record["status"] != "success" or record["node_id"] not in features:
+                    continue
+                keys, x = features[record["node_id"]]
+                y = max(record["duration"] - record["model_load_time"] - record.get("paused_time", 0.0), 0.0)
+                for key in keys:
+                    regression = self.regressions.get(key, None)
+                    if regression is None:
+                        regression = self.regressions[key] = Regression(len(x))
+                    regression.add(x, y, self.decay)
+                self.dirty = True
+        if self.path is not None and time.monotonic() - self.last_save > self.save_interval:
+            self.save()
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            data = {"regressions": {k: v.state() for k, v in self.regressions.items()}}
+            self.dirty = False
+            self.last_save = time.monotonic()
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            temp = self.path + ".tmp"
+            with open(temp, "w", encoding="utf-8") as f:
+                json.dump(data, f)
+            os.replace(temp, self.path)
+        except Exception as e:
+            logging.warning("Failed to save the runtime estimates to {}: {}".format(self.path, e))
+
+    def predict_node(self, keys, x):
+        for key in keys:
+            regression = self.regressions.get(key, None)
+            if regression is not None and regression.samples >= MIN_SAMPLES:
+                return regression.predict(x)
+        return None
+
+    def predict_prompt(self, prompt):
+        """
+        Estimated seconds a prompt takes to run, falling back to the averages
+        of profiler.history for the nodes that don't have enough samples yet.
+        None when nothing ran yet to estimate from.
+        """
+        total = 0.0
+        known = False
+        with self.lock:
+            for node_id, (keys, x) in prompt_features(prompt).items():
+                seconds = self.predict_node(keys, x)
+                if seconds is None:
+                    stats = profiler.history.get(keys[-1])
+                    if stats is None:
+                        continue
+                    seconds = stats["duration"] - stats["model_load_time"]
+                total += max(seconds, 0.0)
+                known = True
+        if not known:
+            return profiler.history.estimate_prompt(prompt)
+        return total
@@ -0,0 +1,246 @@
+import heapq
+
+import nodes
+from comfy_execution import caching
+
+def get_input_links(node, skip_lazy=False):
+    lazy = set()
+    if skip_lazy:
+        lazy = get_lazy_inputs(nodes.NODE_CLASS_MAPPINGS[node['class_type']])
+    links = []
+    for name, value in node['inputs'].items():
+        if isinstance(value, list) and name not in lazy:
+            links.append(value[0])
+    return links
+
+def get_lazy_inputs(class_def):
+    valid_inputs = caching.get_input_types(class_def)
+    lazy = set()
+    for category in ("required", "optional"):
+        for name, info in valid_inputs.get(category, {}).items():
+            if len(info) > 1 and isinstance(info[1], dict) and info[1].get("lazy", False):
+                lazy.add(name)
+    return lazy
+
+# outputs that hold a ModelPatcher, the nodes returning them are loaders
+MODEL_OUTPUT_TYPES = ("MODEL", "CLIP", "VAE", "CLIP_VISION", "CONTROL_NET", "STYLE_MODEL", "GLIGEN", "UPSCALE_MODEL")
+
+def get_model_inputs(node):
+    """
+    The (name, value) of the widgets picking a file from a list (ckpt_name,
+    lora_name...) if the node is a loader, otherwise an empty list.
+    """
+    class_def = nodes.NODE_CLASS_MAPPINGS[node['class_type']]
+    if not any(x in MODEL_OUTPUT_TYPES for x in class_def.RETURN_TYPES):
+        return []
+    input_types = caching.get_input_types(class_def)
+    out = []
+    for name, value in node['inputs'].items():
+        info = input_types.get("required", {}).get(name, None) or input_types.get("optional", {}).get(name, None)
+        if info is not None and isinstance(info[0], list) and isinstance(value, str):
+            out.append((name, value))
+    return out
+
+def topological_sort(prompt):
+    """
+    Kahn's algorithm over the whole prompt. Returns the node ids in an order
+    where every node comes after the nodes linked to its inputs, followed by
+    the nodes that are part of (or downstream of) a cycle.
+    """
+    indegree = {}
+    consumers = {}
+    for unique_id in prompt:
+        links = set(x for x in get_input_links(prompt[unique_id]) if x in prompt)
+        indegree[unique_id] = len(links)
+        for x in links:
+            consumers.setdefault(x, []).append(unique_id)
+
+    ready = [x for x in prompt if indegree[x] == 0]
+    order = []
+    while len(ready) > 0:
+        unique_id = ready.pop()
+        order.append(unique_id)
+        for x in consumers.get(unique_id, []):
+            indegree[x] -= 1
+            if indegree[x] == 0:
+                ready.append(x)
+
+    if len(order) < len(prompt):
+        in_order = set(order)
+        order += [x for x in prompt if x not in in_order]
+    return order
+
+class DependencyCycleError(Exception):
+    def __init__(self, message, node_ids):
+        super().__init__(message)
+        self.node_ids = node_ids
+
+class ExecutionPlan:
+    """
+    The part of a prompt that has to run to produce execute_outputs, compiled
+    once into indegree counters, consumer lists and a ready heap.
+
+    Nodes that are already in `outputs` are treated as done and aren't part
+    of the plan. When several nodes are ready, the one that comes first in a
+    depth-first walk of the outputs (smallest output first, inputs in
+    declaration order) is picked, which is the order the UI expects.
+
+    Inputs declared with {"lazy": True} are not followed. The nodes behind
+    them only become part of the plan when add_dependencies() is called for
+    them once the consuming node asked for them. Until the consuming node
+    completes, everything those nodes would read counts as still needed.
+
+    Ready nodes accepted by pooled(unique_id) are kept apart from the others
+    and popped with pop_ready(pooled=True).
+    """
+    def __init__(self, prompt, outputs, execute_outputs, pooled=None):
+        self.prompt = prompt
+        self.pooled = pooled
+        self.order = {}
+        self.indegree = {}
+        self.consumers = {}
+        self.ready = []
+        self.ready_pooled = []
+        self.done = set()
+        # how many plan nodes still have to read each output, including the
+        # outputs that were already computed before the plan started
+        self.remaining_consumers = {}
+        # node id -> the outputs held for the nodes behind its lazy inputs
+        self.lazy_holds = {}
+
+        per_output = []
+        for node_id in execute_outputs:
+            needed = self.needed_nodes(node_id, outputs)
+            per_output.append((len(needed), node_id, needed))
+        per_output.sort(key=lambda a: a[:2])
+
+        to_add = []
+        for _, _, needed in per_output:
+            to_add += needed
+        self.add_nodes(to_add, outputs)
+
+    def add_nodes(self, node_ids, outputs):
+        added = []
+        for unique_id in node_ids:
+            if unique_id not in self.order:
+                self.order[unique_id] = len(self.order)
+                added.append(unique_id)
+
+        for unique_id in added:
+            for x in set(get_input_links(self.prompt[unique_id])):
+                if x in self.prompt:
+                    self.remaining_consumers[x] = self.remaining_consumers.get(x, 0) + 1
+            held = self.lazy_branch_inputs(unique_id, outputs)
+            if len(held) > 0:
+                self.lazy_holds[unique_id] = held
+                for x in held:
+                    self.remaining_consumers[x] = self.remaining_consumers.get(x, 0) + 1
+            links = set(x for x in get_input_links(self.prompt[unique_id], skip_lazy=True) if x in self.order and x not in self.done)
+            self.indegree[unique_id] = len(links)
+            for x in links:
+                self.consumers.setdefault(x, []).append(unique_id)
+
+        for unique_id in added:
+            if self.indegree[unique_id] == 0:
+                self.push_ready(unique_id)
+
+    def add_dependencies(self, unique_id, input_ids, outputs):
+        """
+        Makes a node that was popped wait for the nodes linked to its lazy
+        inputs that it asked for, adding them and what they need to the plan.
+        """
+        for x in input_ids:
+            if x in outputs or x in self.done or x not in self.prompt:
+                continue
+            if x not in self.order:
+                self.add_nodes(self.needed_nodes(x, outputs), outputs)
+            self.indegree[unique_id] += 1
+            self.consumers.setdefault(x, []).append(unique_id)
+
+        if self.indegree[unique_id] == 0:
+            self.push_ready(unique_id)
+
+    def needed_nodes(self, node_id, outputs):
+        # post-order of everything node_id depends on that isn't computed or planned yet
+        result = []
+        seen = set()
+        stack = [(node_id, False)]
+        while len(stack) > 0:
+            unique_id, expanded = stack.pop()
+            if expanded:
+                result.append(unique_id)
+                continue
+            if unique_id in seen or unique_id in outputs or unique_id in self.order or unique_id not in self.prompt:
+                continue
+            seen.add(unique_id)
+            stack.append((unique_id, True))
+            for x in reversed(get_input_links(self.prompt[unique_id], skip_lazy=True)):
+                stack.append((x, False))
+        return result
+
+    def lazy_branch_inputs(self, unique_id, outputs):
+        # the outputs read by the nodes that would be added to the plan if
+        # unique_id asked for all its lazy inputs
+        lazy = get_lazy_inputs(nodes.NODE_CLASS_MAPPINGS[self.prompt[unique_id]['class_type']])
+        if len(lazy) == 0:
+            return set()
+        to_visit = [v[0] for k, v in self.prompt[unique_id]['inputs'].items() if k in lazy and isinstance(v, list)]
+        held = set()
+        seen = set()
+        while len(to_visit) > 0:
+            x = to_visit.pop()
+            if x in seen or x not in self.prompt or x in outputs or x in self.order:
+                continue
+            seen.add(x)
+            for y in get_input_links(self.prompt[x]):
+                if y in self.prompt:
+                    held.add(y)
+                    to_visit.append(y)
+        return held
+
+    def __len__(self):
+        return len(self.order)
+
+    def is_finished(self):
+        return len(self.done) == len(self.order)
+
+    def push_ready(self, unique_id):
+        entry = (self.order[unique_id], unique_id)
+        if self.pooled is not None and self.pooled(unique_id):
+            heapq.heappush(self.ready_pooled, entry)
+        else:
+            heapq.heappush(self.ready, entry)
+
+    def pop_ready(self, pooled=False):
+        """
+        Returns the next node whose inputs are all computed, or None. With
+        pooled, only the ready nodes the pooled predicate accepted.
+        """
+        ready = self.ready_pooled if pooled else self.ready
+        if len(ready) == 0:
+            return None
+        return heapq.heappop(ready)[1]
+
+    def blocked_error(self):
+        blocked = sorted((x for x in self.indegree if self.indegree[x] > 0), key=lambda a: self.order[a])
+        return DependencyCycleError("Dependency cycle detected between nodes {}".format(", ".join(blocked)), blocked)
+
+    def complete(self, unique_id):
+        """
+        Marks a node as computed and returns the nodes linked to its inputs
+        that no node left in the plan needs anymore.
+        """
+        self.done.add(unique_id)
+        for x in self.consumers.get(unique_id, []):
+            self.indegree[x] -= 1
+            if self.indegree[x] == 0:
+                self.push_ready(x)
+
+        unused = []
+        read = list(set(get_input_links(self.prompt[unique_id]))) + list(self.lazy_holds.pop(unique_id, ()))
+        for x in read:
+            if x in self.remaining_consumers:
+                self.remaining_consumers[x] -= 1
+                if self.remaining_consumers[x] == 0:
+                    unused.append(x)
+        return unused
@@ -0,0 +1,115 @@
+import heapq
+
+class IndexedHeap:
+    """
+    A binary min-heap of queue items that also tracks the position of every
+    item by key, so an item can be removed or given a new priority in
+    O(log n) instead of a linear scan and a heapify. Items are compared as
+    is, keys (key_function(item)) must be unique.
+    """
+    def __init__(self, key_function, items=()):
+        self.key_function = key_function
+        self.heap = list(items)
+        heapq.heapify(self.heap)
+        self.positions = {}
+        for i, item in enumerate(self.heap):
+            self.positions[key_function(item)] = i
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __contains__(self, key):
+        return key in self.positions
+
+    def __iter__(self):
+        return iter(self.heap)
+
+    def get(self, key):
+        i = self.positions.get(key, None)
+        if i is None:
+            return None
+        return self.heap[i]
+
+    def peek(self):
+        return self.heap[0]
+
+    def push(self, item):
+        key = self.key_function(item)
+        if key in self.positions:
+            raise KeyError("{} is already queued".format(key))
+        self.heap.append(item)
+        self.positions[key] = len(self.heap) - 1
+        self.sift_up(len(self.heap) - 1)
+
+    def pop(self):
+        return self.remove_at(0)
+
+    def remove(self, key):
+        i = self.positions.get(key, None)
+        if i is None:
+            return None
+        return self.remove_at(i)
+
+    def update(self, item):
+        """
+        Replaces the item with the same key, moving it to where its new
+        priority puts it.
+        """
+        i = self.positions[self.key_function(item)]
+        old = self.heap[i]
+        self.heap[i] = item
+        if item < old:
+            self.sift_up(i)
+        else:
+            self.sift_down(i)
+        return old
+
+    def clear(self):
+        self.heap = []
+        self.positions = {}
+
+    def smallest(self, count, offset=0):
+        """
+        The items at positions offset to offset + count in priority order.
+        """
+        if count <= 0:
+            return []
+        return heapq.nsmallest(offset + count, self.heap)[offset:]
+
+    def remove_at(self, i):
+        item = self.heap[i]
+        del self.positions[self.key_function(item)]
+        last = self.heap.pop()
+        if i < len(self.heap):
+            self.heap[i] = last
+            self.positions[self.key_function(last)] = i
+            if last < item:
+                self.sift_up(i)
+            else:
+                self.sift_down(i)
+        return item
+
+    def swap(self, i, j):
+        self.heap[i], self.heap[j] = self.heap[j], self.heap[i]
+        self.positions[self.key_function(self.heap[i])] = i
+        self.positions[self.key_function(self.heap[j])] = j
+
+    def sift_up(self, i):
+        while i > 0:
+            parent = (i - 1) // 2
+            if not self.heap[i] < self.heap[parent]:
+                break
+            self.swap(i, parent)
+            i = parent
+
+    def sift_down(self, i):
+        size = len(self.heap)
+        while True:
+            smallest = i
+            for child in (2 * i + 1, 2 * i + 2):
+                if child < size and self.heap[child] < self.heap[smallest]:
+                    smallest = child
+            if smallest == i:
+                break
+            self.swap(i, smallest)
+            i = smallest
@@ -0,0 +1,91 @@
+import time
+import logging
+import threading
+
+import comfy.model_management
+from comfy_execution import profiler
+
+class Preemption:
+    """
+    Lets a prompt sent to the front of the queue ahead of the running one
+    start at the next progress update of the running prompt, usually a
+    sampler step, instead of waiting for it to finish. The scheduling policy
+    still picks which queued prompt that is.
+
+    The running prompt is paused where it is: its thread waits while
+    run_prompt(item, item_id) runs the other prompt to the end on a new
+    thread with its own executor, then the models the paused prompt was
+    using are loaded again and it carries on from the same step. Its state
+    stays in memory the whole time. Prompts that preempt can't be preempted
+    themselves. A paused prompt that is interrupted (interrupt()) isn't
+    resumed, it stops with an InterruptProcessingException once the other
+    prompt is done.
+    """
+    def __init__(self, prompt_queue, server, run_prompt):
+        self.prompt_queue = prompt_queue
+        self.server = server
+        self.run_prompt = run_prompt
+        self.number = None
+        self.preempting = False
+        self.lock = threading.Lock()
+        self.paused = None
+        self.cancelled = False
+
+    def started(self, item):
+        self.number = item[0]
+
+    def finished(self):
+        self.number = None
+
+    def interrupt(self, prompt_id):
+        """
+        Cancels prompt_id if it is paused, returns False if it isn't.
+        """
+        with self.lock:
+            if self.paused is None or self.paused != prompt_id:
+                return False
+            self.cancelled = True
+            return True
+
+    def check(self):
+        if self.preempting or self.number is None:
+            return
+        queue_item = self.prompt_queue.get_preempting(self.number)
+        if queue_item is not None:
+            self.pause(queue_item)
+
+    def pause(self, queue_item):
+        server = self.server
+        paused = (server.client_id, server.last_node_id, server.last_prompt_id)
+        models = comfy.model_management.loaded_models(only_currently_used=True)
+        logging.info("Pausing prompt {} to run prompt {}".format(paused[2], queue_item[0][1]))
+        if paused[0] is not None:
+            server.send_sync("execution_paused", {"prompt_id": paused[2], "node": paused[1], "by": queue_item[0][1]}, paused[0])
+
+        start = time.perf_counter()
+        self.preempting = True
+        with self.lock:
+            self.paused = paused[2]
+            self.cancelled = False
+        try:
+            thread = threading.Thread(target=self.run_prompt, args=queue_item, name="preempting_prompt")
+            thread.start()
+            thread.join()
+        finally:
+            self.preempting = False
+            server.client_id, server.last_node_id, server.last_prompt_id = paused
+            with self.lock:
+                cancelled = self.cancelled
+                self.paused = None
+                self.cancelled = False
+
+        if cancelled:
+            logging.info("Prompt {} was interrupted while paused".format(paused[2]))
+            raise comfy.model_management.InterruptProcessingException()
+
+        comfy.model_management.load_models_gpu(models)
+        elapsed = time.perf_counter() - start
+        profiler.pause_hook(elapsed)
+        logging.info("Resuming prompt {} after {:.2f} seconds".format(paused[2], elapsed))
+        if paused[0] is not None:
+            server.send_sync("execution_resumed", {"prompt_id": paused[2], "node": paused[1]}, paused[0])
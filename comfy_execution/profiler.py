@@ -0,0 +1,336 @@
+import os
+import json
+import time
+import hashlib
+import threading
+
+import psutil
+import torch
+
+current = threading.local()
+
+MAXIMUM_WORKFLOWS = 1000
+
+def model_load_hook(start, elapsed):
+    scope = getattr(current, "scope", None)
+    if scope is not None:
+        scope.record["model_load_time"] += elapsed
+        scope.record["model_loads"].append([start - scope.profile.start_time, elapsed])
+
+def tensor_bytes(value, depth=0):
+    if isinstance(value, torch.Tensor):
+        return value.nelement() * value.element_size()
+    if depth > 4:
+        return 0
+    if isinstance(value, dict):
+        return sum(tensor_bytes(v, depth + 1) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(tensor_bytes(v, depth + 1) for v in value)
+    return 0
+
+def pause_hook(elapsed):
+    scope = getattr(current, "scope", None)
+    if scope is not None:
+        scope.record["paused_time"] += elapsed
+        with scope.profile.lock:
+            scope.profile.paused_time += elapsed
+
+class MemorySampler:
+    """
+    One thread sampling the RSS of the process every interval seconds for
+    the profiles of all the prompts that are running, idle when there are
+    none.
+    """
+    def __init__(self, interval=0.05):
+        self.interval = interval
+        self.process = psutil.Process(os.getpid())
+        self.lock = threading.Lock()
+        self.profiles = set()
+        self.wake = threading.Event()
+        self.thread = None
+
+    def add(self, profile):
+        with self.lock:
+            self.profiles.add(profile)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.run, daemon=True, name="rss_sampler")
+                self.thread.start()
+        self.wake.set()
+
+    def remove(self, profile):
+        with self.lock:
+            self.profiles.discard(profile)
+
+    def run(self):
+        while True:
+            with self.lock:
+                profiles = list(self.profiles)
+                if len(profiles) == 0:
+                    self.wake.clear()
+            if len(profiles) == 0:
+                self.wake.wait()
+                continue
+            rss = self.process.memory_info().rss
+            for profile in profiles:
+                profile.sample_memory(rss)
+            time.sleep(self.interval)
+
+sampler = MemorySampler()
+
+class NodeScope:
+    def __init__(self, profile, record):
+        self.profile = profile
+        self.record = record
+
+    def __enter__(self):
+        current.scope = self
+        self.record["thread"] = threading.current_thread().name
+        rss = sampler.process.memory_info().rss
+        self.record["rss_start"] = rss
+        self.record["peak_rss"] = rss
+        with self.profile.lock:
+            self.profile.active.append(self.record)
+            self.profile.mark_overlapped()
+        self.record["start"] = time.perf_counter() - self.profile.start_time
+        return self.record
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.record["duration"] = time.perf_counter() - self.profile.start_time - self.record["start"]
+        current.scope = None
+        rss = sampler.process.memory_info().rss
+        with self.profile.lock:
+            self.profile.active.remove(self.record)
+            self.record["peak_rss"] = max(self.record["peak_rss"], rss)
+            self.profile.nodes.append(self.record)
+        return False
+
+class PromptProfile:
+    """
+    Timings of every node execution of a prompt: wall time, time spent in
+    load_models_gpu, peak host memory (RSS sampled by the MemorySampler
+    while the node runs), tensor bytes of each output and whether the output
+    came from the cache.
+
+    RSS is process wide, so the peak of a node that ran at the same time as
+    other nodes (on the cpu thread pool) is marked overlapped and isn't
+    counted as its own by ProfileHistory.
+    """
+    def __init__(self, prompt_id, workflow=None, features=None):
+        self.prompt_id = prompt_id
+        self.workflow = workflow
+        self.features = features
+        self.lock = threading.Lock()
+        self.nodes = []
+        self.active = []
+        self.start_time = time.perf_counter()
+        self.start_timestamp = time.time()
+        self.duration = None
+        # time spent paused while other prompts ran, see preemption.py
+        self.paused_time = 0.0
+        sampler.add(self)
+
+    def sample_memory(self, rss):
+        with self.lock:
+            for record in self.active:
+                record["peak_rss"] = max(record["peak_rss"], rss)
+
+    def mark_overlapped(self):
+        if len(self.active) > 1:
+            for record in self.active:
+                record["overlapped"] = True
+
+    def new_record(self, node_id, class_type, cache):
+        return {
+            "node_id": node_id,
+            "class_type": class_type,
+            "cache": cache,
+            "status": None,
+            "start": time.perf_counter() - self.start_time,
+            "duration": 0.0,
+            "model_load_time": 0.0,
+            "model_loads": [],
+            "paused_time": 0.0,
+            "rss_start": None,
+            "peak_rss": None,
+            "overlapped": False,
+            "output_sizes": [],
+            "thread": None,
+        }
+
+    def node(self, node_id, class_type):
+        return NodeScope(self, self.new_record(node_id, class_type, "miss"))
+
+    def cached(self, node_id, class_type, outputs):
+        record = self.new_record(node_id, class_type, "hit")
+        record["status"] = "success"
+        record["output_sizes"] = [tensor_bytes(x) for x in outputs]
+        with self.lock:
+            self.nodes.append(record)
+
+    def stop(self):
+        self.duration = time.perf_counter() - self.start_time
+        sampler.remove(self)
+
+    def as_dict(self):
+        with self.lock:
+            nodes = [dict(x) for x in self.nodes]
+        return {
+            "prompt_id": self.prompt_id,
+            "workflow": self.workflow,
+            "features": self.features,
+            "start_timestamp": self.start_timestamp,
+            "duration": self.duration,
+            "paused_time": self.paused_time,
+            "nodes": nodes,
+        }
+
+def workflow_key(prompt):
+    """
+    Identifies the structure of a prompt, its nodes and how they are linked,
+    whatever the widget values are.
+    """
+    structure = []
+    for node_id, node in prompt.items():
+        links = sorted((k, v[0], v[1]) for k, v in node.get("inputs", {}).items() if isinstance(v, list) and len(v) == 2)
+        structure.append((node_id, node.get("class_type", None), links))
+    structure.sort(key=lambda x: str(x[0]))
+    return hashlib.sha1(json.dumps(structure, default=str).encode("utf-8")).hexdigest()
+
+class ProfileHistory:
+    """
+    Running averages (exponential, weighted by alpha) of the profiled node
+    executions (PromptProfile.as_dict()) per class_type, used to estimate the cost of a node before
+    it runs. Cache hits and failed executions are not counted, neither is
+    the peak memory of overlapped executions.
+
+    The wall time of whole prompts is averaged per workflow_key() and over
+    all prompts, prompts that failed or came entirely from the cache are not
+    counted.
+    """
+    def __init__(self, alpha=0.2):
+        self.alpha = alpha
+        self.lock = threading.Lock()
+        self.classes = {}
+        self.workflows = {}
+        self.prompt_duration = None
+        # called with every profile added, like estimator.RuntimeEstimator.add
+        self.listeners = []
+
+    def add(self, profile):
+        for listener in self.listeners:
+            listener(profile)
+        executed = False
+        failed = False
+        for record in profile["nodes"]:
+            if record["status"] == "failure":
+                failed = True
+            if record["cache"] != "miss" or record["status"] != "success":
+                continue
+            executed = True
+            sample = {
+                "duration": record["duration"] - record.get("paused_time", 0.0),
+                "model_load_time": record["model_load_time"],
+                "output_bytes": sum(record["output_sizes"]),
+            }
+            peak_memory = None
+            if not record.get("overlapped", False):
+                peak_memory = max(record["peak_rss"] - record["rss_start"], 0)
+            with self.lock:
+                stats = self.classes.get(record["class_type"], None)
+                if stats is None:
+                    stats = self.classes[record["class_type"]] = dict(sample, peak_memory=0, samples=1, memory_samples=0)
+                else:
+                    for k, v in sample.items():
+                        stats[k] += self.alpha * (v - stats[k])
+                    stats["samples"] += 1
+                if peak_memory is not None:
+                    if stats["memory_samples"] == 0:
+                        stats["peak_memory"] = peak_memory
+                    else:
+                        stats["peak_memory"] += self.alpha * (peak_memory - stats["peak_memory"])
+                    stats["memory_samples"] += 1
+
+        duration = profile.get("duration", None)
+        if not executed or failed or duration is None:
+            return
+        duration -= profile.get("paused_time", 0.0)
+        with self.lock:
+            workflow = profile.get("workflow", None)
+            if workflow is not None:
+                average = self.workflows.pop(workflow, None)
+                # most recently seen last, the oldest ones go first when there are too many
+                self.workflows[workflow] = duration if average is None else average + self.alpha * (duration - average)
+                while len(self.workflows) > MAXIMUM_WORKFLOWS:
+                    self.workflows.pop(next(iter(self.workflows)))
+            if self.prompt_duration is None:
+                self.prompt_duration = duration
+            else:
+                self.prompt_duration += self.alpha * (duration - self.prompt_duration)
+
+    def get(self, class_type):
+        with self.lock:
+            stats = self.classes.get(class_type, None)
+            if stats is None:
+                return None
+            return dict(stats)
+
+    def estimate_prompt(self, prompt):
+        """
+        Estimated seconds a prompt takes: the average of its workflow, else
+        the sum of the averages of its node classes, else the average of all
+        prompts. None when nothing ran yet.
+        """
+        workflow = workflow_key(prompt)
+        with self.lock:
+            if workflow in self.workflows:
+                return self.workflows[workflow]
+            known = False
+            total = 0.0
+            for node in prompt.values():
+                stats = self.classes.get(node.get("class_type", None), None)
+                if stats is not None:
+                    known = True
+                    total += stats["duration"]
+            if known:
+                return total
+            return self.prompt_duration
+
+history = ProfileHistory()
+
+def to_chrome_trace(profile):
+    """
+    Converts a profile from PromptProfile.as_dict() to the Chrome trace event
+    format, which can be opened in chrome://tracing or ui.perfetto.dev.
+    """
+    events = []
+    threads = {}
+    pid = 1
+    for record in profile["nodes"]:
+        tid = threads.setdefault(record["thread"] or "cache", len(threads) + 1)
+        start = round(record["start"] * 1e6)
+        events.append({
+            "name": record["class_type"],
+            "cat": "cache" if record["cache"] == "hit" else "node",
+            "ph": "X",
+            "ts": start,
+            "dur": round(record["duration"] * 1e6),
+            "pid": pid,
+            "tid": tid,
+            "args": {k: record.get(k, None) for k in ("node_id", "status", "cache", "peak_rss", "overlapped", "output_sizes")},
+        })
+        for load_start, load_duration in record["model_loads"]:
+            events.append({
+                "name": "load_models_gpu",
+                "cat": "model_load",
+                "ph": "X",
+                "ts": round(load_start * 1e6),
+                "dur": round(load_duration * 1e6),
+                "pid": pid,
+                "tid": tid,
+                "args": {"node_id": record["node_id"]},
+            })
+
+    events.append({"name": "process_name", "ph": "M", "pid": pid, "args": {"name": "prompt {}".format(profile["prompt_id"])}})
+    for name, tid in threads.items():
+        events.append({"name": "thread_name", "ph": "M", "pid": pid, "tid": tid, "args": {"name": name}})
+    return {"traceEvents": events, "displayTimeUnit": "ms"}
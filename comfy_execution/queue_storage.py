@@ -0,0 +1,144 @@
+import os
+import json
+import sqlite3
+import logging
+import threading
+
+class MemoryStorage:
+    """
+    Keeps the pending prompts and the history in memory, they are lost when
+    the process exits. Queue items are (number, prompt_id, prompt, extra_data,
+    outputs_to_execute) tuples, history entries are dicts that are never
+    modified once added.
+    """
+    def __init__(self):
+        self.history = {}
+
+    def load_pending(self):
+        return []
+
+    def add_pending(self, item):
+        pass
+
+    def set_running(self, prompt_id):
+        pass
+
+    def remove_pending(self, prompt_id):
+        pass
+
+    def clear_pending(self):
+        pass
+
+    def add_history(self, prompt_id, entry, max_size):
+        self.history.pop(prompt_id, None)
+        self.history[prompt_id] = entry
+        while len(self.history) > max_size:
+            self.history.pop(next(iter(self.history)))
+
+    def get_history(self, prompt_id):
+        return self.history.get(prompt_id, None)
+
+    def list_history(self, max_items=None, offset=-1):
+        if offset < 0 and max_items is not None:
+            offset = len(self.history) - max_items
+        offset = max(offset, 0)
+        out = {}
+        for i, k in enumerate(self.history):
+            if i < offset:
+                continue
+            if max_items is not None and len(out) >= max_items:
+                break
+            out[k] = self.history[k]
+        return out
+
+    def history_count(self):
+        return len(self.history)
+
+    def delete_history(self, prompt_id):
+        self.history.pop(prompt_id, None)
+
+    def clear_history(self):
+        self.history = {}
+
+    def close(self):
+        pass
+
+class SQLiteStorage:
+    """
+    Keeps the pending prompts and the history in a SQLite database (WAL
+    journal) so they survive a restart. History entries are only read from
+    disk when they are asked for. Prompts that were running when the process
+    stopped are queued again by load_pending().
+    """
+    def __init__(self, path):
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            self.connection.execute("PRAGMA synchronous=NORMAL")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS queue (prompt_id TEXT PRIMARY KEY, number REAL NOT NULL, running INTEGER NOT NULL DEFAULT 0, item TEXT NOT NULL)")
+            self.connection.execute("CREATE TABLE IF NOT EXISTS history (seq INTEGER PRIMARY KEY AUTOINCREMENT, prompt_id TEXT NOT NULL UNIQUE, entry TEXT NOT NULL)")
+        logging.info("Storing the prompt queue and history in {}".format(path))
+
+    def execute(self, sql, parameters=()):
+        with self.lock:
+            return self.connection.execute(sql, parameters).fetchall()
+
+    def load_pending(self):
+        self.execute("UPDATE queue SET running = 0")
+        return [tuple(json.loads(x[0])) for x in self.execute("SELECT item FROM queue ORDER BY number")]
+
+    def add_pending(self, item):
+        self.execute("INSERT OR REPLACE INTO queue (prompt_id, number, running, item) VALUES (?, ?, 0, ?)", (item[1], item[0], json.dumps(item)))
+
+    def set_running(self, prompt_id):
+        self.execute("UPDATE queue SET running = 1 WHERE prompt_id = ?", (prompt_id,))
+
+    def remove_pending(self, prompt_id):
+        self.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+
+    def clear_pending(self):
+        self.execute("DELETE FROM queue WHERE running = 0")
+
+    def add_history(self, prompt_id, entry, max_size):
+        data = json.dumps(entry, default=str)
+        with self.lock:
+            self.connection.execute("BEGIN")
+            try:
+                self.connection.execute("DELETE FROM queue WHERE prompt_id = ?", (prompt_id,))
+                self.connection.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+                self.connection.execute("INSERT INTO history (prompt_id, entry) VALUES (?, ?)", (prompt_id, data))
+                self.connection.execute("DELETE FROM history WHERE seq <= (SELECT seq FROM history ORDER BY seq DESC LIMIT 1 OFFSET ?)", (max_size,))
+                self.connection.execute("COMMIT")
+            except:
+                self.connection.execute("ROLLBACK")
+                raise
+
+    def get_history(self, prompt_id):
+        rows = self.execute("SELECT entry FROM history WHERE prompt_id = ?", (prompt_id,))
+        if len(rows) == 0:
+            return None
+        return json.loads(rows[0][0])
+
+    def list_history(self, max_items=None, offset=-1):
+        if offset < 0 and max_items is not None:
+            rows = self.execute("SELECT prompt_id, entry FROM history ORDER BY seq DESC LIMIT ?", (max_items,))
+            rows.reverse()
+        else:
+            rows = self.execute("SELECT prompt_id, entry FROM history ORDER BY seq LIMIT ? OFFSET ?", (-1 if max_items is None else max_items, max(offset, 0)))
+        return {x[0]: json.loads(x[1]) for x in rows}
+
+    def history_count(self):
+        return self.execute("SELECT COUNT(*) FROM history")[0][0]
+
+    def delete_history(self, prompt_id):
+        self.execute("DELETE FROM history WHERE prompt_id = ?", (prompt_id,))
+
+    def clear_history(self):
+        self.execute("DELETE FROM history")
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
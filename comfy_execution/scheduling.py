@@ -0,0 +1,273 @@
+import time
+import logging
+
+from comfy_execution import graph
+from comfy_execution import indexed_heap
+
+class FIFOPolicy:
+    """
+    Runs the queued item with the lowest number first.
+
+    PromptQueue tells a policy about every item that is added (added),
+    removed without running (forget), picked to run (started) and done
+    (finished). select() returns the prompt_id of the item to run next or
+    None to wait until something changes.
+    """
+    name = "fifo"
+
+    def added(self, item):
+        pass
+
+    def select(self, queue):
+        return queue.peek()[1]
+
+    def started(self, item):
+        pass
+
+    def finished(self, item):
+        pass
+
+    def forget(self, prompt_id):
+        pass
+
+    def describe(self):
+        return {"policy": self.name}
+
+def model_signature(prompt):
+    """
+    The set of model files the loader nodes of a prompt pick.
+    """
+    signature = set()
+    for node in prompt.values():
+        try:
+            signature.update((node['class_type'], name, value) for name, value in graph.get_model_inputs(node))
+        except Exception:
+            pass
+    return frozenset(signature)
+
+class ModelAffinityPolicy(FIFOPolicy):
+    """
+    Prefers, among the first `window` queued items, the one that uses the
+    most of the model files the previous prompt used, so prompts that share
+    checkpoints/LoRAs run back to back instead of reloading the weights every
+    time. An item that has been passed over max_skips times runs next, and
+    items sent to the front (negative number) always run in order.
+    """
+    name = "model-affinity"
+
+    def __init__(self, window=16, max_skips=4):
+        self.window = window
+        self.max_skips = max_skips
+        self.signatures = {}
+        self.skips = {}
+        self.last_signature = frozenset()
+
+    def signature(self, item):
+        prompt_id = item[1]
+        if prompt_id not in self.signatures:
+            self.signatures[prompt_id] = model_signature(item[2])
+        return self.signatures[prompt_id]
+
+    def select(self, queue):
+        head = queue.peek()
+        if head[0] < 0 or len(self.last_signature) == 0 or self.skips.get(head[1], 0) >= self.max_skips:
+            return head[1]
+
+        candidates = queue.smallest(self.window)
+        best = 0
+        best_overlap = len(self.signature(head) & self.last_signature)
+        for i, item in enumerate(candidates):
+            overlap = len(self.signature(item) & self.last_signature)
+            if overlap > best_overlap:
+                best = i
+                best_overlap = overlap
+            if self.skips.get(item[1], 0) >= self.max_skips:
+                # can't be passed over again
+                break
+
+        for item in candidates[:best]:
+            self.skips[item[1]] = self.skips.get(item[1], 0) + 1
+        if best > 0:
+            logging.debug("model affinity: running {} ahead of {} queued items".format(candidates[best][1], best))
+        return candidates[best][1]
+
+    def started(self, item):
+        self.last_signature = self.signature(item)
+        self.signatures.pop(item[1], None)
+        self.skips.pop(item[1], None)
+
+    def forget(self, prompt_id):
+        self.signatures.pop(prompt_id, None)
+        self.skips.pop(prompt_id, None)
+
+def item_owner(item):
+    extra_data = item[3]
+    return extra_data.get("user_id", None) or extra_data.get("client_id", None) or ""
+
+class FairPolicy(FIFOPolicy):
+    """
+    Weighted fair queuing between the owners of the queued items (the user
+    with --multi-user, otherwise the client_id). Every owner has its own
+    queue in submission order and a virtual time that advances by
+    1 / weight for each prompt it runs; the owner with the lowest virtual
+    time goes next, so a client that queued hundreds of prompts only gets
+    its share while others are waiting. An owner that starts queueing again
+    joins at the current virtual time instead of cashing in the time it was
+    idle. Owners at their max_running limit are skipped and items sent to
+    the front (negative number) run first.
+
+    weights and max_running map owners to values, "*" is the default for
+    the ones not listed. A max_running of 0 means no limit.
+    """
+    name = "fair"
+
+    def __init__(self, weights={}, max_running={}):
+        self.weights = weights
+        self.max_running = max_running
+        self.queues = {}
+        self.owners = {}
+        self.virtual_time = {}
+        self.running = {}
+        self.clock = 0.0
+
+    def weight(self, owner):
+        return max(self.weights.get(owner, self.weights.get("*", 1.0)), 1e-6)
+
+    def running_limit(self, owner):
+        return self.max_running.get(owner, self.max_running.get("*", 0))
+
+    def added(self, item):
+        owner = item_owner(item)
+        if owner not in self.queues:
+            self.queues[owner] = indexed_heap.IndexedHeap(lambda a: a[1])
+            self.virtual_time[owner] = max(self.virtual_time.get(owner, 0.0), self.clock)
+        self.queues[owner].push(item)
+        self.owners[item[1]] = owner
+
+    def forget(self, prompt_id):
+        owner = self.owners.pop(prompt_id, None)
+        if owner is None:
+            return
+        self.queues[owner].remove(prompt_id)
+        if len(self.queues[owner]) == 0:
+            del self.queues[owner]
+
+    def can_run(self, owner):
+        limit = self.running_limit(owner)
+        return limit <= 0 or self.running.get(owner, 0) < limit
+
+    def select(self, queue):
+        head = queue.peek()
+        if head[0] < 0:
+            return head[1]
+        best = None
+        for owner, owner_queue in self.queues.items():
+            if not self.can_run(owner):
+                continue
+            key = (self.virtual_time[owner], owner_queue.peek()[0])
+            if best is None or key < best[0]:
+                best = (key, owner_queue.peek()[1])
+        if best is None:
+            return None
+        return best[1]
+
+    def started(self, item):
+        owner = item_owner(item)
+        self.forget(item[1])
+        self.clock = max(self.clock, self.virtual_time.get(owner, 0.0))
+        self.virtual_time[owner] = self.virtual_time.get(owner, self.clock) + 1.0 / self.weight(owner)
+        self.running[owner] = self.running.get(owner, 0) + 1
+
+    def finished(self, item):
+        owner = item_owner(item)
+        self.running[owner] = self.running.get(owner, 1) - 1
+        if self.running[owner] <= 0:
+            del self.running[owner]
+        if owner not in self.queues and owner not in self.running:
+            self.virtual_time.pop(owner, None)
+
+    def describe(self):
+        owners = {}
+        for owner in set(self.queues) | set(self.running):
+            owners[owner] = {
+                "weight": self.weight(owner),
+                "max_running": self.running_limit(owner),
+                "virtual_time": self.virtual_time.get(owner, self.clock),
+                "pending": len(self.queues[owner]) if owner in self.queues else 0,
+                "running": self.running.get(owner, 0),
+            }
+        return {"policy": self.name, "virtual_time": self.clock, "owners": owners}
+
+class ShortestJobPolicy(FIFOPolicy):
+    """
+    Runs the queued item with the lowest estimate(item), its estimated run
+    time in seconds, first. Items without an estimate count as the average
+    estimate of the queued items that have one when they were queued, that
+    isn't updated as other items come and go. An item that has been queued
+    for max_wait seconds runs next whatever its estimate and items sent to
+    the front (negative number) always run in order.
+    """
+    name = "shortest-job"
+
+    def __init__(self, estimate, max_wait=600.0):
+        self.estimate = estimate
+        self.max_wait = max_wait
+        self.jobs = indexed_heap.IndexedHeap(lambda a: a[-1])
+        self.queued_at = {}
+        self.estimates = {}
+        self.estimates_total = 0.0
+
+    def key(self, item, estimate):
+        return (estimate, item[0])
+
+    def added(self, item):
+        self.queued_at[item[1]] = time.monotonic()
+        estimate = self.estimate(item)
+        if estimate is not None:
+            self.estimates[item[1]] = estimate
+            self.estimates_total += estimate
+        elif len(self.estimates) > 0:
+            estimate = self.estimates_total / len(self.estimates)
+        else:
+            estimate = 0.0
+        self.jobs.push(self.key(item, estimate) + (item[1],))
+
+    def select(self, queue):
+        head = queue.peek()
+        if head[0] < 0 or time.monotonic() - self.queued_at.get(head[1], 0.0) >= self.max_wait:
+            return head[1]
+        return self.jobs.peek()[-1]
+
+    def started(self, item):
+        self.forget(item[1])
+
+    def forget(self, prompt_id):
+        self.jobs.remove(prompt_id)
+        self.queued_at.pop(prompt_id, None)
+        estimate = self.estimates.pop(prompt_id, None)
+        if estimate is not None:
+            self.estimates_total -= estimate
+
+    def describe(self):
+        return {"policy": self.name, "next": [{"prompt_id": x[-1], "key": list(x[:-1])} for x in self.jobs.smallest(8)]}
+
+class DeadlinePolicy(ShortestJobPolicy):
+    """
+    Least slack first: runs the item that has to start the soonest to be
+    done by its deadline, the deadline minus its estimated run time. The
+    deadline is extra_data["deadline"] (unix time), items queued without
+    one get default_deadline seconds after they were queued written there.
+    """
+    name = "deadline"
+
+    def __init__(self, estimate, default_deadline=3600.0):
+        super().__init__(estimate, max_wait=float("inf"))
+        self.default_deadline = default_deadline
+
+    def key(self, item, estimate):
+        return (item[3]["deadline"] - estimate, item[0])
+
+    def added(self, item):
+        if item[3].get("deadline", None) is None:
+            item[3]["deadline"] = time.time() + self.default_deadline
+        super().added(item)
@@ -0,0 +1,203 @@
+import time
+import queue
+import logging
+import threading
+import multiprocessing
+
+import execution
+from comfy_execution import profiler
+
+class WorkerQueue:
+    """
+    What prompt_worker() sees of the PromptQueue inside a worker process:
+    prompts and flags are sent by the WorkerPool of the main process, results
+    are sent back to it.
+    """
+    def __init__(self, tasks, results):
+        self.tasks = tasks
+        self.results = results
+        self.flags = {}
+
+    def get(self, timeout=None):
+        try:
+            task = self.tasks.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if task[0] == "flags":
+            self.flags.update(task[1])
+            return None
+        return (task[1], task[2])
+
+    def task_done(self, item_id, outputs, status, profile=None):
+        self.results.put(("done", item_id, outputs, None if status is None else status._asdict(), profile))
+
+    def get_flags(self, reset=True):
+        flags = self.flags
+        if reset:
+            self.flags = {}
+        return flags
+
+class WorkerServer:
+    """
+    Stands in for the PromptServer inside a worker process, the messages are
+    sent by the main process to the websocket clients.
+    """
+    def __init__(self, results):
+        self.results = results
+        self.client_id = None
+        self.last_node_id = None
+        self.last_prompt_id = None
+        self.prompt_executor = None
+
+    def send_sync(self, event, data, sid=None):
+        self.results.put(("send", event, data, sid))
+
+    def queue_updated(self):
+        pass
+
+def watch_interrupt(interrupt, function):
+    while True:
+        interrupt.wait()
+        interrupt.clear()
+        function()
+
+class Worker:
+    def __init__(self, index, context, target, args):
+        self.index = index
+        self.tasks = context.Queue()
+        self.results = context.Queue()
+        self.interrupt = context.Event()
+        self.idle = threading.Semaphore(1)
+        self.current = None
+        self.prompt_id = None
+        self.last_executing = 0.0
+        self.dead = False
+        self.started = None
+        self.process = context.Process(target=target, args=(index, self.tasks, self.results, self.interrupt) + args, daemon=True, name="prompt_worker_{}".format(index))
+
+class WorkerPool:
+    """
+    Runs the prompts of a PromptQueue in `count` worker processes, each with
+    its own PromptExecutor. target(index, tasks, results, interrupt, *args)
+    is the entry point of a worker process. In the main process every worker
+    has a thread that hands it the next prompt when it is idle and a thread
+    that relays what it sends to the PromptServer. A worker process that
+    exits is started again, the prompt it was running fails.
+    """
+    # a worker that exits sooner than this after it started waits this long before it is started again
+    restart_delay = 30.0
+
+    def __init__(self, prompt_queue, server, count, target, args=()):
+        self.prompt_queue = prompt_queue
+        self.server = server
+        self.context = multiprocessing.get_context("spawn")
+        self.target = target
+        self.args = args
+        self.lock = threading.Lock()
+        self.workers = [Worker(i, self.context, target, args) for i in range(count)]
+
+    def start(self):
+        for worker in self.workers:
+            self.start_worker(worker)
+
+    def start_worker(self, worker):
+        worker.started = time.monotonic()
+        worker.process.start()
+        threading.Thread(target=self.dispatch, args=(worker,), daemon=True).start()
+        threading.Thread(target=self.relay, args=(worker,), daemon=True).start()
+
+    def interrupt(self, prompt_id=None):
+        """
+        Interrupts the worker running prompt_id, by default the one running
+        the prompt the clients last got an "executing" message about.
+        """
+        with self.lock:
+            busy = [w for w in self.workers if w.current is not None]
+            if prompt_id is None:
+                busy = sorted(busy, key=lambda w: w.last_executing)[-1:]
+            else:
+                busy = [w for w in busy if w.prompt_id == prompt_id]
+            for worker in busy:
+                worker.interrupt.set()
+
+    def broadcast_flags(self):
+        flags = self.prompt_queue.get_flags()
+        if len(flags) > 0:
+            for worker in self.workers:
+                worker.tasks.put(("flags", flags))
+
+    def dispatch(self, worker):
+        while worker.process.is_alive():
+            worker.idle.acquire()
+            queue_item = None
+            while queue_item is None and worker.process.is_alive():
+                queue_item = self.prompt_queue.get(timeout=1.0)
+                self.broadcast_flags()
+            if queue_item is None:
+                break
+            item, item_id = queue_item
+            with self.lock:
+                dead = worker.dead
+                if not dead:
+                    worker.current = item_id
+                    worker.prompt_id = item[1]
+                    worker.last_executing = time.monotonic()
+            if dead:
+                # the process exited while the prompt was being taken from the queue
+                self.fail(item_id)
+                break
+            worker.tasks.put(("prompt", item, item_id))
+
+    def relay(self, worker):
+        while True:
+            try:
+                message = worker.results.get(timeout=5.0)
+            except queue.Empty:
+                if worker.process.is_alive():
+                    continue
+                self.worker_died(worker)
+                return
+
+            if message[0] == "send":
+                event, data, sid = message[1:]
+                if event == "executing" and isinstance(data, dict):
+                    with self.lock:
+                        worker.last_executing = time.monotonic()
+                    self.server.send_executing(data, sid)
+                else:
+                    self.server.send_sync(event, data, sid)
+            elif message[0] == "done":
+                item_id, outputs, status, profile = message[1:]
+                if status is not None:
+                    status = execution.PromptQueue.ExecutionStatus(**status)
+                if profile is not None:
+                    profiler.history.add(profile)
+                with self.lock:
+                    worker.current = None
+                    worker.prompt_id = None
+                self.prompt_queue.task_done(item_id, outputs, status=status, profile=profile)
+                worker.idle.release()
+
+    def fail(self, item_id):
+        status = execution.PromptQueue.ExecutionStatus(status_str='error', completed=False, messages=[("execution_error", {"exception_message": "worker process exited"})])
+        self.prompt_queue.task_done(item_id, {}, status=status)
+
+    def worker_died(self, worker):
+        logging.error("Prompt worker process {} exited with code {}".format(worker.index, worker.process.exitcode))
+        with self.lock:
+            worker.dead = True
+            item_id = worker.current
+            worker.current = None
+            worker.prompt_id = None
+        if item_id is not None:
+            self.fail(item_id)
+        # lets the dispatch thread see the process is gone
+        worker.idle.release()
+
+        if time.monotonic() - worker.started < self.restart_delay:
+            time.sleep(self.restart_delay)
+        logging.info("Starting prompt worker process {} again".format(worker.index))
+        replacement = Worker(worker.index, self.context, self.target, self.args)
+        with self.lock:
+            self.workers[worker.index] = replacement
+        self.start_worker(replacement)
@@ -32,6 +32,7 @@ class Blend:
     FUNCTION = "blend_images"
 
     CATEGORY = "image/postprocessing"
+    CPU_BOUND = True
 
     def blend_images(self, image1: torch.Tensor, image2: torch.Tensor, blend_factor: float, blend_mode: str):
         image2 = image2.to(image1.device)
@@ -139,6 +140,7 @@ class Quantize:
     FUNCTION = "quantize"
 
     CATEGORY = "image/postprocessing"
+    CPU_BOUND = True
 
     def bayer(im, pal_im, order):
         def normalized_bayer_matrix(n):
@@ -257,6 +259,7 @@ class ImageScaleToTotalPixels:
     FUNCTION = "upscale"
 
     CATEGORY = "image/upscaling"
+    CPU_BOUND = True
 
     def upscale(self, image, upscale_method, megapixels):
         samples = image.movedim(-1,1)
@@ -1,19 +1,33 @@
+import os
 import sys
 import copy
+import json
+import hashlib
 import logging
 import threading
-import heapq
+import collections
 import traceback
 import inspect
+from enum import Enum
+from concurrent.futures import ThreadPoolExecutor
 from typing import List, Literal, NamedTuple, Optional
 
 import torch
 import nodes
+import folder_paths
 
 import comfy.model_management
+from comfy.cli_args import OutputReleasePolicy
+from comfy_execution import caching
+from comfy_execution import graph
+from comfy_execution import profiler
+from comfy_execution import estimator
+from comfy_execution import queue_storage
+from comfy_execution import indexed_heap
+from comfy_execution import scheduling
 
 def get_input_data(inputs, class_def, unique_id, outputs={}, prompt={}, extra_data={}):
-    valid_inputs = class_def.INPUT_TYPES()
+    valid_inputs = caching.get_input_types(class_def)
     input_data_all = {}
     for x in inputs:
         input_data = inputs[x]
@@ -46,6 +60,11 @@ def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
     if hasattr(obj, "INPUT_IS_LIST"):
         input_is_list = obj.INPUT_IS_LIST
 
+    # or has a method that gets every input as a list of the same length and returns a list of results
+    batched_func = None
+    if func == obj.FUNCTION:
+        batched_func = getattr(obj, "BATCHED_FUNCTION", None)
+
     if len(input_data_all) == 0:
         max_len_input = 0
     else:
@@ -63,6 +82,15 @@ def map_node_over_list(obj, input_data_all, func, allow_interrupt=False):
         if allow_interrupt:
             nodes.before_node_execution()
         results.append(getattr(obj, func)(**input_data_all))
+    elif batched_func is not None:
+        if allow_interrupt:
+            nodes.before_node_execution()
+        batch_size = max(max_len_input, 1)
+        padded = {k: [v[i if len(v) > i else -1] for i in range(batch_size)] for k, v in input_data_all.items()}
+        r = getattr(obj, batched_func)(**padded)
+        if len(r) != batch_size:
+            raise ValueError("{} returned {} results for a batch of {} inputs".format(batched_func, len(r), batch_size))
+        results += r
     elif max_len_input == 0:
         if allow_interrupt:
             nodes.before_node_execution()
@@ -116,30 +144,34 @@ def format_value(x):
     else:
         return str(x)
 
-def recursive_execute(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage):
+# the node each thread is running, progress is reported for it
+current_node = threading.local()
+
+# pooled output nodes run one at a time, they usually pick their file names
+# from what is already on disk
+output_node_lock = threading.Lock()
+
+def is_cpu_bound(prompt, unique_id):
+    class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+    return getattr(class_def, "CPU_BOUND", False)
+
+class ExecutionResult(Enum):
+    SUCCESS = 0
+    FAILURE = 1
+    PENDING = 2
+
+def execute_node(server, prompt, outputs, current_item, extra_data, executed, prompt_id, outputs_ui, object_storage, announce=True):
     unique_id = current_item
     inputs = prompt[unique_id]['inputs']
     class_type = prompt[unique_id]['class_type']
     class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
     if unique_id in outputs:
-        return (True, None, None)
-
-    for x in inputs:
-        input_data = inputs[x]
-
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                result = recursive_execute(server, prompt, outputs, input_unique_id, extra_data, executed, prompt_id, outputs_ui, object_storage)
-                if result[0] is not True:
-                    # Another node failed further upstream
-                    return result
+        return (ExecutionResult.SUCCESS, None, None)
 
     input_data_all = None
     try:
         input_data_all = get_input_data(inputs, class_def, unique_id, outputs, prompt, extra_data)
-        if server.client_id is not None:
+        if announce and server.client_id is not None:
             server.last_node_id = unique_id
             server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, server.client_id)
 
@@ -148,6 +180,17 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             obj = class_def()
             object_storage[(unique_id, class_type)] = obj
 
+        if hasattr(obj, "check_lazy_status"):
+            missing = [x for x in graph.get_lazy_inputs(class_def) if isinstance(inputs.get(x, None), list) and inputs[x][0] in prompt and inputs[x][0] not in outputs]
+            if len(missing) > 0:
+                needed = set()
+                for r in map_node_over_list(obj, input_data_all, "check_lazy_status", allow_interrupt=True):
+                    if isinstance(r, (list, tuple)):
+                        needed.update(r)
+                pending = [inputs[x][0] for x in missing if x in needed]
+                if len(pending) > 0:
+                    return (ExecutionResult.PENDING, pending, None)
+
         output_data, output_ui = get_output_data(obj, input_data_all)
         outputs[unique_id] = output_data
         if len(output_ui) > 0:
@@ -162,7 +205,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             "node_id": unique_id,
         }
 
-        return (False, error_details, iex)
+        return (ExecutionResult.FAILURE, error_details, iex)
     except Exception as ex:
         typ, _, tb = sys.exc_info()
         exception_type = full_type_name(typ)
@@ -173,7 +216,7 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
                 input_data_formatted[name] = [format_value(x) for x in inputs]
 
         output_data_formatted = {}
-        for node_id, node_outputs in outputs.items():
+        for node_id, node_outputs in list(outputs.items()):
             output_data_formatted[node_id] = [[format_value(x) for x in l] for l in node_outputs]
 
         logging.error(f"!!! Exception during processing!!! {ex}")
@@ -187,99 +230,116 @@ def recursive_execute(server, prompt, outputs, current_item, extra_data, execute
             "current_inputs": input_data_formatted,
             "current_outputs": output_data_formatted
         }
-        return (False, error_details, ex)
+        return (ExecutionResult.FAILURE, error_details, ex)
 
     executed.add(unique_id)
 
-    return (True, None, None)
-
-def recursive_will_execute(prompt, outputs, current_item, memo={}):
-    unique_id = current_item
-
-    if unique_id in memo:
-        return memo[unique_id]
-
-    inputs = prompt[unique_id]['inputs']
-    will_execute = []
-    if unique_id in outputs:
-        return []
-
-    for x in inputs:
-        input_data = inputs[x]
-        if isinstance(input_data, list):
-            input_unique_id = input_data[0]
-            output_index = input_data[1]
-            if input_unique_id not in outputs:
-                will_execute += recursive_will_execute(prompt, outputs, input_unique_id, memo)
+    return (ExecutionResult.SUCCESS, None, None)
+
+def delete_changed_outputs(prompt, old_prompt, outputs):
+    # nodes are visited after everything linked to their inputs, so a changed
+    # node has already been removed from outputs by the time its consumers are checked
+    for unique_id in graph.topological_sort(prompt):
+        inputs = prompt[unique_id]['inputs']
+        class_type = prompt[unique_id]['class_type']
+        class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+
+        is_changed_old = ''
+        is_changed = ''
+        to_delete = False
+        if hasattr(class_def, 'IS_CHANGED'):
+            if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
+                is_changed_old = old_prompt[unique_id]['is_changed']
+            if 'is_changed' not in prompt[unique_id]:
+                input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
+                if input_data_all is not None:
+                    try:
+                        #is_changed = class_def.IS_CHANGED(**input_data_all)
+                        is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
+                        prompt[unique_id]['is_changed'] = is_changed
+                    except:
+                        to_delete = True
+            else:
+                is_changed = prompt[unique_id]['is_changed']
 
-    memo[unique_id] = will_execute + [unique_id]
-    return memo[unique_id]
+        if unique_id not in outputs:
+            continue
 
-def recursive_output_delete_if_changed(prompt, old_prompt, outputs, current_item):
-    unique_id = current_item
-    inputs = prompt[unique_id]['inputs']
-    class_type = prompt[unique_id]['class_type']
-    class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+        if not to_delete:
+            if is_changed != is_changed_old:
+                to_delete = True
+            elif unique_id not in old_prompt:
+                to_delete = True
+            elif inputs == old_prompt[unique_id]['inputs']:
+                for x in inputs:
+                    input_data = inputs[x]
+
+                    if isinstance(input_data, list):
+                        input_unique_id = input_data[0]
+                        if input_unique_id not in outputs:
+                            to_delete = True
+                            break
+            else:
+                to_delete = True
 
-    is_changed_old = ''
-    is_changed = ''
-    to_delete = False
-    if hasattr(class_def, 'IS_CHANGED'):
-        if unique_id in old_prompt and 'is_changed' in old_prompt[unique_id]:
-            is_changed_old = old_prompt[unique_id]['is_changed']
-        if 'is_changed' not in prompt[unique_id]:
-            input_data_all = get_input_data(inputs, class_def, unique_id, outputs)
-            if input_data_all is not None:
-                try:
-                    #is_changed = class_def.IS_CHANGED(**input_data_all)
-                    is_changed = map_node_over_list(class_def, input_data_all, "IS_CHANGED")
-                    prompt[unique_id]['is_changed'] = is_changed
-                except:
-                    to_delete = True
-        else:
-            is_changed = prompt[unique_id]['is_changed']
+        if to_delete:
+            d = outputs.pop(unique_id)
+            del d
 
-    if unique_id not in outputs:
-        return True
+# outputs the "large" release policy frees, the rest is usually cheap to keep
+# and likely to be reused by the next prompt
+LARGE_OUTPUT_TYPES = ("IMAGE", "LATENT", "MASK")
 
-    if not to_delete:
-        if is_changed != is_changed_old:
-            to_delete = True
-        elif unique_id not in old_prompt:
-            to_delete = True
-        elif inputs == old_prompt[unique_id]['inputs']:
-            for x in inputs:
-                input_data = inputs[x]
-
-                if isinstance(input_data, list):
-                    input_unique_id = input_data[0]
-                    output_index = input_data[1]
-                    if input_unique_id in outputs:
-                        to_delete = recursive_output_delete_if_changed(prompt, old_prompt, outputs, input_unique_id)
-                    else:
-                        to_delete = True
-                    if to_delete:
-                        break
-        else:
-            to_delete = True
+def model_patchers(value):
+    for x in (value, getattr(value, "patcher", None), getattr(value, "control_model_wrapped", None)):
+        if x is not None and hasattr(x, "model_size") and hasattr(x, "model"):
+            yield x
 
-    if to_delete:
-        d = outputs.pop(unique_id)
-        del d
-    return to_delete
+def find_model_file(name):
+    for folder_name in folder_paths.folder_names_and_paths:
+        if folder_name in ("custom_nodes", "configs"):
+            continue
+        path = folder_paths.get_full_path(folder_name, name)
+        if path is not None:
+            return path
+    return None
 
 class PromptExecutor:
-    def __init__(self, server):
+    def __init__(self, server, lru_size=0, cpu_threads=0, release_outputs=OutputReleasePolicy.Never, cache_ram_budget=None, cache_spill_size=0, cache_spill_directory=None):
         self.server = server
+        self.lru_size = lru_size
+        self.cache_ram_budget = cache_ram_budget
+        self.cache_spill_size = cache_spill_size
+        self.cache_spill_directory = cache_spill_directory
+        self.output_cache = None
+        self.profile = None
+        comfy.model_management.set_model_load_hook(profiler.model_load_hook)
+        self.release_outputs = release_outputs
+        self.lock = threading.RLock()
+        self.cpu_pool = None
+        if cpu_threads > 0:
+            self.cpu_pool = ThreadPoolExecutor(max_workers=cpu_threads, thread_name_prefix="cpu_node")
         self.reset()
 
     def reset(self):
-        self.outputs = {}
-        self.object_storage = {}
-        self.outputs_ui = {}
-        self.status_messages = []
-        self.success = True
-        self.old_prompt = {}
+        with self.lock:
+            self.outputs = {}
+            if self.output_cache is not None:
+                self.output_cache.clear()
+            self.output_cache = None
+            if self.lru_size > 0:
+                spill = None
+                if self.cache_ram_budget is not None:
+                    directory = self.cache_spill_directory
+                    if directory is None:
+                        directory = os.path.join(folder_paths.get_temp_directory(), "output_cache")
+                    spill = caching.DiskSpillCache(directory, self.cache_spill_size)
+                self.output_cache = caching.LRUCache(self.lru_size, ram_budget=self.cache_ram_budget, spill=spill)
+            self.object_storage = {}
+            self.outputs_ui = {}
+            self.status_messages = []
+            self.success = True
+            self.old_prompt = {}
 
     def add_message(self, event, data, broadcast: bool):
         self.status_messages.append((event, data))
@@ -327,6 +387,166 @@ class PromptExecutor:
             d = self.outputs.pop(o)
             del d
 
+    def is_releasable(self, prompt, unique_id):
+        if self.release_outputs == OutputReleasePolicy.Never:
+            return False
+        if self.release_outputs == OutputReleasePolicy.Large:
+            class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+            return any(x in LARGE_OUTPUT_TYPES for x in class_def.RETURN_TYPES)
+        return True
+
+    def execute_plan(self, plan, prompt, prompt_id, extra_data, executed, on_complete=None):
+        """
+        Runs the nodes of the plan. Nodes the plan pooled (CPU_BOUND ones
+        when there is a thread pool) are handed to the pool as soon as they
+        are ready, everything else runs on this thread. Pooled nodes only
+        send "executing" while this thread is idle and leave
+        server.last_node_id alone. on_complete(unique_id, unused) is called
+        for every node that ran, with the nodes whose outputs aren't needed by
+        the plan anymore, outside the lock the nodes are dispatched under so
+        it can write to disk. Once a node fails nothing new is started, pooled
+        nodes that didn't start yet are cancelled and the first failure is
+        returned as (error, ex) once the running ones finished. Returns None
+        on success.
+        """
+        cond = threading.Condition()
+        failures = []
+        futures = {}
+        in_flight = 0
+        busy = False
+
+        def run_node(unique_id, pooled=False):
+            current_node.node_id = unique_id
+            current_node.pooled = pooled
+            try:
+                with self.profile.node(unique_id, prompt[unique_id]['class_type']) as record:
+                    result = execute_node(self.server, prompt, self.outputs, unique_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage, announce=not pooled)
+                    record["status"] = result[0].name.lower()
+                    if result[0] == ExecutionResult.SUCCESS:
+                        record["output_sizes"] = [profiler.tensor_bytes(x) for x in self.outputs.get(unique_id, [])]
+            finally:
+                current_node.node_id = None
+                current_node.pooled = False
+            return result
+
+        def finish(unique_id, result):
+            # returns the unused nodes to pass to on_complete() if it completed
+            status, details, ex = result
+            unused = None
+            if status == ExecutionResult.SUCCESS:
+                unused = plan.complete(unique_id)
+            elif status == ExecutionResult.PENDING:
+                # details are the nodes behind the lazy inputs it asked for
+                plan.add_dependencies(unique_id, details, self.outputs)
+            elif len(failures) == 0:
+                failures.append((details, ex))
+                cancel()
+            cond.notify_all()
+            return unused
+
+        def cancel():
+            nonlocal in_flight
+            for unique_id, future in list(futures.items()):
+                if future.cancel():
+                    del futures[unique_id]
+                    in_flight -= 1
+
+        def run_pooled(unique_id):
+            nonlocal in_flight
+            try:
+                with cond:
+                    if not busy and self.server.client_id is not None:
+                        self.server.send_sync("executing", { "node": unique_id, "prompt_id": prompt_id }, self.server.client_id)
+                class_def = nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]['class_type']]
+                with torch.inference_mode():
+                    if getattr(class_def, "OUTPUT_NODE", False):
+                        with output_node_lock:
+                            result = run_node(unique_id, pooled=True)
+                    else:
+                        result = run_node(unique_id, pooled=True)
+                with cond:
+                    futures.pop(unique_id, None)
+                    unused = finish(unique_id, result)
+                    dispatch()
+                if unused is not None and on_complete is not None:
+                    on_complete(unique_id, unused)
+            except Exception as ex:
+                # raised outside of execute_node's own error handling, by the profiler or on_complete
+                logging.error(f"!!! Exception while running node {unique_id} on the cpu thread pool!!! {ex}")
+                logging.error(traceback.format_exc())
+                with cond:
+                    futures.pop(unique_id, None)
+                    if len(failures) == 0:
+                        failures.append(({
+                            "node_id": unique_id,
+                            "exception_message": str(ex),
+                            "exception_type": full_type_name(type(ex)),
+                            "traceback": traceback.format_tb(ex.__traceback__),
+                            "current_inputs": {},
+                            "current_outputs": {},
+                        }, ex))
+                        cancel()
+            finally:
+                # the loop of execute_plan waits for this to reach 0
+                with cond:
+                    in_flight -= 1
+                    cond.notify_all()
+
+        def dispatch():
+            nonlocal in_flight
+            if self.cpu_pool is None or len(failures) > 0:
+                return
+            while True:
+                unique_id = plan.pop_ready(pooled=True)
+                if unique_id is None:
+                    break
+                in_flight += 1
+                futures[unique_id] = self.cpu_pool.submit(run_pooled, unique_id)
+
+        with cond:
+            while True:
+                dispatch()
+                node_id = None
+                if len(failures) == 0:
+                    node_id = plan.pop_ready()
+                if node_id is None:
+                    if in_flight == 0:
+                        break
+                    cond.wait()
+                    continue
+
+                in_flight += 1
+                busy = True
+                cond.release()
+                try:
+                    result = run_node(node_id)
+                finally:
+                    cond.acquire()
+                    in_flight -= 1
+                    busy = False
+                unused = finish(node_id, result)
+                if unused is not None and on_complete is not None:
+                    cond.release()
+                    try:
+                        on_complete(node_id, unused)
+                    finally:
+                        cond.acquire()
+
+        if len(failures) > 0:
+            return failures[0]
+        if not plan.is_finished():
+            ex = plan.blocked_error()
+            error = {
+                "node_id": ex.node_ids[0],
+                "exception_message": str(ex),
+                "exception_type": full_type_name(type(ex)),
+                "traceback": [],
+                "current_inputs": {},
+                "current_outputs": {},
+            }
+            return (error, ex)
+        return None
+
     def execute(self, prompt, prompt_id, extra_data={}, execute_outputs=[]):
         nodes.interrupt_processing(False)
 
@@ -337,71 +557,226 @@ class PromptExecutor:
 
         self.status_messages = []
         self.add_message("execution_start", { "prompt_id": prompt_id}, broadcast=False)
+        if self.profile is not None:
+            self.profile.stop()
+        self.profile = profiler.PromptProfile(prompt_id, workflow=profiler.workflow_key(prompt), features=estimator.prompt_features(prompt))
 
         with torch.inference_mode():
-            #delete cached outputs if nodes don't exist for them
-            to_delete = []
-            for o in self.outputs:
-                if o not in prompt:
-                    to_delete += [o]
-            for o in to_delete:
-                d = self.outputs.pop(o)
-                del d
-            to_delete = []
-            for o in self.object_storage:
-                if o[0] not in prompt:
-                    to_delete += [o]
-                else:
-                    p = prompt[o[0]]
-                    if o[1] != p['class_type']:
+            # plan() reads the outputs and old_prompt from the server thread
+            with self.lock:
+                #delete cached outputs if nodes don't exist for them
+                to_delete = []
+                for o in self.outputs:
+                    if o not in prompt:
                         to_delete += [o]
-            for o in to_delete:
-                d = self.object_storage.pop(o)
-                del d
-
-            for x in prompt:
-                recursive_output_delete_if_changed(prompt, self.old_prompt, self.outputs, x)
-
-            current_outputs = set(self.outputs.keys())
-            for x in list(self.outputs_ui.keys()):
-                if x not in current_outputs:
-                    d = self.outputs_ui.pop(x)
+                for o in to_delete:
+                    d = self.outputs.pop(o)
+                    del d
+                to_delete = []
+                for o in self.object_storage:
+                    if o[0] not in prompt:
+                        to_delete += [o]
+                    else:
+                        p = prompt[o[0]]
+                        if o[1] != p['class_type']:
+                            to_delete += [o]
+                for o in to_delete:
+                    d = self.object_storage.pop(o)
                     del d
 
-            comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
-            self.add_message("execution_cached",
-                          { "nodes": list(current_outputs) , "prompt_id": prompt_id},
-                          broadcast=False)
+                delete_changed_outputs(prompt, self.old_prompt, self.outputs)
+
+                #outputs of identical subgraphs from earlier prompts, whatever their node ids
+                cache_keys = None
+                restored = set()
+                if self.output_cache is not None:
+                    cache_keys = caching.CacheKeySet(prompt)
+                    for x in prompt:
+                        if x in self.outputs:
+                            continue
+                        entry = self.output_cache.get(cache_keys.get(x))
+                        if entry is not None:
+                            self.outputs[x] = entry.outputs
+                            if len(entry.ui) > 0:
+                                self.outputs_ui[x] = entry.ui
+                            restored.add(x)
+
+                current_outputs = set(self.outputs.keys())
+                for x in list(self.outputs_ui.keys()):
+                    if x not in current_outputs:
+                        d = self.outputs_ui.pop(x)
+                        del d
+
+                for x in current_outputs:
+                    self.profile.cached(x, prompt[x]['class_type'], self.outputs[x])
+
+                comfy.model_management.cleanup_models(keep_clone_weights_loaded=True)
+                self.add_message("execution_cached",
+                              { "nodes": list(current_outputs) , "prompt_id": prompt_id},
+                              broadcast=False)
             executed = set()
-            output_node_id = None
-            to_execute = []
-
-            for node_id in list(execute_outputs):
-                to_execute += [(0, node_id)]
-
-            while len(to_execute) > 0:
-                #always execute the output that depends on the least amount of unexecuted nodes first
-                memo = {}
-                to_execute = sorted(list(map(lambda a: (len(recursive_will_execute(prompt, self.outputs, a[-1], memo)), a[-1]), to_execute)))
-                output_node_id = to_execute.pop(0)[-1]
-
-                # This call shouldn't raise anything if there's an error deep in
-                # the actual SD code, instead it will report the node where the
-                # error was raised
-                self.success, error, ex = recursive_execute(self.server, prompt, self.outputs, output_node_id, extra_data, executed, prompt_id, self.outputs_ui, self.object_storage)
-                if self.success is not True:
+            pooled = None
+            if self.cpu_pool is not None:
+                pooled = lambda unique_id: is_cpu_bound(prompt, unique_id)
+            plan = graph.ExecutionPlan(prompt, self.outputs, execute_outputs, pooled=pooled)
+
+            # This call shouldn't raise anything if there's an error deep in
+            # the actual SD code, instead it will report the node where the
+            # error was raised
+            def on_complete(unique_id, unused):
+                if cache_keys is not None:
+                    self.output_cache.set(cache_keys.get(unique_id), caching.CacheEntry(self.outputs[unique_id], self.outputs_ui.get(unique_id, {})))
+                for x in unused:
+                    if x in self.outputs and self.is_releasable(prompt, x):
+                        d = self.outputs.pop(x)
+                        del d
+
+            failure = self.execute_plan(plan, prompt, prompt_id, extra_data, executed, on_complete)
+            with self.lock:
+                self.success = failure is None
+                if failure is not None:
+                    error, ex = failure
                     self.handle_execution_error(prompt_id, prompt, current_outputs, executed, error, ex)
-                    break
 
-            for x in executed:
-                self.old_prompt[x] = copy.deepcopy(prompt[x])
+                for x in executed.union(restored):
+                    self.old_prompt[x] = copy.deepcopy(prompt[x])
+
+                if cache_keys is not None and self.output_cache.spill is not None:
+                    # the cache decides which of these stay in memory, don't pin them here too.
+                    # They are restored by key on the next prompt.
+                    for x in list(self.outputs):
+                        key = cache_keys.get(x)
+                        if key in self.output_cache and self.output_cache.is_spillable(key):
+                            d = self.outputs.pop(x)
+                            del d
             self.server.last_node_id = None
+            self.profile.stop()
+            profiler.history.add(self.profile.as_dict())
             if comfy.model_management.DISABLE_SMART_MEMORY:
                 comfy.model_management.unload_all_models()
 
+    def plan(self, prompt, execute_outputs):
+        """
+        Works out what execute() would do with a validated prompt if it was
+        run right now, without running anything: the nodes that would be
+        executed and the ones that would come from the cache, the models that
+        would have to be loaded or evicted and the cost of each node estimated
+        from the profiles of earlier prompts. It only reads the executor
+        state, under its lock, so it can run on another thread than the prompt
+        worker. It calls IS_CHANGED and stats model files, so keep it off the
+        event loop.
+        """
+        prompt = copy.deepcopy(prompt)
+        with self.lock:
+            outputs = {x: v for x, v in dict(self.outputs).items() if x in prompt}
+            old_prompt = dict(self.old_prompt)
+            output_cache = self.output_cache
+        delete_changed_outputs(prompt, old_prompt, outputs)
+        cached = dict.fromkeys(outputs, "outputs")
+
+        if output_cache is not None:
+            cache_keys = caching.CacheKeySet(prompt)
+            for x in prompt:
+                if x in cached:
+                    continue
+                entry = output_cache.peek(cache_keys.get(x))
+                if entry is not None:
+                    outputs[x] = entry.outputs
+                    cached[x] = "lru"
+
+        plan = graph.ExecutionPlan(prompt, outputs, execute_outputs)
+
+        # nodes behind lazy inputs only run if the node asks for them
+        needed = set()
+        to_visit = list(execute_outputs)
+        while len(to_visit) > 0:
+            unique_id = to_visit.pop()
+            if unique_id in needed or unique_id not in prompt:
+                continue
+            needed.add(unique_id)
+            if unique_id not in outputs:
+                to_visit += graph.get_input_links(prompt[unique_id])
+
+        loaded = list(comfy.model_management.current_loaded_models)
+        used_by = {}
+        result_nodes = {}
+        loads = []
+        duration = 0.0
+        peak_memory = 0
+        unknown = []
+        for unique_id in needed:
+            class_type = prompt[unique_id]['class_type']
+            class_def = nodes.NODE_CLASS_MAPPINGS[class_type]
+            if unique_id in cached:
+                result_nodes[unique_id] = {"class_type": class_type, "status": "cached", "cache": cached[unique_id], "estimate": None}
+                for slot in outputs[unique_id] or []:
+                    for value in slot:
+                        for patcher in model_patchers(value):
+                            for i, m in enumerate(loaded):
+                                if m.model.model is patcher.model:
+                                    used_by.setdefault(i, []).append(unique_id)
+                continue
+
+            status = "execute" if unique_id in plan.order else "lazy"
+            estimate = profiler.history.get(class_type)
+            result_nodes[unique_id] = {"class_type": class_type, "status": status, "cache": None, "estimate": estimate}
+            if status == "execute":
+                if estimate is None:
+                    unknown.append(unique_id)
+                else:
+                    duration += estimate["duration"]
+                    peak_memory = max(peak_memory, estimate["peak_memory"])
+
+            if any(x in graph.MODEL_OUTPUT_TYPES for x in class_def.RETURN_TYPES):
+                files = []
+                for name, value in graph.get_model_inputs(prompt[unique_id]):
+                    path = find_model_file(value)
+                    if path is not None:
+                        files.append({"name": value, "size": os.path.getsize(path)})
+                loads.append({"node_id": unique_id, "class_type": class_type, "status": status, "files": files})
+
+        # same order free_memory() unloads in
+        device = comfy.model_management.get_torch_device()
+        memory_required = sum(f["size"] for x in loads if x["status"] == "execute" for f in x["files"])
+        evict = []
+        if memory_required > 0:
+            memory_required += comfy.model_management.minimum_inference_memory()
+            free = comfy.model_management.get_free_memory(device)
+            can_unload = []
+            for i in range(len(loaded) - 1, -1, -1):
+                if loaded[i].device == device and i not in used_by:
+                    can_unload.append((sys.getrefcount(loaded[i].model), loaded[i].model_memory(), i))
+            for x in sorted(can_unload):
+                if free > memory_required:
+                    break
+                free += x[1]
+                evict.append(x[2])
+
+        def describe(i):
+            m = loaded[i]
+            return {"model": type(m.model.model).__name__, "size": m.model_memory(), "device": str(m.device), "used_by": used_by.get(i, [])}
+
+        return {
+            "nodes": result_nodes,
+            "order": sorted(plan.order, key=lambda a: plan.order[a]),
+            "models": {
+                "loaded": [describe(i) for i in range(len(loaded))],
+                "load": loads,
+                "evict": [describe(i) for i in evict],
+                "memory_required": memory_required,
+            },
+            "estimate": {
+                "duration": duration,
+                "peak_memory": peak_memory,
+                "unknown_nodes": unknown,
+            },
+        }
+
 
 
-def validate_inputs(prompt, item, validated):
+validation_cache = caching.ValidationCache()
+
+def validate_inputs(prompt, item, validated, cache_keys=None):
     unique_id = item
     if unique_id in validated:
         return validated[unique_id]
@@ -410,9 +785,27 @@ def validate_inputs(prompt, item, validated):
     class_type = prompt[unique_id]['class_type']
     obj_class = nodes.NODE_CLASS_MAPPINGS[class_type]
 
-    class_inputs = obj_class.INPUT_TYPES()
+    class_inputs = caching.get_input_types(obj_class)
     required_inputs = class_inputs['required']
 
+    key = None
+    # VALIDATE_INPUTS can depend on anything, like files or remote state, so
+    # nodes that define it are validated every time
+    if cache_keys is not None and not hasattr(obj_class, "VALIDATE_INPUTS"):
+        key = cache_keys.get(unique_id)
+        converted = validation_cache.get(key)
+        if converted is not None:
+            # same subgraph as one that passed before, only the linked nodes need a look
+            try:
+                hit = all(validate_inputs(prompt, inputs[x][0], validated, cache_keys)[0] is True for x in required_inputs if isinstance(inputs.get(x, None), list))
+            except Exception:
+                hit = False
+            if hit:
+                inputs.update(converted)
+                ret = (True, [], unique_id)
+                validated[unique_id] = ret
+                return ret
+
     errors = []
     valid = True
 
@@ -471,7 +864,7 @@ def validate_inputs(prompt, item, validated):
                 errors.append(error)
                 continue
             try:
-                r = validate_inputs(prompt, o_id, validated)
+                r = validate_inputs(prompt, o_id, validated, cache_keys)
                 if r[0] is False:
                     # `r` will be set in `validated[o_id]` already
                     valid = False
@@ -551,6 +944,10 @@ def validate_inputs(prompt, item, validated):
 
             if x not in validate_function_inputs:
                 if isinstance(type_input, list):
+                    if val not in type_input:
+                        # the file might have been added since the folders were last checked
+                        folder_paths.get_cache_generation(max_age=0)
+                        type_input = caching.get_input_types(obj_class)['required'][x][0]
                     if val not in type_input:
                         input_config = info
                         list_info = ""
@@ -609,6 +1006,7 @@ def validate_inputs(prompt, item, validated):
         ret = (False, errors, unique_id)
     else:
         ret = (True, [], unique_id)
+        validation_cache.set(key, {x: v for x, v in inputs.items() if not isinstance(v, list)})
 
     validated[unique_id] = ret
     return ret
@@ -658,11 +1056,12 @@ def validate_prompt(prompt):
     errors = []
     node_errors = {}
     validated = {}
+    cache_keys = caching.CacheKeySet(prompt, is_changed=False)
     for o in outputs:
         valid = False
         reasons = []
         try:
-            m = validate_inputs(prompt, o, validated)
+            m = validate_inputs(prompt, o, validated, cache_keys)
             valid = m[0]
             reasons = m[1]
         except Exception as ex:
@@ -728,37 +1127,223 @@ def validate_prompt(prompt):
     return (True, None, list(good_outputs), node_errors)
 
 MAXIMUM_HISTORY_SIZE = 10000
+MAXIMUM_QUEUE_CHANGES = 10000
+
+# extra_data that only says who sent a prompt, not what it does
+DEDUPLICATE_IGNORED_EXTRA_DATA = ("client_id", "user_id", "deadline")
+
+def deduplicate_key(item):
+    """
+    Queue items with the same key run the same nodes with the same inputs.
+    None for items that can give different outputs every time they run: the
+    ones with nodes that define IS_CHANGED (it can return NaN to always run)
+    or aren't idempotent.
+    """
+    for node in item[2].values():
+        class_def = nodes.NODE_CLASS_MAPPINGS.get(node["class_type"], None)
+        if class_def is None or hasattr(class_def, "IS_CHANGED") or not caching.is_idempotent(class_def):
+            return None
+    extra_data = {k: v for k, v in item[3].items() if k not in DEDUPLICATE_IGNORED_EXTRA_DATA}
+    data = json.dumps([item[2], sorted(item[4]), extra_data], sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha256(data.encode("utf-8")).hexdigest()
 
 class PromptQueue:
-    def __init__(self, server):
+    def __init__(self, server, storage=None, policy=None, deduplicate=False):
         self.server = server
         self.mutex = threading.RLock()
         self.not_empty = threading.Condition(self.mutex)
         self.task_counter = 0
-        self.queue = []
+        self.queue = indexed_heap.IndexedHeap(lambda a: a[1])
         self.currently_running = {}
-        self.history = {}
+        if storage is None:
+            storage = queue_storage.MemoryStorage()
+        self.storage = storage
+        if policy is None:
+            policy = scheduling.FIFOPolicy()
+        self.policy = policy
         self.flags = {}
+        # called with (name, data) for every flag set, for whatever runs prompts besides the local worker
+        self.flag_listeners = []
+        # a prompt identical to one that is queued or running isn't queued, it follows that one and gets its outputs
+        self.deduplicate = deduplicate
+        self.leaders = {}
+        self.leader_keys = {}
+        self.follower_leaders = {}
+        # the "executed" messages running leaders sent, for the items that follow them later
+        self.leader_outputs = {}
+        # every change to the queue gets a version so clients can ask for what changed since the one they have
+        self.version = 0
+        self.changes = collections.deque(maxlen=MAXIMUM_QUEUE_CHANGES)
         server.prompt_queue = self
 
+    def record_change(self, op, prompt_id=None, number=None):
+        self.version += 1
+        self.changes.append({"version": self.version, "op": op, "prompt_id": prompt_id, "number": number})
+
+    def restore(self):
+        """
+        Queues again the prompts the storage kept from before a restart. The
+        ones that don't validate anymore go to the history as failed.
+        """
+        with self.mutex:
+            for item in self.storage.load_pending():
+                valid = validate_prompt(item[2])
+                if not valid[0]:
+                    logging.warning("Dropping queued prompt {} that no longer validates: {}".format(item[1], valid[1]))
+                    self.storage.remove_pending(item[1])
+                    status = PromptQueue.ExecutionStatus(status_str='error', completed=False, messages=[("execution_error", {"prompt_id": item[1], "exception_message": valid[1]["message"]})])
+                    self.storage.add_history(item[1], {
+                        "prompt": item,
+                        "outputs": {},
+                        'status': status._asdict(),
+                        'profile': None,
+                    }, MAXIMUM_HISTORY_SIZE)
+                    continue
+                self.enqueue(item)
+                if item[0] >= self.server.number:
+                    self.server.number = int(item[0]) + 1
+            if len(self.queue) > 0:
+                logging.info("Restored {} queued prompts".format(len(self.queue)))
+                self.server.queue_updated()
+                self.not_empty.notify()
+
     def put(self, item):
+        """
+        Queues an item, returns the prompt_id of the item it follows if an
+        identical one is already queued or running.
+        """
         with self.mutex:
-            heapq.heappush(self.queue, item)
+            leader = self.enqueue(item)
+            # after the policy saw it, it can add to extra_data
+            self.storage.add_pending(item)
             self.server.queue_updated()
             self.not_empty.notify()
+            return leader
+
+    def enqueue(self, item):
+        key = deduplicate_key(item) if self.deduplicate else None
+        if key is not None:
+            leader = self.leaders.get(key, None)
+            if leader is not None:
+                self.leader_keys[leader][1].append(item)
+                self.follower_leaders[item[1]] = leader
+                self.record_change("deduplicated", item[1], item[0])
+                queued = self.queue.get(leader)
+                if queued is not None and item[0] < queued[0]:
+                    # the follower was sent ahead of the one it follows
+                    self.set_priority(leader, item[0])
+                client_id = item[3].get("client_id", None)
+                if client_id is not None:
+                    # under the mutex so the messages of the leader that come later aren't sent twice
+                    for data in self.leader_outputs.get(leader, []):
+                        self.server.send_sync("executed", dict(data, prompt_id=item[1]), client_id)
+                return leader
+            self.leaders[key] = item[1]
+            self.leader_keys[item[1]] = (key, [])
+        self.queue.push(item)
+        self.policy.added(item)
+        self.record_change("add", item[1], item[0])
+        return None
+
+    def get_leader(self, item):
+        """
+        The prompt_id of the queued or running item put() would make this one
+        follow, if any.
+        """
+        if not self.deduplicate:
+            return None
+        key = deduplicate_key(item)
+        if key is None:
+            return None
+        with self.mutex:
+            return self.leaders.get(key, None)
+
+    def get_followers(self, prompt_id, executed=None):
+        """
+        The (prompt_id, client_id) of the items that follow the one with this
+        prompt_id. executed is the data of an "executed" message of that
+        item, it is sent again to the items that start following it later.
+        """
+        with self.mutex:
+            entry = self.leader_keys.get(prompt_id, None)
+            if entry is None:
+                return []
+            if executed is not None:
+                self.leader_outputs.setdefault(prompt_id, []).append(executed)
+            return [(x[1], x[3].get("client_id", None)) for x in entry[1]]
+
+    def release(self, prompt_id):
+        """
+        Called when an item is removed from the queue without running: the
+        first of its followers is queued in its place.
+        """
+        self.leader_outputs.pop(prompt_id, None)
+        entry = self.leader_keys.pop(prompt_id, None)
+        if entry is None:
+            return
+        key, followers = entry
+        del self.leaders[key]
+        if len(followers) == 0:
+            return
+        leader = followers[0]
+        number = min(x[0] for x in followers)
+        if number < leader[0]:
+            # keep the place of the follower that was sent the furthest ahead
+            leader = (number,) + tuple(leader[1:])
+            self.storage.add_pending(leader)
+        self.leaders[key] = leader[1]
+        self.leader_keys[leader[1]] = (key, followers[1:])
+        del self.follower_leaders[leader[1]]
+        for x in followers[1:]:
+            self.follower_leaders[x[1]] = leader[1]
+        self.queue.push(leader)
+        self.policy.added(leader)
+        self.record_change("add", leader[1], leader[0])
+
+    def select(self):
+        if len(self.queue) == 0:
+            return None
+        return self.policy.select(self.queue)
 
     def get(self, timeout=None):
         with self.not_empty:
-            while len(self.queue) == 0:
+            prompt_id = self.select()
+            while prompt_id is None:
                 self.not_empty.wait(timeout=timeout)
-                if timeout is not None and len(self.queue) == 0:
+                prompt_id = self.select()
+                if timeout is not None and prompt_id is None:
                     return None
-            item = heapq.heappop(self.queue)
-            i = self.task_counter
-            self.currently_running[i] = copy.deepcopy(item)
-            self.task_counter += 1
-            self.server.queue_updated()
-            return (item, i)
+            return self.start(prompt_id)
+
+    def get_preempting(self, number):
+        """
+        Like get() but only returns the item the policy picks if it was sent
+        to the front of the queue (a negative number) ahead of an item with
+        this number, without waiting.
+        """
+        with self.mutex:
+            # the policies pick from the whole queue, only ask them when something was sent to the front
+            if len(self.queue) == 0 or not self.queue.peek()[0] < min(number, 0):
+                return None
+            prompt_id = self.select()
+            if prompt_id is None:
+                return None
+            item_number = self.queue.get(prompt_id)[0]
+            if not item_number < min(number, 0):
+                return None
+            return self.start(prompt_id)
+
+    def start(self, prompt_id):
+        item = self.queue.remove(prompt_id)
+        self.policy.started(item)
+        i = self.task_counter
+        # the worker gets its own copy to modify, the queued one is what /queue reports
+        self.currently_running[i] = item
+        self.storage.set_running(item[1])
+        self.record_change("running", item[1])
+        self.task_counter += 1
+        self.server.queue_updated()
+        return (copy.deepcopy(item), i)
 
     class ExecutionStatus(NamedTuple):
         status_str: Literal['success', 'error']
@@ -766,29 +1351,98 @@ class PromptQueue:
         messages: List[str]
 
     def task_done(self, item_id, outputs,
-                  status: Optional['PromptQueue.ExecutionStatus']):
+                  status: Optional['PromptQueue.ExecutionStatus'], profile=None):
         with self.mutex:
             prompt = self.currently_running.pop(item_id)
-            if len(self.history) > MAXIMUM_HISTORY_SIZE:
-                self.history.pop(next(iter(self.history)))
+            self.policy.finished(prompt)
+            # the policy might have been holding back items because of this one
+            self.not_empty.notify()
 
             status_dict: Optional[dict] = None
             if status is not None:
                 status_dict = copy.deepcopy(status._asdict())
 
-            self.history[prompt[1]] = {
+            self.record_change("done", prompt[1])
+            self.storage.add_history(prompt[1], {
                 "prompt": prompt,
                 "outputs": copy.deepcopy(outputs),
                 'status': status_dict,
-            }
+                'profile': profile,
+            }, MAXIMUM_HISTORY_SIZE)
+
+            self.leader_outputs.pop(prompt[1], None)
+            entry = self.leader_keys.pop(prompt[1], None)
+            if entry is not None:
+                key, followers = entry
+                del self.leaders[key]
+                for item in followers:
+                    del self.follower_leaders[item[1]]
+                    self.record_change("done", item[1])
+                    self.storage.add_history(item[1], {
+                        "prompt": item,
+                        "outputs": copy.deepcopy(outputs),
+                        'status': status_dict,
+                        'profile': None,
+                        'deduplicated': prompt[1],
+                    }, MAXIMUM_HISTORY_SIZE)
+                    if item[3].get("client_id", None) is not None:
+                        self.server.send_sync("executing", { "node": None, "prompt_id": item[1] }, item[3]["client_id"])
             self.server.queue_updated()
 
+    def requeue(self, item_id):
+        """
+        Puts a running item back in the queue, for prompts whose worker went
+        away before finishing them.
+        """
+        with self.mutex:
+            item = self.currently_running.pop(item_id)
+            self.policy.finished(item)
+            # it runs again from the start
+            self.leader_outputs.pop(item[1], None)
+            self.queue.push(item)
+            self.policy.added(item)
+            self.storage.add_pending(item)
+            self.record_change("add", item[1], item[0])
+            self.server.queue_updated()
+            self.not_empty.notify()
+
     def get_current_queue(self):
         with self.mutex:
+            return (list(self.currently_running.values()), list(self.queue))
+
+    def get_queue_page(self, offset=0, limit=100):
+        """
+        The running items and the pending items from offset to offset + limit
+        sorted by number, with the number of pending items and the current
+        version. That is the order they run in with the fifo policy, the other
+        policies pick from the whole queue when a prompt finishes.
+        """
+        with self.mutex:
+            return (list(self.currently_running.values()), self.queue.smallest(limit, offset), len(self.queue), self.version)
+
+    def get_scheduling_info(self):
+        with self.mutex:
+            return self.policy.describe()
+
+    def get_changes(self, since):
+        """
+        The changes made to the queue after version since, oldest first, or
+        None if they are too old to be known and the whole queue has to be
+        fetched again. Added items that are still pending come with the item.
+        """
+        with self.mutex:
+            if since >= self.version:
+                return (self.version, [])
+            if len(self.changes) == 0 or self.changes[0]["version"] > since + 1:
+                return (self.version, None)
             out = []
-            for x in self.currently_running.values():
-                out += [x]
-            return (out, copy.deepcopy(self.queue))
+            for x in self.changes:
+                if x["version"] > since:
+                    x = dict(x)
+                    if x["op"] == "add":
+                        x["item"] = self.queue.get(x["prompt_id"])
+                    out.append(x)
+            return (self.version, out)
 
     def get_tasks_remaining(self):
         with self.mutex:
@@ -796,52 +1450,94 @@ class PromptQueue:
 
     def wipe_queue(self):
         with self.mutex:
-            self.queue = []
+            for item in self.queue:
+                self.policy.forget(item[1])
+            self.queue.clear()
+            # the followers of running items go too, the running ones keep their keys
+            running = set(x[1] for x in self.currently_running.values())
+            for leader in list(self.leader_keys):
+                if leader in running:
+                    self.leader_keys[leader][1].clear()
+                else:
+                    del self.leaders[self.leader_keys.pop(leader)[0]]
+            self.follower_leaders.clear()
+            self.storage.clear_pending()
+            self.record_change("clear")
             self.server.queue_updated()
 
     def delete_queue_item(self, function):
         with self.mutex:
-            for x in range(len(self.queue)):
-                if function(self.queue[x]):
-                    if len(self.queue) == 1:
-                        self.wipe_queue()
-                    else:
-                        self.queue.pop(x)
-                        heapq.heapify(self.queue)
-                    self.server.queue_updated()
-                    return True
+            for item in self.queue:
+                if function(item):
+                    return self.delete_queue_items([item[1]]) > 0
         return False
 
+    def delete_queue_items(self, prompt_ids):
+        with self.mutex:
+            deleted = 0
+            for prompt_id in prompt_ids:
+                item = self.queue.remove(prompt_id)
+                if item is not None:
+                    self.policy.forget(prompt_id)
+                    self.storage.remove_pending(prompt_id)
+                    self.record_change("remove", prompt_id)
+                    self.release(prompt_id)
+                    deleted += 1
+                elif prompt_id in self.follower_leaders:
+                    followers = self.leader_keys[self.follower_leaders.pop(prompt_id)][1]
+                    followers[:] = [x for x in followers if x[1] != prompt_id]
+                    self.storage.remove_pending(prompt_id)
+                    self.record_change("remove", prompt_id)
+                    deleted += 1
+            if deleted > 0:
+                self.server.queue_updated()
+            return deleted
+
+    def set_priority(self, prompt_id, number):
+        """
+        Gives a pending item a new number, lower numbers run first.
+        """
+        with self.mutex:
+            item = self.queue.get(prompt_id)
+            if item is None:
+                return False
+            item = (number,) + tuple(item[1:])
+            self.queue.update(item)
+            self.policy.forget(prompt_id)
+            self.policy.added(item)
+            self.storage.add_pending(item)
+            self.record_change("priority", prompt_id, number)
+            self.server.queue_updated()
+            return True
+
+    def move_to_front(self, prompt_id):
+        with self.mutex:
+            if prompt_id not in self.queue:
+                return False
+            return self.set_priority(prompt_id, self.queue.peek()[0] - 1)
+
     def get_history(self, prompt_id=None, max_items=None, offset=-1):
         with self.mutex:
             if prompt_id is None:
-                out = {}
-                i = 0
-                if offset < 0 and max_items is not None:
-                    offset = len(self.history) - max_items
-                for k in self.history:
-                    if i >= offset:
-                        out[k] = self.history[k]
-                        if max_items is not None and len(out) >= max_items:
-                            break
-                    i += 1
-                return out
-            elif prompt_id in self.history:
-                return {prompt_id: copy.deepcopy(self.history[prompt_id])}
-            else:
+                return self.storage.list_history(max_items=max_items, offset=offset)
+            entry = self.storage.get_history(prompt_id)
+            if entry is None:
                 return {}
+            return {prompt_id: entry}
 
     def wipe_history(self):
         with self.mutex:
-            self.history = {}
+            self.storage.clear_history()
 
     def delete_history_item(self, id_to_delete):
         with self.mutex:
-            self.history.pop(id_to_delete, None)
+            self.storage.delete_history(id_to_delete)
 
     def set_flag(self, name, data):
         with self.mutex:
             self.flags[name] = data
+            for listener in self.flag_listeners:
+                listener(name, data)
             self.not_empty.notify()
 
     def get_flags(self, reset=True):
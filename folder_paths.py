@@ -41,6 +41,12 @@ user_directory = os.path.join(os.path.dirname(os.path.realpath(__file__)), "user
 
 filename_list_cache = {}
 
+# bumped whenever the model/input folders or the registered nodes may have
+# changed, anything derived from them (like INPUT_TYPES) is cached against it
+cache_generation = 0
+cache_generation_checked = None
+cache_generation_mtimes = {}
+
 if not os.path.exists(input_directory):
     try:
         os.makedirs(input_directory)
@@ -50,14 +56,17 @@ if not os.path.exists(input_directory):
 def set_output_directory(output_dir):
     global output_directory
     output_directory = output_dir
+    invalidate_cache()
 
 def set_temp_directory(temp_dir):
     global temp_directory
     temp_directory = temp_dir
+    invalidate_cache()
 
 def set_input_directory(input_dir):
     global input_directory
     input_directory = input_dir
+    invalidate_cache()
 
 def get_output_directory():
     global output_directory
@@ -129,6 +138,7 @@ def add_model_folder_path(folder_name, full_folder_path):
         folder_names_and_paths[folder_name][0].append(full_folder_path)
     else:
         folder_names_and_paths[folder_name] = ([full_folder_path], set())
+    invalidate_cache()
 
 def get_folder_paths(folder_name):
     return folder_names_and_paths[folder_name][0][:]
@@ -227,6 +237,41 @@ def get_filename_list(folder_name):
         filename_list_cache[folder_name] = out
     return list(out[0])
 
+def invalidate_cache():
+    global cache_generation
+    cache_generation += 1
+
+def watched_directories_():
+    dirs = set([get_input_directory()])
+    for x in folder_names_and_paths.values():
+        dirs.update(x[0])
+    for x in list(filename_list_cache.values()):
+        dirs.update(x[1])
+    return dirs
+
+def get_cache_generation(max_age=1.0):
+    """
+    Returns a number that changes when the files in the model or input
+    folders may have changed. The directory mtimes are checked at most once
+    every max_age seconds, call invalidate_cache() after writing to them to
+    make the change visible right away.
+    """
+    global cache_generation_checked
+    global cache_generation_mtimes
+    now = time.monotonic()
+    if cache_generation_checked is None or now - cache_generation_checked >= max_age:
+        cache_generation_checked = now
+        mtimes = {}
+        for x in watched_directories_():
+            try:
+                mtimes[x] = os.path.getmtime(x)
+            except OSError:
+                pass
+        if mtimes != cache_generation_mtimes:
+            cache_generation_mtimes = mtimes
+            invalidate_cache()
+    return cache_generation
+
 def get_save_image_path(filename_prefix, output_dir, image_width=0, image_height=0):
     def map_filename(filename):
         prefix_len = len(os.path.basename(filename_prefix))
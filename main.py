@@ -51,9 +51,10 @@ import asyncio
 import itertools
 import shutil
 import threading
+import socket
 import gc
 
-from comfy.cli_args import args
+from comfy.cli_args import args, QueuePolicy
 import logging
 
 if os.name == "nt":
@@ -74,8 +75,16 @@ import comfy.utils
 import yaml
 
 import execution
+from comfy_execution import queue_storage
+from comfy_execution import scheduling
+from comfy_execution import workers
+from comfy_execution import broker
+from comfy_execution import admission
+from comfy_execution import preemption as preemption_module
+from comfy_execution import profiler
+from comfy_execution import estimator
 import server
-from server import BinaryEventTypes
+from server import BinaryEventTypes, encode_preview_image
 from nodes import init_custom_nodes
 import comfy.model_management
 
@@ -90,8 +99,36 @@ def cuda_malloc_warning():
         if cuda_malloc_warning:
             logging.warning("\nWARNING: this card most likely does not support cuda-malloc, if you get \"CUDA error\" please run ComfyUI with: --disable-cuda-malloc\n")
 
-def prompt_worker(q, server):
-    e = execution.PromptExecutor(server)
+def create_executor(server, cache_spill_directory=None):
+    cache_ram_budget = None
+    if args.cache_ram_budget is not None:
+        cache_ram_budget = round(args.cache_ram_budget * 1024 * 1024)
+    return execution.PromptExecutor(server, lru_size=args.cache_lru, cpu_threads=args.cpu_node_threads, release_outputs=args.release_outputs,
+                                    cache_ram_budget=cache_ram_budget, cache_spill_size=round(args.cache_spill_size * 1024 * 1024),
+                                    cache_spill_directory=cache_spill_directory)
+
+def execute_item(q, server, e, item, item_id):
+    execution_start_time = time.perf_counter()
+    prompt_id = item[1]
+    server.last_prompt_id = prompt_id
+
+    e.execute(item[2], prompt_id, item[3], item[4])
+    q.task_done(item_id,
+                e.outputs_ui,
+                status=execution.PromptQueue.ExecutionStatus(
+                    status_str='success' if e.success else 'error',
+                    completed=e.success,
+                    messages=e.status_messages),
+                profile=e.profile.as_dict())
+    if server.client_id is not None:
+        server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
+
+    execution_time = time.perf_counter() - execution_start_time
+    logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
+
+def prompt_worker(q, server, cache_spill_directory=None, preemption=None):
+    e = create_executor(server, cache_spill_directory)
+    server.prompt_executor = e
     last_gc_collect = 0
     need_gc = False
     gc_collect_interval = 10.0
@@ -104,24 +141,15 @@ def prompt_worker(q, server):
         queue_item = q.get(timeout=timeout)
         if queue_item is not None:
             item, item_id = queue_item
-            execution_start_time = time.perf_counter()
-            prompt_id = item[1]
-            server.last_prompt_id = prompt_id
-
-            e.execute(item[2], prompt_id, item[3], item[4])
+            if preemption is not None:
+                preemption.started(item)
+            try:
+                execute_item(q, server, e, item, item_id)
+            finally:
+                if preemption is not None:
+                    preemption.finished()
             need_gc = True
-            q.task_done(item_id,
-                        e.outputs_ui,
-                        status=execution.PromptQueue.ExecutionStatus(
-                            status_str='success' if e.success else 'error',
-                            completed=e.success,
-                            messages=e.status_messages))
-            if server.client_id is not None:
-                server.send_sync("executing", { "node": None, "prompt_id": prompt_id }, server.client_id)
-
             current_time = time.perf_counter()
-            execution_time = current_time - execution_start_time
-            logging.info("Prompt executed in {:.2f} seconds".format(execution_time))
 
         flags = q.get_flags()
         free_memory = flags.get("free_memory", False)
@@ -149,14 +177,18 @@ async def run(server, address='', port=8188, verbose=True, call_on_start=None):
     await asyncio.gather(server.start(address, port, verbose, call_on_start), server.publish_loop())
 
 
-def hijack_progress(server):
+def hijack_progress(server, preemption=None):
     def hook(value, total, preview_image):
         comfy.model_management.throw_exception_if_processing_interrupted()
-        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": server.last_node_id}
+        # nodes on the cpu thread pool report progress for themselves
+        node_id = getattr(execution.current_node, "node_id", None) or server.last_node_id
+        progress = {"value": value, "max": total, "prompt_id": server.last_prompt_id, "node": node_id}
 
         server.send_sync("progress", progress, server.client_id)
         if preview_image is not None:
             server.send_sync(BinaryEventTypes.UNENCODED_PREVIEW_IMAGE, preview_image, server.client_id)
+        if preemption is not None and not getattr(execution.current_node, "pooled", False):
+            preemption.check()
     comfy.utils.set_progress_bar_global_hook(hook)
 
 
@@ -186,6 +218,47 @@ def load_extra_path_config(yaml_path):
                 logging.info("Adding extra search path {} {}".format(x, full_path))
                 folder_paths.add_model_folder_path(x, full_path)
 
+def load_extra_model_paths():
+    extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
+    if os.path.isfile(extra_model_paths_config_path):
+        load_extra_path_config(extra_model_paths_config_path)
+
+    if args.extra_model_paths_config:
+        for config_path in itertools.chain(*args.extra_model_paths_config):
+            load_extra_path_config(config_path)
+
+def apply_directory_args():
+    if args.output_directory:
+        output_dir = os.path.abspath(args.output_directory)
+        logging.info(f"Setting output directory to: {output_dir}")
+        folder_paths.set_output_directory(output_dir)
+
+    #These are the default folders that checkpoints, clip and vae models will be saved to when using CheckpointSave, etc.. nodes
+    folder_paths.add_model_folder_path("checkpoints", os.path.join(folder_paths.get_output_directory(), "checkpoints"))
+    folder_paths.add_model_folder_path("clip", os.path.join(folder_paths.get_output_directory(), "clip"))
+    folder_paths.add_model_folder_path("vae", os.path.join(folder_paths.get_output_directory(), "vae"))
+
+    if args.input_directory:
+        input_dir = os.path.abspath(args.input_directory)
+        logging.info(f"Setting input directory to: {input_dir}")
+        folder_paths.set_input_directory(input_dir)
+
+def worker_process(index, tasks, results, interrupt, threads):
+    # entry point of the --workers processes, they load the nodes on their own and get prompts from the main process
+    import torch
+    torch.set_num_threads(threads)
+    if args.temp_directory:
+        folder_paths.set_temp_directory(os.path.join(os.path.abspath(args.temp_directory), "temp"))
+    load_extra_model_paths()
+    init_custom_nodes()
+    apply_directory_args()
+
+    server = workers.WorkerServer(results)
+    hijack_progress(server)
+    threading.Thread(target=workers.watch_interrupt, args=(interrupt, comfy.model_management.interrupt_current_processing), daemon=True).start()
+    logging.info("Prompt worker {} started with {} torch threads".format(index, threads))
+    prompt_worker(workers.WorkerQueue(tasks, results), server, os.path.join(folder_paths.get_temp_directory(), "output_cache", "worker_{}".format(index)))
+
 
 if __name__ == "__main__":
     if args.temp_directory:
@@ -204,39 +277,72 @@ if __name__ == "__main__":
     loop = asyncio.new_event_loop()
     asyncio.set_event_loop(loop)
     server = server.PromptServer(loop)
-    q = execution.PromptQueue(server)
-
-    extra_model_paths_config_path = os.path.join(os.path.dirname(os.path.realpath(__file__)), "extra_model_paths.yaml")
-    if os.path.isfile(extra_model_paths_config_path):
-        load_extra_path_config(extra_model_paths_config_path)
-
-    if args.extra_model_paths_config:
-        for config_path in itertools.chain(*args.extra_model_paths_config):
-            load_extra_path_config(config_path)
+    storage = None
+    if args.queue_db is not None:
+        storage = queue_storage.SQLiteStorage(args.queue_db)
+    runtime_estimator = estimator.RuntimeEstimator(os.path.join(folder_paths.user_directory, "runtime_estimates.json"))
+    profiler.history.listeners.append(runtime_estimator.add)
+    estimate = lambda item: runtime_estimator.predict_prompt(item[2])
+
+    policy = None
+    if args.queue_policy == QueuePolicy.ModelAffinity:
+        policy = scheduling.ModelAffinityPolicy(window=args.affinity_window, max_skips=args.affinity_max_skips)
+    elif args.queue_policy == QueuePolicy.Fair:
+        policy = scheduling.FairPolicy(weights=dict(args.fair_weights), max_running=dict(args.fair_max_running))
+    elif args.queue_policy == QueuePolicy.ShortestJob:
+        policy = scheduling.ShortestJobPolicy(estimate, max_wait=args.sjf_max_wait)
+    elif args.queue_policy == QueuePolicy.Deadline:
+        policy = scheduling.DeadlinePolicy(estimate, default_deadline=args.default_deadline)
+    q = execution.PromptQueue(server, storage, policy, deduplicate=args.enable_prompt_deduplication)
+
+    def parallelism():
+        if server.broker is not None:
+            return args.workers + len(server.broker.workers)
+        return args.workers
+    server.admission = admission.AdmissionControl(q, max_queue=args.max_queue, max_per_owner=args.max_queue_per_user, max_pending_time=args.max_queue_time, parallelism=parallelism, estimate=estimate)
+
+    load_extra_model_paths()
 
     init_custom_nodes()
+    # restored prompts are validated against the input, output and model folders these set
+    apply_directory_args()
+    q.restore()
 
     cuda_malloc_warning()
 
     server.add_routes()
-    hijack_progress(server)
-
-    threading.Thread(target=prompt_worker, daemon=True, args=(q, server,)).start()
 
-    if args.output_directory:
-        output_dir = os.path.abspath(args.output_directory)
-        logging.info(f"Setting output directory to: {output_dir}")
-        folder_paths.set_output_directory(output_dir)
-
-    #These are the default folders that checkpoints, clip and vae models will be saved to when using CheckpointSave, etc.. nodes
-    folder_paths.add_model_folder_path("checkpoints", os.path.join(folder_paths.get_output_directory(), "checkpoints"))
-    folder_paths.add_model_folder_path("clip", os.path.join(folder_paths.get_output_directory(), "clip"))
-    folder_paths.add_model_folder_path("vae", os.path.join(folder_paths.get_output_directory(), "vae"))
-
-    if args.input_directory:
-        input_dir = os.path.abspath(args.input_directory)
-        logging.info(f"Setting input directory to: {input_dir}")
-        folder_paths.set_input_directory(input_dir)
+    if args.broker:
+        if args.broker_token is None:
+            logging.warning("\nWARNING: --broker is running without a --broker-token, anyone who can reach this server can register as a worker and receive the queued prompts.\n")
+        server.broker = broker.LocalBroker(q, server, lease_time=args.broker_lease_time)
+        server.broker.start()
+
+    if args.broker_url is not None:
+        broker_queue = broker.BrokerQueue(broker.HTTPBroker(args.broker_url, args.broker_token), socket.gethostname(), {"device": str(comfy.model_management.get_torch_device())})
+        broker_server = broker.BrokerServer(broker_queue, encode_preview_image)
+        hijack_progress(broker_server)
+        threading.Thread(target=prompt_worker, daemon=True, args=(broker_queue, broker_server,)).start()
+    elif args.workers > 1:
+        hijack_progress(server)
+        threads = args.worker_threads
+        if threads <= 0:
+            threads = max(1, (os.cpu_count() or 1) // args.workers)
+        server.workers = workers.WorkerPool(q, server, args.workers, worker_process, (threads,))
+        server.workers.start()
+    elif args.workers == 1:
+        preemption = None
+        if args.preemption:
+            preempting_executor = []
+            def run_preempting(item, item_id):
+                # the paused prompt keeps the caches of the main executor, preempting prompts get their own caches and spill directory
+                if len(preempting_executor) == 0:
+                    preempting_executor.append(create_executor(server, os.path.join(folder_paths.get_temp_directory(), "output_cache_preempting")))
+                execute_item(q, server, preempting_executor[0], item, item_id)
+            preemption = preemption_module.Preemption(q, server, run_preempting)
+            server.preemption = preemption
+        hijack_progress(server, preemption)
+        threading.Thread(target=prompt_worker, daemon=True, args=(q, server, None, preemption)).start()
 
     if args.quick_test_for_ci:
         exit(0)
@@ -255,4 +361,5 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         logging.info("\nStopped server")
 
+    runtime_estimator.save()
     cleanup_temp()
@@ -261,12 +261,17 @@ class VAEDecode:
         return {"required": { "samples": ("LATENT", ), "vae": ("VAE", )}}
     RETURN_TYPES = ("IMAGE",)
     FUNCTION = "decode"
+    BATCHED_FUNCTION = "decode_batched"
 
     CATEGORY = "latent"
 
     def decode(self, vae, samples):
         return (vae.decode(samples["samples"]), )
 
+    def decode_batched(self, vae, samples):
+        images = comfy.utils.batched_call(lambda v, s: v.decode(s), vae, [x["samples"] for x in samples])
+        return [(x, ) for x in images]
+
 class VAEDecodeTiled:
     @classmethod
     def INPUT_TYPES(s):
@@ -287,6 +292,7 @@ class VAEEncode:
         return {"required": { "pixels": ("IMAGE", ), "vae": ("VAE", )}}
     RETURN_TYPES = ("LATENT",)
     FUNCTION = "encode"
+    BATCHED_FUNCTION = "encode_batched"
 
     CATEGORY = "latent"
 
@@ -294,6 +300,10 @@ class VAEEncode:
         t = vae.encode(pixels[:,:,:,:3])
         return ({"samples":t}, )
 
+    def encode_batched(self, vae, pixels):
+        latents = comfy.utils.batched_call(lambda v, p: v.encode(p), vae, [x[:,:,:,:3] for x in pixels])
+        return [({"samples":t}, ) for t in latents]
+
 class VAEEncodeTiled:
     @classmethod
     def INPUT_TYPES(s):
@@ -458,6 +468,7 @@ class LoadLatent:
         return {"required": {"latent": [sorted(files), ]}, }
 
     CATEGORY = "_for_testing"
+    CPU_BOUND = True
 
     RETURN_TYPES = ("LATENT", )
     FUNCTION = "load"
@@ -1425,6 +1436,7 @@ class SaveImage:
     OUTPUT_NODE = True
 
     CATEGORY = "image"
+    CPU_BOUND = True
 
     def save_images(self, images, filename_prefix="ComfyUI", prompt=None, extra_pnginfo=None):
         filename_prefix += self.prefix_append
@@ -1478,6 +1490,7 @@ class LoadImage:
                 }
 
     CATEGORY = "image"
+    CPU_BOUND = True
 
     RETURN_TYPES = ("IMAGE", "MASK")
     FUNCTION = "load_image"
@@ -1552,6 +1565,7 @@ class LoadImageMask:
                 }
 
     CATEGORY = "mask"
+    CPU_BOUND = True
 
     RETURN_TYPES = ("MASK",)
     FUNCTION = "load_image"
@@ -1603,6 +1617,7 @@ class ImageScale:
     FUNCTION = "upscale"
 
     CATEGORY = "image/upscaling"
+    CPU_BOUND = True
 
     def upscale(self, image, upscale_method, width, height, crop):
         if width == 0 and height == 0:
@@ -1630,6 +1645,7 @@ class ImageScaleBy:
     FUNCTION = "upscale"
 
     CATEGORY = "image/upscaling"
+    CPU_BOUND = True
 
     def upscale(self, image, upscale_method, scale_by):
         samples = image.movedim(-1,1)
@@ -1649,6 +1665,7 @@ class ImageInvert:
     FUNCTION = "invert"
 
     CATEGORY = "image"
+    CPU_BOUND = True
 
     def invert(self, image):
         s = 1.0 - image
@@ -1664,6 +1681,7 @@ class ImageBatch:
     FUNCTION = "batch"
 
     CATEGORY = "image"
+    CPU_BOUND = True
 
     def batch(self, image1, image2):
         if image1.shape[1:] != image2.shape[1:]:
@@ -1712,6 +1730,7 @@ class ImagePadForOutpaint:
     FUNCTION = "expand_image"
 
     CATEGORY = "image"
+    CPU_BOUND = True
 
     def expand_image(self, image, left, top, right, bottom, feathering):
         d1, d2, d3, d4 = image.size()
@@ -1916,6 +1935,7 @@ def load_custom_node(module_path, ignore=set()):
                     NODE_CLASS_MAPPINGS[name] = module.NODE_CLASS_MAPPINGS[name]
             if hasattr(module, "NODE_DISPLAY_NAME_MAPPINGS") and getattr(module, "NODE_DISPLAY_NAME_MAPPINGS") is not None:
                 NODE_DISPLAY_NAME_MAPPINGS.update(module.NODE_DISPLAY_NAME_MAPPINGS)
+            folder_paths.invalidate_cache()
             return True
         else:
             logging.warning(f"Skip {module_path} module for custom nodes due to the lack of NODE_CLASS_MAPPINGS.")
@@ -10,11 +10,21 @@ import uuid
 import urllib
 import json
 import glob
+import shutil
 import struct
+import math
+import hmac
+import collections
+import gzip
+import hashlib
+import threading
+import concurrent.futures
+import time
 import ssl
 from PIL import Image, ImageOps
 from PIL.PngImagePlugin import PngInfo
 from io import BytesIO
+from typing import NamedTuple
 
 import aiohttp
 from aiohttp import web
@@ -26,6 +36,12 @@ import comfy.utils
 import comfy.model_management
 
 from app.user_manager import UserManager
+from app import file_io
+from app.preview_cache import PreviewCache
+from comfy_execution import caching
+from comfy_execution import profiler
+from comfy_execution import broker
+from comfy_execution import admission
 
 class BinaryEventTypes:
     PREVIEW_IMAGE = 1
@@ -37,6 +53,87 @@ async def send_socket_catch_exception(function, message):
     except (aiohttp.ClientError, aiohttp.ClientPayloadError, ConnectionResetError) as err:
         logging.warning("send error: {}".format(err))
 
+class ClientSender:
+    """
+    Sends the messages of one websocket from its own task, so a slow client
+    only holds up itself. Only the latest progress message and preview image
+    waiting to be sent are kept. A client with max_size messages waiting
+    stops getting previews until it catches up and is disconnected if that
+    isn't enough.
+    """
+    COALESCED = ("progress", BinaryEventTypes.PREVIEW_IMAGE)
+
+    def __init__(self, sid, ws, max_size=256):
+        self.sid = sid
+        self.ws = ws
+        self.max_size = max_size
+        # [event, (kind, payload)] in order, the payload is set to None when a newer message replaces it
+        self.queue = collections.deque()
+        self.latest = {}
+        self.size = 0
+        self.previews = True
+        self.closed = False
+        self.ready = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, event, kind, payload):
+        if self.closed or (event == BinaryEventTypes.PREVIEW_IMAGE and not self.previews):
+            return
+        if event in self.COALESCED:
+            old = self.latest.get(event, None)
+            if old is not None:
+                old[1] = None
+                self.size -= 1
+        if self.size >= self.max_size:
+            self.shed()
+            if self.size >= self.max_size:
+                logging.warning("websocket client {} is not reading its messages, disconnecting it".format(self.sid))
+                self.close()
+                return
+        entry = [event, (kind, payload)]
+        if event in self.COALESCED:
+            self.latest[event] = entry
+        self.queue.append(entry)
+        self.size += 1
+        self.ready.set()
+
+    def shed(self):
+        if self.previews:
+            logging.info("websocket client {} is falling behind, not sending it previews".format(self.sid))
+        self.previews = False
+        preview = self.latest.pop(BinaryEventTypes.PREVIEW_IMAGE, None)
+        if preview is not None and preview[1] is not None:
+            preview[1] = None
+            self.size -= 1
+
+    def close(self):
+        self.closed = True
+        self.task.cancel()
+        self.queue.clear()
+        self.latest.clear()
+        self.size = 0
+        asyncio.ensure_future(self.ws.close())
+
+    async def run(self):
+        while True:
+            if len(self.queue) == 0:
+                self.ready.clear()
+                await self.ready.wait()
+                continue
+            entry = self.queue.popleft()
+            if entry[1] is None:
+                continue
+            self.size -= 1
+            if self.latest.get(entry[0], None) is entry:
+                del self.latest[entry[0]]
+            kind, payload = entry[1]
+            if kind == "bytes":
+                await send_socket_catch_exception(self.ws.send_bytes, payload)
+            else:
+                await send_socket_catch_exception(self.ws.send_str, payload)
+            if not self.previews and self.size < self.max_size // 4:
+                self.previews = True
+
 @web.middleware
 async def cache_control(request: web.Request, handler):
     response: web.Response = await handler(request)
@@ -61,6 +158,200 @@ def create_cors_middleware(allowed_origin: str):
 
     return cors_middleware
 
+def node_info(node_class):
+    obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
+    info = {}
+    info['input'] = caching.get_input_types(obj_class)
+    info['output'] = obj_class.RETURN_TYPES
+    info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
+    info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
+    info['name'] = node_class
+    info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
+    info['description'] = obj_class.DESCRIPTION if hasattr(obj_class,'DESCRIPTION') else ''
+    info['category'] = 'sd'
+    if hasattr(obj_class, 'OUTPUT_NODE') and obj_class.OUTPUT_NODE == True:
+        info['output_node'] = True
+    else:
+        info['output_node'] = False
+
+    if hasattr(obj_class, 'CATEGORY'):
+        info['category'] = obj_class.CATEGORY
+    return info
+
+class ObjectInfoSnapshot(NamedTuple):
+    version: int
+    generation: int
+    # len(nodes.NODE_CLASS_MAPPINGS) when it was built, nodes that failed are left out of nodes
+    classes: int
+    # node class -> its node_info() as JSON
+    nodes: dict
+    body: bytes
+    gzip: bytes
+    etag: str
+
+class ObjectInfoCache:
+    """
+    The /object_info document, serialized and gzipped ahead of time. A
+    thread checks every interval seconds whether the model or input folders
+    or the node classes changed (folder_paths.get_cache_generation()) and
+    rebuilds it, requests only check that it is current. Every rebuild that
+    changes something gets a new version, the nodes that changed since an
+    earlier version can be asked for.
+    """
+    MAXIMUM_CHANGES = 100
+
+    def __init__(self, loop, interval=2.0):
+        self.loop = loop
+        self.interval = interval
+        # held while rebuilding, which takes a while
+        self.lock = threading.Lock()
+        # held only to publish or read the snapshot together with the changes
+        self.changes_lock = threading.Lock()
+        self.snapshot = None
+        self.changes = collections.deque(maxlen=self.MAXIMUM_CHANGES)
+
+    def start(self):
+        threading.Thread(target=self.refresh_loop, daemon=True, name="object_info").start()
+
+    def refresh_loop(self):
+        while True:
+            try:
+                self.refresh(folder_paths.get_cache_generation(max_age=self.interval))
+            except Exception:
+                logging.exception("failed to refresh object_info")
+            time.sleep(self.interval)
+
+    def current(self, generation):
+        snapshot = self.snapshot
+        return snapshot is not None and snapshot.generation == generation and snapshot.classes == len(nodes.NODE_CLASS_MAPPINGS)
+
+    def refresh(self, generation):
+        if self.current(generation):
+            return self.snapshot
+        with self.lock:
+            if self.current(generation):
+                return self.snapshot
+            old = self.snapshot
+            out = {}
+            classes = list(nodes.NODE_CLASS_MAPPINGS)
+            for x in classes:
+                try:
+                    out[x] = json.dumps(node_info(x))
+                except Exception as e:
+                    logging.error(f"[ERROR] An error occurred while retrieving information for the '{x}' node.")
+                    logging.error(traceback.format_exc())
+
+            version = 0
+            if old is not None:
+                changed = set(x for x in out if old.nodes.get(x, None) != out[x])
+                removed = set(old.nodes) - set(out)
+                if len(changed) == 0 and len(removed) == 0:
+                    with self.changes_lock:
+                        self.snapshot = old._replace(generation=generation, classes=len(classes))
+                    return self.snapshot
+                version = old.version + 1
+
+            body = ("{" + ", ".join('{}: {}'.format(json.dumps(x), v) for x, v in out.items()) + "}").encode("utf-8")
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            snapshot = ObjectInfoSnapshot(version, generation, len(classes), out, body, gzip.compress(body, compresslevel=6), etag)
+            with self.changes_lock:
+                if old is not None:
+                    self.changes.append((version, changed, removed))
+                self.snapshot = snapshot
+            return snapshot
+
+    async def get(self):
+        # the stat calls are cheap, serializing every node isn't: that happens off the event loop
+        generation = folder_paths.get_cache_generation(max_age=0)
+        if self.current(generation):
+            return self.snapshot
+        return await self.loop.run_in_executor(None, self.refresh, generation)
+
+    def get_changes(self, since):
+        """
+        The current snapshot and the (changed, removed) node classes after
+        version since in it, or None for those when since is too old to know.
+        """
+        with self.changes_lock:
+            snapshot = self.snapshot
+            if since >= snapshot.version:
+                return (snapshot, (set(), set()))
+            if len(self.changes) == 0 or self.changes[0][0] > since + 1:
+                return (snapshot, None)
+            changed = set()
+            removed = set()
+            for version, c, r in self.changes:
+                if version > since:
+                    changed = (changed - r) | c
+                    removed = (removed - c) | r
+            return (snapshot, (changed, removed))
+
+def encode_preview_image(image_data):
+    """
+    The bytes of a PREVIEW_IMAGE message for an (image_type, image, max_size)
+    preview.
+    """
+    image_type = image_data[0]
+    image = image_data[1]
+    max_size = image_data[2]
+    if max_size is not None:
+        if hasattr(Image, 'Resampling'):
+            resampling = Image.Resampling.BILINEAR
+        else:
+            resampling = Image.ANTIALIAS
+
+        image = ImageOps.contain(image, (max_size, max_size), resampling)
+    type_num = 1
+    if image_type == "JPEG":
+        type_num = 1
+    elif image_type == "PNG":
+        type_num = 2
+
+    bytesIO = BytesIO()
+    header = struct.pack(">I", type_num)
+    bytesIO.write(header)
+    image.save(bytesIO, format=image_type, quality=95, compress_level=1)
+    return bytesIO.getvalue()
+
+def transcode_image(file, image_format, quality, channel, max_size):
+    """
+    The bytes of a /view variant of an image file: a webp or jpeg preview, or
+    a png of its rgb or alpha channel, scaled down to fit in max_size pixels.
+    """
+    with Image.open(file) as img:
+        if max_size is not None and (img.width > max_size or img.height > max_size):
+            if hasattr(Image, 'Resampling'):
+                resampling = Image.Resampling.LANCZOS
+            else:
+                resampling = Image.ANTIALIAS
+            img.thumbnail((max_size, max_size), resampling)
+
+        buffer = BytesIO()
+        if image_format != 'png':
+            if image_format in ['jpeg'] or channel == 'rgb':
+                img = img.convert("RGB")
+            img.save(buffer, format=image_format, quality=quality)
+        elif channel == 'rgb':
+            if img.mode == "RGBA":
+                r, g, b, a = img.split()
+                new_img = Image.merge('RGB', (r, g, b))
+            else:
+                new_img = img.convert("RGB")
+            new_img.save(buffer, format='PNG')
+        elif channel == 'a':
+            if img.mode == "RGBA":
+                _, _, _, a = img.split()
+            else:
+                a = Image.new('L', img.size, 255)
+
+            # alpha img
+            alpha_img = Image.new('RGBA', img.size)
+            alpha_img.putalpha(a)
+            alpha_img.save(buffer, format='PNG')
+        else:
+            img.save(buffer, format='PNG')
+        return buffer.getvalue()
+
 class PromptServer():
     def __init__(self, loop):
         PromptServer.instance = self
@@ -71,6 +362,11 @@ class PromptServer():
         self.user_manager = UserManager()
         self.supports = ["custom_nodes_from_web"]
         self.prompt_queue = None
+        self.prompt_executor = None
+        self.workers = None
+        self.broker = None
+        self.preemption = None
+        self.admission = None
         self.loop = loop
         self.messages = asyncio.Queue()
         self.number = 0
@@ -82,12 +378,26 @@ class PromptServer():
         max_upload_size = round(args.max_upload_size * 1024 * 1024)
         self.app = web.Application(client_max_size=max_upload_size, middlewares=middlewares)
         self.sockets = dict()
+        self.senders = dict()
+        # previews are resized and encoded here, the event loop only sends the bytes
+        self.preview_pool = concurrent.futures.ThreadPoolExecutor(max_workers=2, thread_name_prefix="preview")
+        # /broker/lease waits up to a minute for a prompt, the other broker calls get their own threads so they aren't stuck behind it
+        self.broker_pool = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="broker")
+        self.broker_lease_pool = concurrent.futures.ThreadPoolExecutor(max_workers=32, thread_name_prefix="broker_lease")
+        self.preview_lock = threading.Lock()
+        self.previews_pending = {}
+        self.object_info = ObjectInfoCache(loop)
+        self.preview_cache = None
+        if args.preview_cache_size > 0:
+            self.preview_cache = PreviewCache(os.path.join(folder_paths.get_temp_directory(), "preview_cache"), round(args.preview_cache_size * 1024 * 1024))
         self.web_root = os.path.join(os.path.dirname(
             os.path.realpath(__file__)), "web")
         routes = web.RouteTableDef()
         self.routes = routes
         self.last_node_id = None
+        self.last_prompt_id = None
         self.client_id = None
+        self.executing_lock = threading.Lock()
 
         self.on_prompt_handlers = []
 
@@ -99,10 +409,15 @@ class PromptServer():
             if sid:
                 # Reusing existing session, remove old
                 self.sockets.pop(sid, None)
+                old_sender = self.senders.pop(sid, None)
+                if old_sender is not None:
+                    old_sender.task.cancel()
             else:
                 sid = uuid.uuid4().hex
 
             self.sockets[sid] = ws
+            sender = ClientSender(sid, ws)
+            self.senders[sid] = sender
 
             try:
                 # Send initial state to the new client
@@ -115,7 +430,11 @@ class PromptServer():
                     if msg.type == aiohttp.WSMsgType.ERROR:
                         logging.warning('ws connection closed with exception %s' % ws.exception())
             finally:
-                self.sockets.pop(sid, None)
+                if self.sockets.get(sid, None) is ws:
+                    self.sockets.pop(sid, None)
+                if self.senders.get(sid, None) is sender:
+                    self.senders.pop(sid, None)
+                sender.task.cancel()
             return ws
 
         @routes.get("/")
@@ -190,8 +509,10 @@ class PromptServer():
                 if image_save_function is not None:
                     image_save_function(image, post, filepath)
                 else:
+                    image.file.seek(0)
                     with open(filepath, "wb") as f:
-                        f.write(image.file.read())
+                        shutil.copyfileobj(image.file, f, file_io.CHUNK_SIZE)
+                folder_paths.invalidate_cache()
 
                 return web.json_response({"name" : filename, "subfolder": subfolder, "type": image_upload_type})
             else:
@@ -199,13 +520,16 @@ class PromptServer():
 
         @routes.post("/upload/image")
         async def upload_image(request):
-            post = await request.post()
-            return image_upload(post)
+            post = await file_io.read_multipart(request, max_upload_size)
+            try:
+                return await file_io.run(image_upload, post)
+            finally:
+                file_io.close_multipart(post)
 
 
         @routes.post("/upload/mask")
         async def upload_mask(request):
-            post = await request.post()
+            post = await file_io.read_multipart(request, max_upload_size)
 
             def image_save_function(image, post, filepath):
                 original_ref = json.loads(post.get("original_ref"))
@@ -244,7 +568,45 @@ class PromptServer():
                         original_pil.putalpha(new_alpha)
                         original_pil.save(filepath, compress_level=4, pnginfo=metadata)
 
-            return image_upload(post, image_save_function)
+            try:
+                return await file_io.run(image_upload, post, image_save_function)
+            finally:
+                file_io.close_multipart(post)
+
+        def view_file(file, filename, query):
+            if not os.path.isfile(file):
+                return web.Response(status=404)
+
+            channel = query.get('channel', 'rgba')
+            max_size = query.get('max_size', None)
+            if max_size is not None:
+                if not max_size.isdigit() or int(max_size) == 0:
+                    return web.Response(status=400)
+                max_size = int(max_size)
+
+            if 'preview' in query:
+                preview_info = query['preview'].split(';')
+                image_format = preview_info[0]
+                # only an explicitly asked for channel with alpha needs webp, channel defaults to 'rgba'
+                if image_format not in ['webp', 'jpeg'] or 'a' in query.get('channel', ''):
+                    image_format = 'webp'
+
+                quality = 90
+                if preview_info[-1].isdigit():
+                    quality = int(preview_info[-1])
+            elif channel in ['rgb', 'a'] or max_size is not None:
+                image_format = 'png'
+                quality = None
+            else:
+                return web.FileResponse(file, headers={"Content-Disposition": f"filename=\"{filename}\""})
+
+            if self.preview_cache is None:
+                body = transcode_image(file, image_format, quality, channel, max_size)
+            else:
+                body = self.preview_cache.get(file, (image_format, quality, channel, max_size),
+                                              lambda: transcode_image(file, image_format, quality, channel, max_size))
+            return web.Response(body=body, content_type=f'image/{image_format}',
+                                headers={"Content-Disposition": f"filename=\"{filename}\""})
 
         @routes.get("/view")
         async def view_image(request):
@@ -271,66 +633,7 @@ class PromptServer():
 
                 filename = os.path.basename(filename)
                 file = os.path.join(output_dir, filename)
-
-                if os.path.isfile(file):
-                    if 'preview' in request.rel_url.query:
-                        with Image.open(file) as img:
-                            preview_info = request.rel_url.query['preview'].split(';')
-                            image_format = preview_info[0]
-                            if image_format not in ['webp', 'jpeg'] or 'a' in request.rel_url.query.get('channel', ''):
-                                image_format = 'webp'
-
-                            quality = 90
-                            if preview_info[-1].isdigit():
-                                quality = int(preview_info[-1])
-
-                            buffer = BytesIO()
-                            if image_format in ['jpeg'] or request.rel_url.query.get('channel', '') == 'rgb':
-                                img = img.convert("RGB")
-                            img.save(buffer, format=image_format, quality=quality)
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type=f'image/{image_format}',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    if 'channel' not in request.rel_url.query:
-                        channel = 'rgba'
-                    else:
-                        channel = request.rel_url.query["channel"]
-
-                    if channel == 'rgb':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                r, g, b, a = img.split()
-                                new_img = Image.merge('RGB', (r, g, b))
-                            else:
-                                new_img = img.convert("RGB")
-
-                            buffer = BytesIO()
-                            new_img.save(buffer, format='PNG')
-                            buffer.seek(0)
-
-                            return web.Response(body=buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-
-                    elif channel == 'a':
-                        with Image.open(file) as img:
-                            if img.mode == "RGBA":
-                                _, _, _, a = img.split()
-                            else:
-                                a = Image.new('L', img.size, 255)
-
-                            # alpha img
-                            alpha_img = Image.new('RGBA', img.size)
-                            alpha_img.putalpha(a)
-                            alpha_buffer = BytesIO()
-                            alpha_img.save(alpha_buffer, format='PNG')
-                            alpha_buffer.seek(0)
-
-                            return web.Response(body=alpha_buffer.read(), content_type='image/png',
-                                                headers={"Content-Disposition": f"filename=\"{filename}\""})
-                    else:
-                        return web.FileResponse(file, headers={"Content-Disposition": f"filename=\"{filename}\""})
+                return await file_io.run(view_file, file, filename, request.rel_url.query)
 
             return web.Response(status=404)
 
@@ -349,7 +652,7 @@ class PromptServer():
             safetensors_path = folder_paths.get_full_path(folder_name, filename)
             if safetensors_path is None:
                 return web.Response(status=404)
-            out = comfy.utils.safetensors_header(safetensors_path, max_size=1024*1024)
+            out = await file_io.run(comfy.utils.safetensors_header, safetensors_path, max_size=1024*1024)
             if out is None:
                 return web.Response(status=404)
             dt = json.loads(out)
@@ -387,44 +690,41 @@ class PromptServer():
         async def get_prompt(request):
             return web.json_response(self.get_queue_info())
 
-        def node_info(node_class):
-            obj_class = nodes.NODE_CLASS_MAPPINGS[node_class]
-            info = {}
-            info['input'] = obj_class.INPUT_TYPES()
-            info['output'] = obj_class.RETURN_TYPES
-            info['output_is_list'] = obj_class.OUTPUT_IS_LIST if hasattr(obj_class, 'OUTPUT_IS_LIST') else [False] * len(obj_class.RETURN_TYPES)
-            info['output_name'] = obj_class.RETURN_NAMES if hasattr(obj_class, 'RETURN_NAMES') else info['output']
-            info['name'] = node_class
-            info['display_name'] = nodes.NODE_DISPLAY_NAME_MAPPINGS[node_class] if node_class in nodes.NODE_DISPLAY_NAME_MAPPINGS.keys() else node_class
-            info['description'] = obj_class.DESCRIPTION if hasattr(obj_class,'DESCRIPTION') else ''
-            info['category'] = 'sd'
-            if hasattr(obj_class, 'OUTPUT_NODE') and obj_class.OUTPUT_NODE == True:
-                info['output_node'] = True
-            else:
-                info['output_node'] = False
-
-            if hasattr(obj_class, 'CATEGORY'):
-                info['category'] = obj_class.CATEGORY
-            return info
-
         @routes.get("/object_info")
         async def get_object_info(request):
-            out = {}
-            for x in nodes.NODE_CLASS_MAPPINGS:
+            if "since" in request.rel_url.query:
                 try:
-                    out[x] = node_info(x)
-                except Exception as e:
-                    logging.error(f"[ERROR] An error occurred while retrieving information for the '{x}' node.")
-                    logging.error(traceback.format_exc())
-            return web.json_response(out)
+                    since = int(request.rel_url.query["since"])
+                except ValueError:
+                    return web.Response(status=400)
+                # brings the snapshot up to date, the changes are read together with it
+                await self.object_info.get()
+                snapshot, changes = self.object_info.get_changes(since)
+                if changes is None:
+                    return web.json_response({"version": snapshot.version, "resync": True})
+                changed, removed = changes
+                body = "{" + ",".join('{}:{}'.format(json.dumps(x), snapshot.nodes[x]) for x in sorted(changed) if x in snapshot.nodes) + "}"
+                return web.Response(text='{{"version":{},"changed":{},"removed":{}}}'.format(snapshot.version, body, json.dumps(sorted(removed))), content_type="application/json")
+
+            snapshot = await self.object_info.get()
+            gzipped = "gzip" in request.headers.get("Accept-Encoding", "")
+            # the gzipped and the plain document are different representations to caches
+            etag = snapshot.etag[:-1] + '-gz"' if gzipped else snapshot.etag
+            headers = {"ETag": etag, "Cache-Control": "no-cache", "Vary": "Accept-Encoding"}
+            if request.headers.get("If-None-Match", None) == etag:
+                return web.Response(status=304, headers=headers)
+            if gzipped:
+                headers["Content-Encoding"] = "gzip"
+                return web.Response(body=snapshot.gzip, content_type="application/json", headers=headers)
+            return web.Response(body=snapshot.body, content_type="application/json", headers=headers)
 
         @routes.get("/object_info/{node_class}")
         async def get_object_info_node(request):
             node_class = request.match_info.get("node_class", None)
-            out = {}
-            if (node_class is not None) and (node_class in nodes.NODE_CLASS_MAPPINGS):
-                out[node_class] = node_info(node_class)
-            return web.json_response(out)
+            snapshot = await self.object_info.get()
+            if node_class not in snapshot.nodes:
+                return web.json_response({})
+            return web.Response(text="{{{}:{}}}".format(json.dumps(node_class), snapshot.nodes[node_class]), content_type="application/json")
 
         @routes.get("/history")
         async def get_history(request):
@@ -438,14 +738,61 @@ class PromptServer():
             prompt_id = request.match_info.get("prompt_id", None)
             return web.json_response(self.prompt_queue.get_history(prompt_id=prompt_id))
 
+        @routes.get("/profile/{prompt_id}")
+        async def get_profile(request):
+            prompt_id = request.match_info.get("prompt_id", None)
+            history = self.prompt_queue.get_history(prompt_id=prompt_id)
+            if prompt_id not in history or history[prompt_id].get("profile") is None:
+                return web.Response(status=404)
+
+            profile = history[prompt_id]["profile"]
+            if request.rel_url.query.get("format", "") == "trace":
+                return web.json_response(profiler.to_chrome_trace(profile),
+                                         headers={"Content-Disposition": f"attachment; filename=\"{prompt_id}.trace.json\""})
+            return web.json_response(profile)
+
         @routes.get("/queue")
         async def get_queue(request):
             queue_info = {}
+            query = request.rel_url.query
+            try:
+                since = int(query["since"]) if "since" in query else None
+                offset = max(int(query.get("offset", 0)), 0)
+                limit = max(int(query.get("limit", 100)), 0)
+            except ValueError:
+                return web.Response(status=400)
+
+            if since is not None:
+                version, changes = self.prompt_queue.get_changes(since)
+                if changes is not None:
+                    return web.json_response({"version": version, "changes": changes})
+                queue_info['resync'] = True
+
+            if "offset" in query or "limit" in query or since is not None:
+                running, pending, total, version = self.prompt_queue.get_queue_page(offset, limit)
+                queue_info['queue_running'] = running
+                queue_info['queue_pending'] = pending
+                queue_info['pending_total'] = total
+                queue_info['version'] = version
+                queue_info['scheduling'] = self.prompt_queue.get_scheduling_info()
+                add_estimates(queue_info)
+                return web.json_response(queue_info)
+
             current_queue = self.prompt_queue.get_current_queue()
             queue_info['queue_running'] = current_queue[0]
             queue_info['queue_pending'] = current_queue[1]
+            queue_info['scheduling'] = self.prompt_queue.get_scheduling_info()
+            add_estimates(queue_info)
             return web.json_response(queue_info)
 
+        def add_estimates(queue_info):
+            # queue entries are positional lists, the estimated run time of each one is keyed by prompt_id
+            if self.admission is None:
+                return
+            prompt_ids = [x[1] for x in queue_info['queue_running']] + [x[1] for x in queue_info['queue_pending']]
+            queue_info['estimates'] = self.admission.estimates(prompt_ids)
+            queue_info['estimated_time'] = self.admission.estimated_time()
+
         @routes.post("/prompt")
         async def post_prompt(request):
             logging.info("got prompt")
@@ -473,11 +820,35 @@ class PromptServer():
 
                 if "client_id" in json_data:
                     extra_data["client_id"] = json_data["client_id"]
+                if "deadline" in json_data:
+                    try:
+                        deadline = float(json_data["deadline"])
+                    except (TypeError, ValueError):
+                        deadline = math.nan
+                    if not math.isfinite(deadline):
+                        error = {"type": "invalid_deadline", "message": "deadline has to be a number of seconds", "details": "", "extra_info": {"deadline": json_data["deadline"]}}
+                        return web.json_response({"error": error, "node_errors": []}, status=400)
+                    extra_data["deadline"] = time.time() + deadline
+                if args.multi_user:
+                    try:
+                        extra_data["user_id"] = self.user_manager.get_request_user_id(request)
+                    except KeyError:
+                        pass
                 if valid[0]:
+                    estimate = eta = None
+                    # a prompt that follows an identical one doesn't add any work
+                    if self.admission is not None and self.prompt_queue.get_leader((number, None, prompt, extra_data, valid[2])) is None:
+                        try:
+                            estimate, eta = self.admission.admit((number, None, prompt, extra_data, None))
+                        except admission.QueueFull as e:
+                            logging.warning("rejected prompt: {}".format(e.message))
+                            return web.json_response({"error": e.error(), "node_errors": []}, status=429, headers=e.headers())
                     prompt_id = str(uuid.uuid4())
                     outputs_to_execute = valid[2]
-                    self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
-                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3]}
+                    leader = self.prompt_queue.put((number, prompt_id, prompt, extra_data, outputs_to_execute))
+                    response = {"prompt_id": prompt_id, "number": number, "node_errors": valid[3], "estimate": estimate, "eta": eta}
+                    if leader is not None:
+                        response["deduplicated"] = leader
                     return web.json_response(response)
                 else:
                     logging.warning("invalid prompt: {}".format(valid[1]))
@@ -485,23 +856,74 @@ class PromptServer():
             else:
                 return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
 
+        @routes.post("/prompt/plan")
+        async def post_prompt_plan(request):
+            json_data =  await request.json()
+            if "prompt" not in json_data:
+                return web.json_response({"error": "no prompt", "node_errors": []}, status=400)
+
+            prompt = json_data["prompt"]
+            valid = execution.validate_prompt(prompt)
+            if not valid[0]:
+                return web.json_response({"error": valid[1], "node_errors": valid[3]}, status=400)
+            if self.prompt_executor is None:
+                return web.json_response({"error": "no executor in this process to plan against", "node_errors": []}, status=503)
+
+            # runs IS_CHANGED, which can hash files
+            plan = await file_io.run(self.prompt_executor.plan, prompt, valid[2])
+            plan["node_errors"] = valid[3]
+            return web.json_response(plan)
+
         @routes.post("/queue")
         async def post_queue(request):
             json_data =  await request.json()
+            priority = {}
+            if "priority" in json_data:
+                try:
+                    priority = {prompt_id: float(number) for prompt_id, number in json_data['priority'].items()}
+                except (AttributeError, TypeError, ValueError):
+                    return web.json_response({"error": "priority has to map prompt ids to numbers"}, status=400)
+                if not all(math.isfinite(x) for x in priority.values()):
+                    return web.json_response({"error": "priority has to map prompt ids to numbers"}, status=400)
+
             if "clear" in json_data:
                 if json_data["clear"]:
                     self.prompt_queue.wipe_queue()
             if "delete" in json_data:
-                to_delete = json_data['delete']
-                for id_to_delete in to_delete:
-                    delete_func = lambda a: a[1] == id_to_delete
-                    self.prompt_queue.delete_queue_item(delete_func)
+                self.prompt_queue.delete_queue_items(json_data['delete'])
+            if "front" in json_data:
+                for prompt_id in json_data['front']:
+                    self.prompt_queue.move_to_front(prompt_id)
+            for prompt_id, number in priority.items():
+                self.prompt_queue.set_priority(prompt_id, number)
 
             return web.Response(status=200)
 
         @routes.post("/interrupt")
         async def post_interrupt(request):
-            nodes.interrupt_processing()
+            json_data = {}
+            if request.can_read_body:
+                try:
+                    json_data = await request.json()
+                except ValueError:
+                    return web.Response(status=400)
+            prompt_id = json_data.get("prompt_id", None) if isinstance(json_data, dict) else None
+            running = [x[1] for x in self.prompt_queue.get_current_queue()[0]]
+            if prompt_id is None:
+                # the prompt the clients last got an "executing" message about
+                if self.last_prompt_id in running:
+                    prompt_id = self.last_prompt_id
+            elif prompt_id not in running:
+                return web.Response(status=200)
+
+            if self.preemption is not None and self.preemption.interrupt(prompt_id):
+                # interrupting now would stop the prompt that preempted it
+                return web.Response(status=200)
+            leased = self.broker is not None and self.broker.interrupt(prompt_id)
+            if self.workers is not None:
+                self.workers.interrupt(prompt_id)
+            elif not leased:
+                nodes.interrupt_processing()
             return web.Response(status=200)
 
         @routes.post("/free")
@@ -515,6 +937,48 @@ class PromptServer():
                 self.prompt_queue.set_flag("free_memory", free_memory)
             return web.Response(status=200)
 
+        async def broker_call(request, function, *keys, executor=None):
+            if self.broker is None:
+                return web.json_response({"error": "this server is not a broker"}, status=404)
+            if args.broker_token is not None:
+                if not hmac.compare_digest(request.headers.get("Authorization", ""), "Bearer {}".format(args.broker_token)):
+                    return web.json_response({"error": "bad broker token"}, status=401)
+            json_data = await request.json()
+            try:
+                # lease waits for a prompt and the others take locks the prompt worker holds, keep them off the event loop
+                out = await self.loop.run_in_executor(executor or self.broker_pool, lambda: function(*[json_data.get(k, None) for k in keys]))
+            except broker.UnknownWorker:
+                return web.json_response({"error": "unknown worker"}, status=404)
+            except broker.LeaseLost:
+                return web.json_response({"error": "lease lost"}, status=409)
+            return web.json_response(out)
+
+        @routes.post("/broker/register")
+        async def post_broker_register(request):
+            return await broker_call(request, lambda name, info: {"worker_id": self.broker.register(name, info or {}), "lease_time": self.broker.lease_time, "storage_token": self.broker.storage_token}, "name", "info")
+
+        @routes.post("/broker/heartbeat")
+        async def post_broker_heartbeat(request):
+            return await broker_call(request, lambda worker_id, task_ids: self.broker.heartbeat(worker_id, task_ids or []), "worker_id", "task_ids")
+
+        @routes.post("/broker/lease")
+        async def post_broker_lease(request):
+            return await broker_call(request, lambda worker_id, timeout: {"task": self.broker.lease(worker_id, min(float(timeout or 10.0), 60.0))}, "worker_id", "timeout", executor=self.broker_lease_pool)
+
+        @routes.post("/broker/report")
+        async def post_broker_report(request):
+            return await broker_call(request, lambda worker_id, task_id, messages: self.broker.report(worker_id, task_id, messages or []), "worker_id", "task_id", "messages")
+
+        @routes.post("/broker/complete")
+        async def post_broker_complete(request):
+            return await broker_call(request, lambda worker_id, task_id, outputs, status, profile: self.broker.complete(worker_id, task_id, outputs or {}, status, profile), "worker_id", "task_id", "outputs", "status", "profile")
+
+        @routes.get("/broker/workers")
+        async def get_broker_workers(request):
+            if self.broker is None:
+                return web.json_response({"error": "this server is not a broker"}, status=404)
+            return web.json_response(self.broker.describe())
+
         @routes.post("/history")
         async def post_history(request):
             json_data =  await request.json()
@@ -554,10 +1018,15 @@ class PromptServer():
             web.static('/', self.web_root),
         ])
 
+        # the custom nodes are loaded by now
+        self.object_info.start()
+
     def get_queue_info(self):
         prompt_info = {}
         exec_info = {}
         exec_info['queue_remaining'] = self.prompt_queue.get_tasks_remaining()
+        if self.admission is not None:
+            exec_info['estimated_time'] = self.admission.estimated_time()
         prompt_info['exec_info'] = exec_info
         return prompt_info
 
@@ -579,52 +1048,99 @@ class PromptServer():
         return message
 
     async def send_image(self, image_data, sid=None):
-        image_type = image_data[0]
-        image = image_data[1]
-        max_size = image_data[2]
-        if max_size is not None:
-            if hasattr(Image, 'Resampling'):
-                resampling = Image.Resampling.BILINEAR
-            else:
-                resampling = Image.ANTIALIAS
-
-            image = ImageOps.contain(image, (max_size, max_size), resampling)
-        type_num = 1
-        if image_type == "JPEG":
-            type_num = 1
-        elif image_type == "PNG":
-            type_num = 2
-
-        bytesIO = BytesIO()
-        header = struct.pack(">I", type_num)
-        bytesIO.write(header)
-        image.save(bytesIO, format=image_type, quality=95, compress_level=1)
-        preview_bytes = bytesIO.getvalue()
+        preview_bytes = await self.loop.run_in_executor(self.preview_pool, encode_preview_image, image_data)
         await self.send_bytes(BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid=sid)
 
-    async def send_bytes(self, event, data, sid=None):
-        message = self.encode_bytes(event, data)
+    def send_preview(self, image_data, sid=None):
+        """
+        Encodes a preview on the preview pool and sends it, from any thread.
+        Previews nobody is connected to see are dropped and so are the ones
+        that arrive while an older one for the same client is being encoded,
+        except the latest.
+        """
+        if sid is None:
+            if len(self.senders) == 0:
+                return
+        elif sid not in self.senders:
+            return
+        with self.preview_lock:
+            busy = sid in self.previews_pending
+            self.previews_pending[sid] = image_data
+        if not busy:
+            self.preview_pool.submit(self.encode_previews, sid)
+
+    def encode_previews(self, sid):
+        while True:
+            with self.preview_lock:
+                image_data = self.previews_pending[sid]
+                if image_data is None:
+                    del self.previews_pending[sid]
+                    return
+                # None marks the encoding in progress
+                self.previews_pending[sid] = None
+            try:
+                preview_bytes = encode_preview_image(image_data)
+            except Exception as e:
+                logging.warning("failed to encode preview: {}".format(e))
+                continue
+            self.loop.call_soon_threadsafe(self.messages.put_nowait, (BinaryEventTypes.PREVIEW_IMAGE, preview_bytes, sid))
 
+    def queue_message(self, event, kind, payload, sid=None):
+        # the message is encoded once and each client's sender takes it from there
         if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_bytes, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_bytes, message)
+            for sender in list(self.senders.values()):
+                sender.put(event, kind, payload)
+        elif sid in self.senders:
+            self.senders[sid].put(event, kind, payload)
+
+    async def send_bytes(self, event, data, sid=None):
+        message = self.encode_bytes(event, data)
+        self.queue_message(event, "bytes", message, sid)
 
     async def send_json(self, event, data, sid=None):
         message = {"type": event, "data": data}
+        self.queue_message(event, "json", json.dumps(message), sid)
 
-        if sid is None:
-            sockets = list(self.sockets.values())
-            for ws in sockets:
-                await send_socket_catch_exception(ws.send_json, message)
-        elif sid in self.sockets:
-            await send_socket_catch_exception(self.sockets[sid].send_json, message)
+    def send_executing(self, data, sid):
+        # "executing" messages of prompts run in worker processes or by broker workers, several threads relay them
+        with self.executing_lock:
+            self.client_id = sid
+            self.last_node_id = data.get("node", None)
+            if data.get("prompt_id", None) is not None:
+                self.last_prompt_id = data["prompt_id"]
+            self.send_sync("executing", data, sid)
 
     def send_sync(self, event, data, sid=None):
-        self.loop.call_soon_threadsafe(
-            self.messages.put_nowait, (event, data, sid))
+        if event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
+            self.send_preview(data, sid)
+        else:
+            self.loop.call_soon_threadsafe(
+                self.messages.put_nowait, (event, data, sid))
+        if sid is not None and self.prompt_queue is not None:
+            self.send_to_followers(event, data, sid)
+
+    def send_to_followers(self, event, data, sid):
+        # clients of deduplicated prompts get the messages of the prompt they follow, under their own prompt_id
+        if isinstance(data, dict):
+            prompt_id = data.get("prompt_id", None)
+        else:
+            prompt_id = self.last_prompt_id
+        if prompt_id is None:
+            return
+        executed = data if event == "executed" and isinstance(data, dict) else None
+        for follower_id, client_id in self.prompt_queue.get_followers(prompt_id, executed):
+            if client_id is None:
+                continue
+            if isinstance(data, dict):
+                message = (event, dict(data, prompt_id=follower_id), client_id)
+            elif client_id == sid:
+                continue
+            elif event == BinaryEventTypes.UNENCODED_PREVIEW_IMAGE:
+                self.send_preview(data, client_id)
+                continue
+            else:
+                message = (event, data, client_id)
+            self.loop.call_soon_threadsafe(self.messages.put_nowait, message)
 
     def queue_updated(self):
         self.send_sync("status", { "status": self.get_queue_info() })
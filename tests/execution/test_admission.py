@@ -0,0 +1,103 @@
+"""
+AdmissionControl turning prompts away when the queue is full, and the
+Retry-After it asks the clients to wait
+"""
+import pytest
+
+import nodes
+import execution
+from comfy_execution import admission
+
+class Output:
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {}}
+
+class Server:
+    def __init__(self):
+        self.number = 0
+        self.prompt_queue = None
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def node_classes(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {"Output": Output})
+
+def item(number, prompt_id, client_id="alice", estimate=10.0):
+    return (number, prompt_id, {"1": {"class_type": "Output", "inputs": {}}}, {"client_id": client_id, "estimate": estimate}, ["1"])
+
+def make_admission(parallelism=1, **kwargs):
+    q = execution.PromptQueue(Server())
+    control = admission.AdmissionControl(q, parallelism=lambda: parallelism, estimate=lambda item: item[3]["estimate"], **kwargs)
+    return q, control
+
+def test_queue_limit():
+    q, control = make_admission(max_queue=2, parallelism=2)
+    assert control.admit(item(0, None)) == (10.0, 10.0)
+    q.put(item(0, "a"))
+    q.put(item(1, "b", client_id="bob", estimate=30.0))
+    with pytest.raises(admission.QueueFull) as e:
+        control.admit(item(2, None, client_id="carol"))
+    assert e.value.error_type == "queue_full"
+    # one average prompt (20s) has to start, two run at a time
+    assert e.value.retry_after == 10
+
+    # room again once one of them runs
+    q.get()
+    estimate, eta = control.admit(item(2, None, client_id="carol"))
+    # b and what is left of a, shared by the two workers
+    assert eta == pytest.approx(30.0, abs=1.0)
+
+def test_owner_limit():
+    q, control = make_admission(max_per_owner=2)
+    q.put(item(0, "a1"))
+    q.put(item(1, "a2"))
+    q.put(item(2, "b1", client_id="bob"))
+    with pytest.raises(admission.QueueFull) as e:
+        control.admit(item(3, None))
+    assert e.value.error_type == "owner_queue_full"
+    assert e.value.message == "You already have 2 prompts queued"
+    # one of alice's prompts has to start, which takes a turn of each owner
+    assert e.value.retry_after == 20
+    control.admit(item(3, None, client_id="bob"))
+
+    q.delete_queue_items(["a1"])
+    control.admit(item(3, None))
+
+def test_pending_time_limit():
+    q, control = make_admission(max_pending_time=25.0)
+    q.put(item(0, "a"))
+    control.admit(item(1, None, estimate=15.0))
+    with pytest.raises(admission.QueueFull) as e:
+        control.admit(item(1, None, estimate=15.5))
+    assert e.value.error_type == "queue_busy"
+    assert e.value.retry_after == 1
+    # unknown estimates aren't held to it
+    assert control.admit(item(1, None, estimate=None)) == (None, None)
+
+def test_queue_changes_are_followed():
+    q, control = make_admission(max_queue=1)
+    q.put(item(0, "a"))
+    with pytest.raises(admission.QueueFull):
+        control.admit(item(1, None))
+    _, item_id = q.get()
+    assert control.estimates(["a"]) == {"a": 10.0}
+    q.task_done(item_id, {}, None)
+    control.admit(item(1, None))
+    q.put(item(1, "b"))
+    q.wipe_queue()
+    control.admit(item(2, None))
+
+def test_rejection_response():
+    e = admission.QueueFull("queue_full", "There are already 2 prompts queued", 7)
+    assert e.headers() == {"Retry-After": "7"}
+    assert e.error() == {"type": "queue_full", "message": "There are already 2 prompts queued", "details": "", "extra_info": {"retry_after": 7}}
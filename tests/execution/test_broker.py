@@ -0,0 +1,140 @@
+"""
+LocalBroker leases: heartbeats, expiry, requeueing and the attempt limit,
+and the check that workers share the input and output directories
+"""
+import pytest
+
+import nodes
+import execution
+import folder_paths
+from comfy_execution import broker
+
+class Output:
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {}}
+
+class Server:
+    def __init__(self):
+        self.number = 0
+        self.prompt_queue = None
+        self.messages = []
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append((event, data, sid))
+
+    def send_executing(self, data, sid=None):
+        self.messages.append(("executing", data, sid))
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+@pytest.fixture(autouse=True)
+def node_classes(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {"Output": Output})
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(broker, "time", clock)
+    return clock
+
+def make_broker(max_attempts=3):
+    q = execution.PromptQueue(Server())
+    q.put((0, "a", {"1": {"class_type": "Output", "inputs": {}}}, {}, ["1"]))
+    return q, broker.LocalBroker(q, q.server, lease_time=30.0, max_attempts=max_attempts)
+
+def test_heartbeats_keep_the_lease(clock):
+    q, b = make_broker()
+    worker = b.register("worker")
+    task = b.lease(worker, timeout=0)
+    assert task["item"][1] == "a"
+    for i in range(4):
+        clock.sleep(20.0)
+        b.heartbeat(worker, [task["task_id"]])
+        b.expire()
+    b.complete(worker, task["task_id"], {"1": {"text": ["done"]}})
+    assert q.get_history("a")["a"]["outputs"] == {"1": {"text": ["done"]}}
+    assert len(q.queue) == 0
+
+def test_missed_heartbeat_puts_the_prompt_back_in_the_queue(clock):
+    q, b = make_broker()
+    first = b.register("first")
+    task = b.lease(first, timeout=0)
+    # heartbeats that don't name the task don't keep it
+    clock.sleep(20.0)
+    b.heartbeat(first, [])
+    clock.sleep(20.0)
+    b.expire()
+    assert b.leases == {}
+    assert [x[1] for x in q.get_current_queue()[1]] == ["a"]
+
+    second = b.register("second")
+    retry = b.lease(second, timeout=0)
+    assert retry["item"][1] == "a"
+    # the first worker lost it
+    with pytest.raises(broker.LeaseLost):
+        b.complete(first, task["task_id"], {})
+    with pytest.raises(broker.LeaseLost):
+        b.report(first, retry["task_id"], [])
+    b.complete(second, retry["task_id"], {})
+    assert "a" in q.get_history("a")
+    assert len(q.queue) == 0
+
+def test_workers_without_heartbeats_are_dropped(clock):
+    q, b = make_broker()
+    worker = b.register("worker")
+    clock.sleep(61.0)
+    b.expire()
+    with pytest.raises(broker.UnknownWorker):
+        b.lease(worker, timeout=0)
+
+def test_prompt_fails_after_max_attempts(clock):
+    q, b = make_broker(max_attempts=2)
+    worker = b.register("worker")
+    for i in range(2):
+        assert b.lease(worker, timeout=0)["item"][1] == "a"
+        clock.sleep(31.0)
+        b.heartbeat(worker)
+        b.expire()
+    assert len(q.queue) == 0
+    assert b.leases == {} and b.attempts == {}
+    status = q.get_history("a")["a"]["status"]
+    assert status["status_str"] == "error"
+    assert status["messages"][0][1]["exception_message"] == "the workers running it stopped responding"
+
+def test_storage_check(tmp_path, monkeypatch):
+    monkeypatch.setattr(folder_paths, "input_directory", str(tmp_path / "input"))
+    monkeypatch.setattr(folder_paths, "output_directory", str(tmp_path / "output"))
+    broker.write_storage_check("token")
+    assert broker.missing_storage("token") == []
+    assert broker.missing_storage("other") == [str(tmp_path / "input"), str(tmp_path / "output")]
+
+    monkeypatch.setattr(folder_paths, "output_directory", str(tmp_path / "worker_output"))
+    assert broker.missing_storage("token") == [str(tmp_path / "worker_output")]
+
+def test_workers_warn_when_not_sharing_the_directories(tmp_path, monkeypatch, caplog):
+    monkeypatch.setattr(folder_paths, "input_directory", str(tmp_path / "input"))
+    monkeypatch.setattr(folder_paths, "output_directory", str(tmp_path / "output"))
+    q, b = make_broker()
+    b.start()
+    broker.BrokerQueue(b, "same").ensure_registered()
+    assert "aren't the directories of the broker" not in caplog.text
+
+    monkeypatch.setattr(folder_paths, "output_directory", str(tmp_path / "worker_output"))
+    broker.BrokerQueue(b, "other").ensure_registered()
+    assert "{} aren't the directories of the broker".format(tmp_path / "worker_output") in caplog.text
@@ -0,0 +1,81 @@
+"""
+RuntimeEstimator fitting the run time of nodes from the profiles of the
+prompts that ran
+"""
+import pytest
+
+import nodes
+from comfy_execution import estimator
+from comfy_execution import profiler
+
+@pytest.fixture(autouse=True)
+def empty_history(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {})
+    monkeypatch.setattr(profiler, "history", profiler.ProfileHistory())
+
+def run_time(steps, megapixels):
+    return 0.5 + 0.1 * steps + 2.0 * megapixels + 0.05 * steps * megapixels
+
+def test_regression_fits_a_linear_run_time():
+    regression = estimator.Regression(4)
+    for steps in (10, 20, 30):
+        for megapixels in (0.25, 1.0, 2.0):
+            x = [1.0, steps, megapixels, steps * megapixels]
+            regression.add(x, run_time(steps, megapixels), decay=1.0)
+    for steps, megapixels in ((25, 0.5), (40, 4.0)):
+        assert regression.predict([1.0, steps, megapixels, steps * megapixels]) == pytest.approx(run_time(steps, megapixels), rel=1e-3)
+
+def test_regression_forgets_old_samples():
+    regression = estimator.Regression(4)
+    x = [1.0, 20, 1.0, 20]
+    for i in range(50):
+        regression.add(x, 10.0, decay=0.8)
+    for i in range(50):
+        regression.add(x, 5.0, decay=0.8)
+    assert regression.predict(x) == pytest.approx(5.0, rel=1e-3)
+
+def test_regression_without_a_solution_predicts_the_average():
+    # every sample has the same features, the average is all there is to go on
+    regression = estimator.Regression(4, ridge=0.0)
+    for y in (1.0, 2.0, 3.0):
+        regression.add([1.0, 0.0, 0.0, 0.0], y, decay=1.0)
+    assert regression.predict([1.0, 10.0, 1.0, 10.0]) == pytest.approx(2.0)
+
+def prompt(steps, width, height):
+    return {
+        "1": {"class_type": "EmptyLatentImage", "inputs": {"width": width, "height": height, "batch_size": 1}},
+        "2": {"class_type": "KSampler", "inputs": {"steps": steps, "sampler_name": "euler", "latent_image": ["1", 0]}},
+    }
+
+def profile(p, seconds, cache="miss", status="success", model_load_time=0.0):
+    return {
+        "features": estimator.prompt_features(p),
+        "nodes": [{"node_id": "2", "cache": cache, "status": status, "duration": seconds + model_load_time, "model_load_time": model_load_time}],
+    }
+
+def test_prompt_features():
+    features = estimator.prompt_features(prompt(20, 1000, 500))
+    assert features["2"] == [["KSampler||euler", "KSampler"], [1.0, 20.0, 0.5, 10.0]]
+    assert features["1"] == [["EmptyLatentImage"], [1.0, 1.0, 0.5, 0.5]]
+
+def test_estimator_predicts_prompts_after_enough_samples(tmp_path):
+    path = str(tmp_path / "estimates.json")
+    e = estimator.RuntimeEstimator(path, decay=1.0)
+    assert e.predict_prompt(prompt(20, 512, 512)) is None
+
+    sizes = [(10, 512, 512), (20, 1024, 1024), (30, 512, 1024), (40, 1024, 512), (25, 768, 768)]
+    for i, (steps, width, height) in enumerate(sizes):
+        e.add(profile(prompt(steps, width, height), run_time(steps, width * height / 1e6), model_load_time=5.0))
+        # neither cache hits nor failures are samples
+        e.add(profile(prompt(steps, width, height), 100.0, cache="hit"))
+        e.add(profile(prompt(steps, width, height), 100.0, status="failure"))
+        if i + 1 < estimator.MIN_SAMPLES:
+            assert e.predict_prompt(prompt(20, 512, 512)) is None
+    assert e.regressions["KSampler||euler"].samples == len(sizes)
+    # without the time spent loading models
+    expected = run_time(35, 1.0)
+    assert e.predict_prompt(prompt(35, 1000, 1000)) == pytest.approx(expected, rel=0.05)
+
+    # and after a restart
+    e.save()
+    assert estimator.RuntimeEstimator(path).predict_prompt(prompt(35, 1000, 1000)) == pytest.approx(expected, rel=0.05)
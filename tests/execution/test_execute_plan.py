@@ -0,0 +1,79 @@
+"""
+PromptExecutor.execute_plan with the cpu thread pool, with stand-in node
+classes
+"""
+import threading
+
+import pytest
+
+import nodes
+import execution
+from comfy_execution import profiler
+
+class Value:
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"value": ("INT",)}, "optional": {"a": ("INT",), "b": ("INT",)}}
+
+    def run(self, value, a=0, b=0):
+        return (value + a + b,)
+
+class PooledValue(Value):
+    CPU_BOUND = True
+
+class Server:
+    client_id = None
+    last_node_id = None
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def node_classes(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {"Value": Value, "PooledValue": PooledValue})
+
+@pytest.fixture
+def executor():
+    e = execution.PromptExecutor(Server(), cpu_threads=2)
+    yield e
+    e.cpu_pool.shutdown(wait=True)
+
+def execute(e, prompt, outputs, timeout=30):
+    # a hung execute_plan fails the test instead of the whole run
+    thread = threading.Thread(target=e.execute, args=(prompt, "prompt", {}, outputs), daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "execute_plan did not return"
+
+def test_pooled_and_main_thread_nodes_run(executor):
+    prompt = {
+        "1": {"class_type": "PooledValue", "inputs": {"value": 1}},
+        "2": {"class_type": "Value", "inputs": {"value": 2}},
+        "3": {"class_type": "PooledValue", "inputs": {"value": 3, "a": ["1", 0], "b": ["2", 0]}},
+    }
+    execute(executor, prompt, ["3"])
+    assert executor.success
+    assert executor.outputs["3"] == [[6]]
+
+def test_exception_outside_the_node_fails_the_prompt(executor, monkeypatch):
+    node = profiler.PromptProfile.node
+    def failing_node(self, node_id, class_type):
+        if node_id == "2":
+            raise RuntimeError("profiler failed")
+        return node(self, node_id, class_type)
+    monkeypatch.setattr(profiler.PromptProfile, "node", failing_node)
+
+    prompt = {
+        "1": {"class_type": "Value", "inputs": {"value": 1}},
+        "2": {"class_type": "PooledValue", "inputs": {"value": 2}},
+        "3": {"class_type": "Value", "inputs": {"value": 3, "a": ["1", 0], "b": ["2", 0]}},
+    }
+    execute(executor, prompt, ["3"])
+    assert not executor.success
+    errors = [data for event, data in executor.status_messages if event == "execution_error"]
+    assert len(errors) == 1
+    assert errors[0]["node_id"] == "2"
+    assert errors[0]["exception_message"] == "profiler failed"
@@ -0,0 +1,151 @@
+"""
+ExecutionPlan ordering, lazy inputs and the release of outputs that no
+planned node reads anymore, with stand-in node classes
+"""
+import pytest
+
+import nodes
+import execution
+from comfy.cli_args import OutputReleasePolicy
+from comfy_execution import graph
+
+class Value:
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {}, "optional": {"a": ("INT",), "b": ("INT",)}}
+
+    def run(self, a=0, b=0):
+        return (a + b + 1,)
+
+class Switch:
+    RETURN_TYPES = ("INT",)
+    FUNCTION = "run"
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"on_true": ("INT", {"lazy": True}), "on_false": ("INT", {"lazy": True})},
+                "optional": {"a": ("INT",)}}
+
+    def check_lazy_status(self, on_true=None, on_false=None, a=None):
+        return ["on_true"] if on_true is None else []
+
+    def run(self, on_true=None, on_false=None, a=None):
+        return (on_true,)
+
+class Server:
+    client_id = None
+    last_node_id = None
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def node_classes(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {"Value": Value, "Switch": Switch})
+
+def node(class_type, **inputs):
+    return {"class_type": class_type, "inputs": {k: [v, 0] for k, v in inputs.items()}}
+
+def run(plan, prompt, outputs, asks={}):
+    """
+    Runs the plan like PromptExecutor does. asks maps a node to the nodes
+    behind the lazy inputs it asks for the first time it is popped. Returns
+    the nodes in the order they completed and the outputs that got released.
+    """
+    asks = dict(asks)
+    order = []
+    released = []
+    while not plan.is_finished():
+        unique_id = plan.pop_ready()
+        assert unique_id is not None, "plan is blocked"
+        if unique_id in asks:
+            plan.add_dependencies(unique_id, asks.pop(unique_id), outputs)
+            continue
+        for name, value in prompt[unique_id]["inputs"].items():
+            lazy = name in graph.get_lazy_inputs(nodes.NODE_CLASS_MAPPINGS[prompt[unique_id]["class_type"]])
+            if not lazy or value[0] in order:
+                assert value[0] in outputs, "{} read the released output of {}".format(unique_id, value[0])
+        outputs[unique_id] = [[unique_id]]
+        order.append(unique_id)
+        for x in plan.complete(unique_id):
+            released.append(x)
+            outputs.pop(x, None)
+    return order, released
+
+def test_inputs_run_first_and_are_released_after_their_last_consumer():
+    prompt = {
+        "1": node("Value"),
+        "2": node("Value", a="1"),
+        "3": node("Value", a="1", b="2"),
+    }
+    outputs = {}
+    order, released = run(graph.ExecutionPlan(prompt, outputs, ["3"]), prompt, outputs)
+    assert order == ["1", "2", "3"]
+    assert released == ["2", "1"] or released == ["1", "2"]
+    assert "3" in outputs
+
+def test_cached_outputs_are_not_planned():
+    prompt = {
+        "1": node("Value"),
+        "2": node("Value", a="1"),
+    }
+    outputs = {"1": [[1]]}
+    plan = graph.ExecutionPlan(prompt, outputs, ["2"])
+    assert len(plan) == 1
+    order, released = run(plan, prompt, outputs)
+    assert order == ["2"]
+    assert released == ["1"]
+
+def test_lazy_inputs_that_are_not_asked_for_dont_run():
+    prompt = {
+        "1": node("Value"),
+        "2": node("Value"),
+        "3": node("Switch", on_true="1", on_false="2"),
+    }
+    outputs = {}
+    order, _ = run(graph.ExecutionPlan(prompt, outputs, ["3"]), prompt, outputs, asks={"3": ["1"]})
+    assert order == ["1", "3"]
+
+def test_lazy_branch_keeps_the_outputs_it_reads():
+    # 1 is read by 2, which runs first, and by 3 that is behind a lazy input
+    # of 4. 1 must still be there when 4 asks for 3.
+    prompt = {
+        "1": node("Value"),
+        "2": node("Value", a="1"),
+        "3": node("Value", a="1"),
+        "4": node("Switch", on_true="3", on_false="2", a="2"),
+    }
+    outputs = {}
+    plan = graph.ExecutionPlan(prompt, outputs, ["4"])
+    order, released = run(plan, prompt, outputs, asks={"4": ["3"]})
+    assert order == ["1", "2", "3", "4"]
+    assert sorted(released) == ["1", "2", "3"]
+    assert all(x == 0 for x in plan.remaining_consumers.values())
+
+def test_lazy_branch_holds_are_dropped_when_it_is_not_asked_for():
+    prompt = {
+        "1": node("Value"),
+        "2": node("Value", a="1"),
+        "3": node("Value", a="1"),
+        "4": node("Switch", on_true="3", on_false="2", a="2"),
+    }
+    outputs = {}
+    order, released = run(graph.ExecutionPlan(prompt, outputs, ["4"]), prompt, outputs)
+    assert order == ["1", "2", "4"]
+    assert "1" in released
+
+def test_execute_plan_keeps_the_outputs_a_lazy_branch_reads():
+    prompt = {
+        "1": node("Value"),
+        "2": node("Value", a="1"),
+        "3": node("Value", a="1"),
+        "4": node("Switch", on_true="3", on_false="2", a="2"),
+    }
+    e = execution.PromptExecutor(Server(), release_outputs=OutputReleasePolicy.Intermediate)
+    e.execute(prompt, "prompt", {}, ["4"])
+    assert e.success
+    assert e.outputs["4"] == [[2]]
+    assert "1" not in e.outputs
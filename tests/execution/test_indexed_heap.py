@@ -0,0 +1,93 @@
+"""
+IndexedHeap ordering while items are pushed, removed and reprioritized
+"""
+import random
+
+import pytest
+
+from comfy_execution.indexed_heap import IndexedHeap
+
+def key(item):
+    return item[1]
+
+def check(heap):
+    # every item is where positions says and no child is smaller than its parent
+    for i, item in enumerate(heap.heap):
+        assert heap.positions[key(item)] == i
+        if i > 0:
+            assert not item < heap.heap[(i - 1) // 2]
+    assert len(heap.positions) == len(heap.heap)
+
+def drain(heap):
+    out = []
+    while len(heap) > 0:
+        out.append(heap.pop())
+        check(heap)
+    return out
+
+def test_pop_returns_items_in_priority_order():
+    heap = IndexedHeap(key)
+    for number, prompt_id in [(3, "c"), (1, "a"), (4, "d"), (2, "b"), (-1, "front")]:
+        heap.push((number, prompt_id))
+        check(heap)
+    assert heap.peek() == (-1, "front")
+    assert [x[1] for x in drain(heap)] == ["front", "a", "b", "c", "d"]
+
+def test_push_of_a_queued_key_raises():
+    heap = IndexedHeap(key, [(0, "a")])
+    with pytest.raises(KeyError):
+        heap.push((1, "a"))
+
+def test_remove_keeps_the_heap_ordered():
+    heap = IndexedHeap(key, [(i, str(i)) for i in range(20)])
+    check(heap)
+    assert heap.remove("7") == (7, "7")
+    assert heap.remove("0") == (0, "0")
+    assert heap.remove("missing") is None
+    assert "7" not in heap
+    check(heap)
+    assert [x[0] for x in drain(heap)] == [i for i in range(20) if i not in (0, 7)]
+
+def test_update_moves_the_item_to_its_new_priority():
+    heap = IndexedHeap(key, [(i, str(i)) for i in range(10)])
+    assert heap.update((-1, "5")) == (5, "5")
+    check(heap)
+    assert heap.peek() == (-1, "5")
+    heap.update((100, "5"))
+    check(heap)
+    assert heap.get("5") == (100, "5")
+    assert [x[1] for x in drain(heap)] == ["0", "1", "2", "3", "4", "6", "7", "8", "9", "5"]
+
+def test_smallest_pages_in_priority_order_without_changing_the_heap():
+    items = [(i, str(i)) for i in range(30)]
+    random.Random(0).shuffle(items)
+    heap = IndexedHeap(key, items)
+    assert heap.smallest(5) == [(i, str(i)) for i in range(5)]
+    assert heap.smallest(5, offset=10) == [(i, str(i)) for i in range(10, 15)]
+    assert heap.smallest(5, offset=28) == [(28, "28"), (29, "29")]
+    assert heap.smallest(0) == []
+    assert len(heap) == 30
+    check(heap)
+
+def test_random_operations_match_a_sorted_list():
+    rng = random.Random(1)
+    heap = IndexedHeap(key)
+    expected = {}
+    for i in range(500):
+        op = rng.random()
+        if op < 0.5 or len(expected) == 0:
+            item = (rng.randint(-50, 50), "p{}".format(i))
+            heap.push(item)
+            expected[item[1]] = item
+        elif op < 0.7:
+            prompt_id = rng.choice(sorted(expected))
+            assert heap.remove(prompt_id) == expected.pop(prompt_id)
+        elif op < 0.9:
+            prompt_id = rng.choice(sorted(expected))
+            expected[prompt_id] = (rng.randint(-50, 50), prompt_id)
+            heap.update(expected[prompt_id])
+        else:
+            assert heap.pop() == min(expected.values())
+            del expected[min(expected.values())[1]]
+        check(heap)
+    assert heap.smallest(len(expected)) == sorted(expected.values())
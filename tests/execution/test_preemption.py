@@ -0,0 +1,78 @@
+"""
+Preemption pausing the running prompt for one sent to the front of the
+queue, and interrupting a paused prompt
+"""
+import pytest
+
+import execution
+import comfy.model_management
+from comfy_execution import preemption
+
+class Server:
+    def __init__(self):
+        self.number = 0
+        self.prompt_queue = None
+        self.client_id = "client"
+        self.last_node_id = "3"
+        self.last_prompt_id = None
+        self.messages = []
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        self.messages.append(event)
+
+@pytest.fixture
+def loads(monkeypatch):
+    loads = []
+    monkeypatch.setattr(comfy.model_management, "loaded_models", lambda only_currently_used=False: ["model"])
+    monkeypatch.setattr(comfy.model_management, "load_models_gpu", lambda models, *args, **kwargs: loads.append(models))
+    return loads
+
+def start(during=None):
+    """
+    A preemption with the prompt "paused" running and "front" queued ahead
+    of it. during(p) is called while "front" runs.
+    """
+    server = Server()
+    q = execution.PromptQueue(server)
+    ran = []
+    def run_prompt(item, item_id):
+        ran.append(item[1])
+        server.client_id = "other"
+        if during is not None:
+            during(p)
+        q.task_done(item_id, {}, None)
+    p = preemption.Preemption(q, server, run_prompt)
+    q.put((1, "paused", {}, {}, []))
+    item, item_id = q.get()
+    server.last_prompt_id = "paused"
+    p.started(item)
+    q.put((-2, "front", {}, {}, []))
+    return p, server, ran
+
+def test_paused_prompt_resumes(loads):
+    p, server, ran = start()
+    p.check()
+    assert ran == ["front"]
+    assert loads == [["model"]]
+    assert server.messages == ["execution_paused", "execution_resumed"]
+    assert (server.client_id, server.last_prompt_id) == ("client", "paused")
+    # nothing else to run ahead of it
+    p.check()
+    assert ran == ["front"]
+
+def test_interrupted_paused_prompt_doesnt_resume(loads):
+    interrupted = []
+    def during(p):
+        assert not p.interrupt("front")
+        interrupted.append(p.interrupt("paused"))
+    p, server, ran = start(during)
+    with pytest.raises(comfy.model_management.InterruptProcessingException):
+        p.check()
+    assert interrupted == [True]
+    assert ran == ["front"]
+    assert loads == []
+    assert server.messages == ["execution_paused"]
+    assert not p.interrupt("paused")
@@ -0,0 +1,128 @@
+"""
+PromptQueue: restoring a persisted queue, ordering and the change log
+behind /queue?since=, with stand-in node classes
+"""
+import pytest
+
+import nodes
+import execution
+from comfy_execution import queue_storage
+
+class Output:
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {}}
+
+class Server:
+    def __init__(self):
+        self.number = 0
+        self.prompt_queue = None
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def node_classes(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {"Output": Output})
+
+PROMPT = {"1": {"class_type": "Output", "inputs": {}}}
+
+def item(number, prompt_id, prompt=PROMPT, extra_data=None):
+    return (number, prompt_id, prompt, extra_data or {}, ["1"])
+
+def pending_ids(q):
+    return [x[1] for x in q.get_queue_page(0, 100)[1]]
+
+def test_restore_queues_the_persisted_prompts_again(tmp_path):
+    path = str(tmp_path / "queue.db")
+    q = execution.PromptQueue(Server(), queue_storage.SQLiteStorage(path))
+    q.put(item(0, "a"))
+    q.put(item(1, "b"))
+    q.put(item(2, "c"))
+    # running when the process stopped
+    q.get()
+    q.storage.close()
+
+    server = Server()
+    q = execution.PromptQueue(server, queue_storage.SQLiteStorage(path))
+    q.restore()
+    assert pending_ids(q) == ["a", "b", "c"]
+    assert server.number == 3
+    q.storage.close()
+
+def test_restore_moves_prompts_that_dont_validate_to_the_history(tmp_path):
+    path = str(tmp_path / "queue.db")
+    q = execution.PromptQueue(Server(), queue_storage.SQLiteStorage(path))
+    q.put(item(0, "valid"))
+    q.put(item(1, "missing", {"1": {"class_type": "Missing", "inputs": {}}}))
+    q.storage.close()
+
+    q = execution.PromptQueue(Server(), queue_storage.SQLiteStorage(path))
+    q.restore()
+    assert pending_ids(q) == ["valid"]
+    entry = q.get_history("missing")["missing"]
+    assert entry["status"]["status_str"] == "error"
+    assert "Missing" in entry["status"]["messages"][0][1]["exception_message"]
+    q.storage.close()
+
+    # not queued again by the next restart either
+    q = execution.PromptQueue(Server(), queue_storage.SQLiteStorage(path))
+    q.restore()
+    assert pending_ids(q) == ["valid"]
+    q.storage.close()
+
+def ops(changes):
+    return [(x["op"], x["prompt_id"]) for x in changes]
+
+def test_queue_page_is_sorted_by_number():
+    q = execution.PromptQueue(Server())
+    for number in [5, 1, 4, 2, 3]:
+        q.put(item(number, str(number)))
+    q.set_priority("4", -1)
+    running, pending, total, version = q.get_queue_page(1, 3)
+    assert running == []
+    assert [x[1] for x in pending] == ["1", "2", "3"]
+    assert total == 5
+    assert version == q.version
+
+def test_changes_since_a_version():
+    q = execution.PromptQueue(Server())
+    q.put(item(0, "a"))
+    version = q.version
+    q.put(item(1, "b"))
+    q.put(item(2, "c"))
+    q.set_priority("c", -1)
+    q.delete_queue_items(["b"])
+    _, item_id = q.get()
+    q.task_done(item_id, {}, None)
+
+    current, changes = q.get_changes(version)
+    assert current == q.version
+    assert ops(changes) == [("add", "b"), ("add", "c"), ("priority", "c"), ("remove", "b"), ("running", "c"), ("done", "c")]
+    assert [x["version"] for x in changes] == list(range(version + 1, current + 1))
+    assert changes[2]["number"] == -1
+    # added items that are gone by now come without the item
+    assert changes[0]["item"] is None and changes[1]["item"] is None
+
+    _, changes = q.get_changes(0)
+    assert ops(changes)[0] == ("add", "a")
+    assert changes[0]["item"] == item(0, "a")
+    assert q.get_changes(current) == (current, [])
+    assert q.get_changes(current + 10) == (current, [])
+
+def test_changes_too_old_to_know_ask_for_a_resync(monkeypatch):
+    monkeypatch.setattr(execution, "MAXIMUM_QUEUE_CHANGES", 3)
+    q = execution.PromptQueue(Server())
+    for i in range(5):
+        q.put(item(i, str(i)))
+    assert q.get_changes(1) == (5, None)
+    assert ops(q.get_changes(2)[1]) == [("add", "2"), ("add", "3"), ("add", "4")]
+    q.wipe_queue()
+    assert ops(q.get_changes(5)[1]) == [("clear", None)]
@@ -0,0 +1,182 @@
+"""
+The queue policies picking what PromptQueue runs next, with stand-in node
+classes
+"""
+import pytest
+
+import nodes
+import execution
+from comfy_execution import scheduling
+
+class Loader:
+    RETURN_TYPES = ("MODEL",)
+    FUNCTION = "run"
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"ckpt_name": (["x.safetensors", "y.safetensors"],)}}
+
+class Output:
+    RETURN_TYPES = ()
+    FUNCTION = "run"
+    OUTPUT_NODE = True
+
+    @classmethod
+    def INPUT_TYPES(s):
+        return {"required": {"model": ("MODEL",)}}
+
+class Server:
+    def __init__(self):
+        self.number = 0
+        self.prompt_queue = None
+
+    def queue_updated(self):
+        pass
+
+    def send_sync(self, event, data, sid=None):
+        pass
+
+@pytest.fixture(autouse=True)
+def node_classes(monkeypatch):
+    monkeypatch.setattr(nodes, "NODE_CLASS_MAPPINGS", {"Loader": Loader, "Output": Output})
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def monotonic(self):
+        return self.now
+
+    def time(self):
+        return self.now
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(scheduling, "time", clock)
+    return clock
+
+def item(number, prompt_id, ckpt_name="x.safetensors", client_id=None, **extra_data):
+    prompt = {
+        "1": {"class_type": "Loader", "inputs": {"ckpt_name": ckpt_name}},
+        "2": {"class_type": "Output", "inputs": {"model": ["1", 0]}},
+    }
+    return (number, prompt_id, prompt, dict(extra_data, client_id=client_id), ["2"])
+
+def estimate(item):
+    return item[3].get("estimate", None)
+
+def run(q, count):
+    """
+    Starts and finishes count items, returns their prompt ids in the order
+    the policy picked them.
+    """
+    out = []
+    for i in range(count):
+        started, item_id = q.get(timeout=0)
+        out.append(started[1])
+        q.task_done(item_id, {}, None)
+    return out
+
+def test_model_affinity_runs_prompts_sharing_models_together():
+    q = execution.PromptQueue(Server(), policy=scheduling.ModelAffinityPolicy(window=8, max_skips=2))
+    q.put(item(0, "a", "x.safetensors"))
+    q.put(item(1, "b", "y.safetensors"))
+    q.put(item(2, "c", "x.safetensors"))
+    q.put(item(3, "d", "x.safetensors"))
+    q.put(item(4, "e", "x.safetensors"))
+    # b is passed over twice then has to run, even if e shares more with d
+    assert run(q, 5) == ["a", "c", "d", "b", "e"]
+
+def test_model_affinity_runs_items_sent_to_the_front_first():
+    q = execution.PromptQueue(Server(), policy=scheduling.ModelAffinityPolicy())
+    q.put(item(0, "a", "x.safetensors"))
+    q.put(item(1, "b", "x.safetensors"))
+    q.put(item(2, "c", "y.safetensors"))
+    assert run(q, 1) == ["a"]
+    q.set_priority("c", -1)
+    assert run(q, 2) == ["c", "b"]
+
+def test_fair_shares_follow_the_weights():
+    policy = scheduling.FairPolicy(weights={"alice": 2.0})
+    q = execution.PromptQueue(Server(), policy=policy)
+    for i in range(6):
+        q.put(item(i, "alice{}".format(i), client_id="alice"))
+    for i in range(3):
+        q.put(item(6 + i, "bob{}".format(i), client_id="bob"))
+
+    # virtual time advances by 1 / weight for every prompt started
+    q.get(timeout=0)
+    assert policy.virtual_time == {"alice": 0.5, "bob": 0.0}
+    q.get(timeout=0)
+    assert policy.virtual_time == {"alice": 0.5, "bob": 1.0}
+    order = [x[:-1] for x in ["alice0", "bob0"] + run(q, 7)]
+    assert order == ["alice", "bob", "alice", "alice", "bob", "alice", "alice", "bob", "alice"]
+
+def test_fair_owner_starting_again_joins_at_the_current_virtual_time():
+    policy = scheduling.FairPolicy()
+    q = execution.PromptQueue(Server(), policy=policy)
+    q.put(item(0, "alice0", client_id="alice"))
+    assert run(q, 1) == ["alice0"]
+    for i in range(4):
+        q.put(item(1 + i, "bob{}".format(i), client_id="bob"))
+    assert run(q, 3) == ["bob0", "bob1", "bob2"]
+    assert policy.clock == 2.0
+
+    # alice was idle, that doesn't earn three prompts in a row to catch up
+    q.put(item(5, "alice1", client_id="alice"))
+    q.put(item(6, "alice2", client_id="alice"))
+    assert policy.describe()["owners"]["alice"]["virtual_time"] == 2.0
+    assert run(q, 3) == ["alice1", "bob3", "alice2"]
+
+def test_fair_holds_back_owners_at_their_running_limit():
+    policy = scheduling.FairPolicy(max_running={"alice": 1})
+    q = execution.PromptQueue(Server(), policy=policy)
+    q.put(item(0, "alice0", client_id="alice"))
+    q.put(item(1, "alice1", client_id="alice"))
+    started, item_id = q.get(timeout=0)
+    assert started[1] == "alice0"
+    assert policy.select(q.queue) is None
+    assert q.get(timeout=0) is None
+
+    # others still run meanwhile
+    q.put(item(2, "bob0", client_id="bob"))
+    assert run(q, 1) == ["bob0"]
+    q.task_done(item_id, {}, None)
+    assert run(q, 1) == ["alice1"]
+
+def test_shortest_job_runs_the_lowest_estimate_first(clock):
+    q = execution.PromptQueue(Server(), policy=scheduling.ShortestJobPolicy(estimate))
+    q.put(item(0, "slow", estimate=30.0))
+    q.put(item(1, "fast", estimate=5.0))
+    q.put(item(2, "mid", estimate=10.0))
+    q.put(item(3, "also_fast", estimate=5.0))
+    # the average of the estimates known when it was queued
+    q.put(item(4, "unknown"))
+    q.put(item(5, "front", estimate=60.0))
+    q.set_priority("front", -1)
+    q.put(item(6, "faster", estimate=1.0))
+    assert run(q, 7) == ["front", "faster", "fast", "also_fast", "mid", "unknown", "slow"]
+
+def test_shortest_job_runs_items_that_waited_max_wait(clock):
+    q = execution.PromptQueue(Server(), policy=scheduling.ShortestJobPolicy(estimate, max_wait=60.0))
+    q.put(item(0, "slow", estimate=30.0))
+    clock.now += 30.0
+    q.put(item(1, "fast", estimate=5.0))
+    q.put(item(2, "faster", estimate=1.0))
+    assert run(q, 1) == ["faster"]
+    clock.now += 30.0
+    assert run(q, 2) == ["slow", "fast"]
+
+def test_deadline_runs_the_least_slack_first(clock):
+    policy = scheduling.DeadlinePolicy(estimate, default_deadline=100.0)
+    q = execution.PromptQueue(Server(), policy=policy)
+    # has to start by 1040
+    q.put(item(0, "long", deadline=1100.0, estimate=60.0))
+    # 1050
+    q.put(item(1, "short", deadline=1060.0, estimate=10.0))
+    # 1095, queued without a deadline
+    q.put(item(2, "default", estimate=5.0))
+    # 1030
+    q.put(item(3, "soon", deadline=1030.0))
+    assert run(q, 4) == ["soon", "long", "short", "default"]
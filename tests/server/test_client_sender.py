@@ -0,0 +1,106 @@
+"""
+ClientSender keeping a slow websocket client from holding up the others,
+with a stand-in websocket
+"""
+import asyncio
+
+from server import ClientSender, BinaryEventTypes
+
+class WebSocket:
+    def __init__(self, blocked=False):
+        self.sent = []
+        self.closed = False
+        self.unblocked = asyncio.Event()
+        if not blocked:
+            self.unblocked.set()
+
+    async def send_str(self, message):
+        await self.unblocked.wait()
+        self.sent.append(message)
+
+    async def send_bytes(self, message):
+        await self.unblocked.wait()
+        self.sent.append(message)
+
+    async def close(self):
+        self.closed = True
+
+async def settle():
+    for i in range(10):
+        await asyncio.sleep(0)
+
+def run(test):
+    asyncio.run(test())
+
+def test_only_the_latest_progress_and_preview_are_sent():
+    async def test():
+        ws = WebSocket(blocked=True)
+        sender = ClientSender("slow", ws)
+        sender.put("executing", "str", "executing 1")
+        await settle()
+        # the first message is being sent, these wait behind it
+        for i in range(5):
+            sender.put("progress", "str", "progress {}".format(i))
+            sender.put(BinaryEventTypes.PREVIEW_IMAGE, "bytes", b"preview %d" % i)
+        sender.put("executed", "str", "executed 1")
+        assert sender.size == 3
+        ws.unblocked.set()
+        await settle()
+        assert ws.sent == ["executing 1", "progress 4", b"preview 4", "executed 1"]
+        assert sender.size == 0
+    run(test)
+
+def test_full_client_stops_getting_previews_then_is_disconnected():
+    async def test():
+        ws = WebSocket(blocked=True)
+        sender = ClientSender("slow", ws, max_size=4)
+        sender.put("executing", "str", "m0")
+        await settle()
+        sender.put(BinaryEventTypes.PREVIEW_IMAGE, "bytes", b"preview")
+        for i in range(1, 4):
+            sender.put("executed", "str", "m{}".format(i))
+        # full: the preview goes to make room
+        sender.put("executed", "str", "m4")
+        assert not sender.previews and not sender.closed
+        sender.put(BinaryEventTypes.PREVIEW_IMAGE, "bytes", b"dropped")
+        assert sender.size == 4
+
+        ws.unblocked.set()
+        await settle()
+        assert ws.sent == ["m0", "m1", "m2", "m3", "m4"]
+        # caught up, previews again
+        assert sender.previews
+        sender.put(BinaryEventTypes.PREVIEW_IMAGE, "bytes", b"preview")
+        await settle()
+        assert ws.sent[-1] == b"preview"
+
+        ws.unblocked.clear()
+        sender.put("executing", "str", "m5")
+        await settle()
+        for i in range(6, 11):
+            sender.put("executed", "str", "m{}".format(i))
+        await settle()
+        assert sender.closed and ws.closed
+        assert sender.size == 0
+        sender.put("executed", "str", "ignored")
+        assert len(sender.queue) == 0
+    run(test)
+
+def test_slow_client_doesnt_hold_up_the_others():
+    async def test():
+        slow = WebSocket(blocked=True)
+        fast = WebSocket()
+        senders = [ClientSender("slow", slow), ClientSender("fast", fast)]
+        for i in range(100):
+            for sender in senders:
+                sender.put("executed", "str", "m{}".format(i))
+            await asyncio.sleep(0)
+        await settle()
+        assert fast.sent == ["m{}".format(i) for i in range(100)]
+        assert slow.sent == []
+        slow.unblocked.set()
+        await settle()
+        assert slow.sent == fast.sent
+        for sender in senders:
+            sender.task.cancel()
+    run(test)